@@ -0,0 +1,102 @@
+# NOTE: Starts a master and N replicas on localhost for the benchmarks in this directory, each replica with its own database
+# file (and optionally read-only relays), e.g. `with Cluster(3, env={"TOKEN_MODE": "ring"}) as cluster: ...`
+from pathlib import Path
+import os
+import shutil
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BACKEND = Path(__file__).resolve().parent.parent
+# NOTE: replicas expect the master on port 8000
+MASTER_PORT = 8000
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("localhost", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Nothing listening on port {port} after {timeout}s")
+
+
+# NOTE: a replica behind a router listens before its workers have joined, so the port alone does not say it is in the cluster
+def wait_for_members(count: int, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with urllib.request.urlopen(f"http://localhost:{MASTER_PORT}/membership/", timeout=5) as reply:
+            if len(json.load(reply)["servers"]) >= count:
+                return
+        time.sleep(0.1)
+    raise TimeoutError(f"Fewer than {count} replicas joined after {timeout}s")
+
+
+class Cluster:
+    def __init__(self, replicas: int, first_port: int = 8001, env: dict = None, settle: float = 1.0, workers: int = 1, relays: int = 0) -> None:
+        self.ports = [first_port + i for i in range(replicas)]
+        self.relay_ports = [first_port + replicas + i for i in range(relays)] # read-only relays (see relay/server.py)
+        self.env = env or {}
+        self.settle = settle
+        self.workers = workers # worker processes per replica, more than one starts them behind a router (see replica/router.py)
+        self.processes: list[subprocess.Popen] = []
+        self.workdir = None
+
+    @property
+    def master(self) -> str:
+        return f"localhost:{MASTER_PORT}"
+
+    @property
+    def replicas(self) -> list[str]:
+        return [f"localhost:{port}" for port in self.ports]
+
+    def spawn(self, directory: str, port: int, env: dict) -> None:
+        log = open(Path(self.workdir) / f"{directory}_{port}.log", "w")
+        command = [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"]
+        if directory == "replica" and self.workers > 1:
+            command = [sys.executable, "router.py", "--port", str(port), "--workers", str(self.workers), "--log-level", "warning"]
+        self.processes.append(subprocess.Popen(
+            command,
+            cwd=BACKEND / directory,
+            env={**os.environ, **self.env, **env},
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        ))
+        wait_for_port(port)
+
+    def start(self) -> "Cluster":
+        self.workdir = tempfile.mkdtemp(prefix="sharenotes-bench-")
+        # NOTE: a fresh journal, the master would otherwise carry on with the replicas and documents of an earlier run
+        self.spawn("master", MASTER_PORT, {"JOURNAL_FILE": str(Path(self.workdir) / "master.journal")})
+        for port in self.ports:
+            self.spawn("replica", port, {"PORT": str(port), "IP": "localhost", "MASTER_IP": "localhost", "DB_DIR": self.workdir})
+        wait_for_members(len(self.ports))
+        for port in self.relay_ports:
+            self.spawn("relay", port, {"PORT": str(port), "IP": "localhost", "MASTER_IP": "localhost"})
+        # Give the master time to broadcast the final server list and start the tokens
+        time.sleep(self.settle)
+        return self
+
+    def stop(self) -> None:
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = []
+        if self.workdir and not os.getenv("KEEP_BENCH_LOGS"):
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self) -> "Cluster":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
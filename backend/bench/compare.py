@@ -0,0 +1,48 @@
+# NOTE: Compares two result files of load.py (e.g. main against a branch) configuration by configuration: the p50 and p99
+# of every latency and the throughputs side by side, with the change in percent (negative is faster for latencies,
+# positive is more for throughputs), e.g. `python compare.py main.json branch.json`
+import argparse
+import json
+
+LATENCIES = ("connect", "broadcast", "lock", "lap", "doc_list")
+THROUGHPUTS = ("ops_per_s", "deliveries_per_s")
+CONFIGURATION = ("replicas", "docs", "editors", "viewers", "mode", "placement", "replica_workers", "relays")
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        run = json.load(f)
+    return run, {tuple(result.get(key) for key in CONFIGURATION): result for result in run["results"]}
+
+
+def change(old, new) -> str:
+    if old is None or new is None:
+        return ""
+    if not old:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def row(name: str, old, new) -> str:
+    return f"  {name:<20} {'-' if old is None else old:>10} {'-' if new is None else new:>10} {change(old, new):>9}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two result files of load.py")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    args = parser.parse_args()
+
+    old_run, old_results = load(args.old)
+    new_run, new_results = load(args.new)
+    print(f"old: {old_run['branch']} {old_run['commit'][:10]}  new: {new_run['branch']} {new_run['commit'][:10]}")
+    for configuration, new in new_results.items():
+        old = old_results.get(configuration)
+        if old is None:
+            continue
+        print(", ".join(f"{key}={value}" for key, value in zip(CONFIGURATION, configuration)))
+        for metric in LATENCIES:
+            for q in ("p50", "p99"):
+                print(row(f"{metric} {q}", (old[metric] or {}).get(q), (new[metric] or {}).get(q)))
+        for metric in THROUGHPUTS:
+            print(row(metric, old[metric], new[metric]))
@@ -0,0 +1,249 @@
+# NOTE: Load tests a local cluster with simulated editors and viewers while the replica count and document count vary
+# (see README.md for what is measured). Every configuration gets its own cluster and documents, --editors editors take
+# turns on every document (--burst operations at --edit-rate per second, then --think seconds off) while --viewers
+# viewers only receive, for --duration seconds. Clients run in --workers processes, all clients of a document in one
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import resource
+import subprocess
+import time
+import httpx
+import requests
+import websockets
+from cluster import BACKEND, Cluster
+from stats import summarize
+
+START_EDITING = "*** START EDITING ***"
+STOP_EDITING = json.dumps({"content": "*** STOP EDITING ***"})
+
+
+class Client:
+    def __init__(self, docID: int, editor: bool) -> None:
+        self.docID = docID
+        self.editor = editor
+        self.websocket = None
+        self.version = 0 # version the next operation is based on
+        self.granted = asyncio.Event()
+
+
+# Where a client connects: placed by the master like a browser, or spread over the replicas round robin
+# NOTE: viewers ask for a view only connection, the master places them with a relay if there are any
+async def locate(http: httpx.AsyncClient, plan: dict, client: Client, index: int) -> str:
+    if plan["placement"] == "spread":
+        replicas = plan["replicas"]
+        return replicas[(client.docID + index) % len(replicas)]
+    reply = await http.post(f"http://{plan['master']}/connectToExistingDoc/", params={"docID": client.docID, "viewOnly": not client.editor})
+    server = reply.json()
+    return f"{server['IP']}:{server['port']}"
+
+
+async def connect(http: httpx.AsyncClient, plan: dict, client: Client, index: int, limit: asyncio.Semaphore, results: dict) -> None:
+    async with limit:
+        start = time.monotonic()
+        try:
+            replica = await locate(http, plan, client, index)
+            client.websocket = await websockets.connect(f"ws://{replica}/ws/{client.docID}/bench/false/", max_size=None)
+            client.version = json.loads(await client.websocket.recv())["version"]
+        except Exception:
+            results["errors"] += 1
+            client.websocket = None
+            return
+        results["connect"].append(time.monotonic() - start)
+
+
+# Every frame a client gets: viewers time the operations, editors keep the version their next operation is based on
+async def receive(client: Client, sent: dict, results: dict) -> None:
+    async for message in client.websocket:
+        now = time.monotonic()
+        if message == START_EDITING:
+            client.granted.set()
+            continue
+        frame = json.loads(message)
+        if "version" not in frame:
+            continue # queue position
+        # NOTE: other editors' operations and resync answers ("resync": true) both carry the document's current version
+        client.version = frame["version"]
+        if client.editor or "op" not in frame:
+            continue
+        key = (client.docID, frame["version"])
+        if key in sent:
+            results["broadcast"].append(now - sent[key])
+            results["applied"].add(key)
+        results["delivered"] += 1
+
+
+async def edit(client: Client, plan: dict, sent: dict, results: dict) -> None:
+    last_grant = None
+    while True:
+        client.granted.clear()
+        start = time.monotonic()
+        await client.websocket.send(json.dumps({"startEdit": True}))
+        await client.granted.wait()
+        granted = time.monotonic()
+        results["lock"].append(granted - start)
+        if last_grant is not None:
+            results["lap"].append(granted - last_grant)
+        last_grant = granted
+
+        for _ in range(plan["burst"]):
+            # NOTE: inserting at the start is valid whatever the content, a stale version is answered with a resync
+            await client.websocket.send(json.dumps({"op": {"pos": 0, "delete": 0, "insert": "x"}, "version": client.version}))
+            client.version += 1
+            sent[(client.docID, client.version)] = time.monotonic()
+            results["sent"] += 1
+            await asyncio.sleep(1 / plan["edit_rate"])
+        await client.websocket.send(STOP_EDITING)
+        await asyncio.sleep(plan["think"])
+
+
+async def worker(plan: dict) -> dict:
+    results = {"connect": [], "broadcast": [], "lock": [], "lap": [], "errors": 0, "sent": 0, "delivered": 0, "applied": set()}
+    sent: dict[tuple[int, int], float] = {}
+    clients = []
+    for docID in plan["docs"]:
+        clients += [Client(docID, True) for _ in range(plan["editors"])]
+        clients += [Client(docID, False) for _ in range(plan["viewers"])]
+
+    limit = asyncio.Semaphore(plan["connect_concurrency"])
+    async with httpx.AsyncClient(timeout=30) as http:
+        await asyncio.gather(*[connect(http, plan, client, index, limit, results) for index, client in enumerate(clients)])
+    clients = [client for client in clients if client.websocket is not None]
+
+    tasks = [asyncio.create_task(receive(client, sent, results)) for client in clients]
+    tasks += [asyncio.create_task(edit(client, plan, sent, results)) for client in clients if client.editor]
+    await asyncio.sleep(plan["duration"])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # NOTE: failures of tasks (closed sockets) other than the cancellation count as errors
+    results["errors"] += sum(1 for task in tasks if not task.cancelled() and task.exception() is not None)
+    await asyncio.gather(*[client.websocket.close() for client in clients], return_exceptions=True)
+    return results
+
+
+def run_worker(plan: dict) -> dict:
+    return asyncio.run(worker(plan))
+
+
+# Time GET /docList/ on the master until the workers are done
+def poll_doc_list(master: str, pending, limit: int, interval: float) -> list[float]:
+    samples = []
+    with requests.Session() as session:
+        while not pending.ready():
+            start = time.monotonic()
+            try:
+                session.get(f"http://{master}/docList/", params={"limit": limit}, timeout=30).raise_for_status()
+                samples.append(time.monotonic() - start)
+            except requests.RequestException:
+                pass
+            pending.wait(interval)
+    return samples
+
+
+def create_documents(master: str, count: int) -> list[int]:
+    ids = []
+    for first in range(0, count, 500):
+        names = [f"bench-{i}" for i in range(first, min(count, first + 500))]
+        reply = requests.post(f"http://{master}/createDocs/", json=names, timeout=60)
+        reply.raise_for_status()
+        ids += [doc["docID"] for doc in reply.json()]
+    return ids
+
+
+def run(replicas: int, docs: int, args: argparse.Namespace) -> dict:
+    env = {"TOKEN_MODE": args.mode, "TOKEN_HOP_DELAY": str(args.hop_delay)}
+    with Cluster(replicas, env=env, workers=args.replica_workers, relays=args.relays) as cluster:
+        ids = create_documents(cluster.master, docs)
+        time.sleep(1) # let the tokens of the new documents start
+        workers = min(args.workers, len(ids))
+        plans = [{
+            "master": cluster.master,
+            "replicas": cluster.replicas,
+            "docs": ids[i::workers],
+            "editors": args.editors,
+            "viewers": args.viewers,
+            "placement": args.placement,
+            "duration": args.duration,
+            "edit_rate": args.edit_rate,
+            "burst": args.burst,
+            "think": args.think,
+            "connect_concurrency": args.connect_concurrency,
+        } for i in range(workers)]
+        with multiprocessing.Pool(workers) as pool:
+            pending = pool.map_async(run_worker, plans)
+            doc_list = poll_doc_list(cluster.master, pending, args.doc_list_limit, args.doc_list_interval)
+            parts = pending.get()
+
+    merged = {key: [sample for part in parts for sample in part[key]] for key in ("connect", "broadcast", "lock", "lap")}
+    return {
+        "replicas": replicas,
+        "docs": docs,
+        "editors": args.editors,
+        "viewers": args.viewers,
+        "mode": args.mode,
+        "placement": args.placement,
+        "replica_workers": args.replica_workers,
+        "relays": args.relays,
+        "clients": sum(len(part["connect"]) for part in parts),
+        "errors": sum(part["errors"] for part in parts),
+        "duration": args.duration,
+        **{key: summarize(samples) for key, samples in merged.items()},
+        "doc_list": summarize(doc_list),
+        "ops_sent_per_s": round(sum(part["sent"] for part in parts) / args.duration, 1),
+        "ops_per_s": round(sum(len(part["applied"]) for part in parts) / args.duration, 1),
+        "deliveries_per_s": round(sum(part["delivered"] for part in parts) / args.duration, 1),
+    }
+
+
+def git(*command: str) -> str:
+    try:
+        return subprocess.run(["git", *command], cwd=BACKEND, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test local clusters with simulated editors and viewers")
+    parser.add_argument("--replicas", default="1,2,4", help="comma separated replica counts")
+    parser.add_argument("--docs", default="10,100", help="comma separated document counts")
+    parser.add_argument("--editors", type=int, default=2, help="editors per document")
+    parser.add_argument("--viewers", type=int, default=10, help="viewers per document")
+    parser.add_argument("--duration", type=float, default=20, help="seconds measured per configuration")
+    parser.add_argument("--edit-rate", type=float, default=5, help="operations per second while holding the lock")
+    parser.add_argument("--burst", type=int, default=10, help="operations per turn of holding the lock")
+    parser.add_argument("--think", type=float, default=0.5, help="seconds an editor waits before asking to edit again")
+    parser.add_argument("--mode", default="adaptive", help="TOKEN_MODE of the replicas (adaptive or ring)")
+    parser.add_argument("--hop-delay", type=float, default=2, help="TOKEN_HOP_DELAY for ring mode")
+    parser.add_argument("--placement", default="master", choices=["master", "spread"], help="clients placed by the master, or spread over every replica")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="client processes")
+    parser.add_argument("--replica-workers", type=int, default=1, help="worker processes per replica (more than one runs replica/router.py)")
+    parser.add_argument("--relays", type=int, default=0, help="read-only relays the viewers are placed with")
+    parser.add_argument("--connect-concurrency", type=int, default=100, help="connections opened at once per worker")
+    parser.add_argument("--doc-list-limit", type=int, default=50, help="page size of the polled /docList/")
+    parser.add_argument("--doc-list-interval", type=float, default=0.2, help="seconds between /docList/ requests")
+    parser.add_argument("--out", help="also write the results (and the commit they ran on) to this JSON file")
+    args = parser.parse_args()
+
+    # NOTE: every client is a socket on both ends, the replicas inherit the raised limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = []
+    for replicas in [int(n) for n in args.replicas.split(",")]:
+        for docs in [int(n) for n in args.docs.split(",")]:
+            result = run(replicas, docs, args)
+            results.append(result)
+            print(json.dumps(result), flush=True)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({
+                "commit": git("rev-parse", "HEAD"),
+                "branch": git("rev-parse", "--abbrev-ref", "HEAD"),
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "args": vars(args),
+                "results": results,
+            }, f, indent=2)
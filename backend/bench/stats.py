@@ -0,0 +1,26 @@
+# Summaries of latency samples shared by the benchmarks in this directory
+import statistics
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# count, mean and percentiles of a list of latencies (seconds), None when there are no samples
+def summarize(samples: list[float], digits: int = 4) -> dict:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def at(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], digits)
+
+    return {
+        "count": len(ordered),
+        "mean": round(statistics.mean(ordered), digits),
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "max": round(ordered[-1], digits),
+    }
@@ -0,0 +1,56 @@
+# NOTE: Benchmarks time to edit lock (request to edit -> "*** START EDITING ***") against the number of replicas. Each trial
+# connects an editor to the replica BEFORE the previous editor's, so on the ring the token has to go (almost) a full lap
+# to get to it, the worst case for ring circulation
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import requests
+import websockets
+from cluster import Cluster
+from stats import percentile
+
+
+async def time_to_lock(replica: str, docID: int) -> float:
+    async with websockets.connect(f"ws://{replica}/ws/{docID}/bench/false/") as websocket:
+        await websocket.recv()  # document snapshot
+        start = time.monotonic()
+        await websocket.send(json.dumps({"startEdit": True}))
+        while await websocket.recv() != "*** START EDITING ***":
+            pass  # queue position updates
+        elapsed = time.monotonic() - start
+        await websocket.send(json.dumps({"content": "*** STOP EDITING ***"}))
+        return elapsed
+
+
+def run(mode: str, replicas: int, trials: int, hop_delay: float) -> dict:
+    with Cluster(replicas, env={"TOKEN_MODE": mode, "TOKEN_HOP_DELAY": str(hop_delay)}) as cluster:
+        docID = requests.post(f"http://{cluster.master}/createDocAndConnect/", data="bench", headers={"Content-Type": "text/plain"}).json()["docID"]
+        samples = []
+        for trial in range(trials):
+            replica = cluster.replicas[-(trial + 1) % replicas]
+            samples.append(asyncio.run(time_to_lock(replica, docID)))
+            time.sleep(0.2)  # let the released token settle
+    return {
+        "mode": mode,
+        "replicas": replicas,
+        "trials": trials,
+        "mean": round(statistics.mean(samples), 4),
+        "p50": round(percentile(samples, 0.5), 4),
+        "p95": round(percentile(samples, 0.95), 4),
+        "max": round(max(samples), 4),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark time to edit lock against the number of replicas")
+    parser.add_argument("--replicas", default="1,2,4,8", help="comma separated replica counts")
+    parser.add_argument("--modes", default="adaptive,ring", help="comma separated token modes")
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--hop-delay", type=float, default=2, help="TOKEN_HOP_DELAY for ring mode")
+    args = parser.parse_args()
+
+    for mode in args.modes.split(","):
+        for replicas in [int(n) for n in args.replicas.split(",")]:
+            print(json.dumps(run(mode, replicas, args.trials, args.hop_delay)), flush=True)
@@ -0,0 +1,105 @@
+# NOTE: Measures bytes on the wire and CPU per edit for the frame formats replicas and clients exchange, on large documents.
+# Frames are built like the replicas build them (a replication batch with one edit) and framed by the websockets library
+# itself, with and without permessage-deflate, so the sizes are what goes over the socket. CPU is the sender's encode +
+# compress plus the receiver's decompress + decode. No cluster needed
+import argparse
+import json
+import random
+import time
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import Frame, Opcode
+from websockets.streams import StreamReader
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+WORDS = "the quick brown fox jumps over a lazy dog while notes are shared edited and replicated across every replica".split()
+
+
+def make_document(size: int) -> str:
+    rng = random.Random(size)
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+# The edits a client makes one after the other: single character operations, or the whole content every time
+def make_edits(content: str, kind: str, count: int) -> list[dict]:
+    rng = random.Random(len(content))
+    edits = []
+    for version in range(1, count + 1):
+        pos = rng.randrange(len(content))
+        content = content[:pos] + "x" + content[pos:]
+        if kind == "op":
+            edit = {"op": {"pos": pos, "delete": 0, "insert": "x"}, "version": version}
+        else:
+            edit = {"content": content, "version": version}
+        edits.append({"seq": version, "edits": [{"doc": 1, "name": "bench", **edit}]})
+    return edits
+
+
+# Parse a frame off the wire like the receiving end of a connection
+def receive(data: bytes, extensions) -> Frame:
+    reader = StreamReader()
+    reader.feed_data(data)
+    parser = Frame.parse(reader.read_exact, mask=True, extensions=extensions)
+    try:
+        next(parser)
+    except StopIteration as done:
+        return done.value
+    raise ValueError("incomplete frame")
+
+
+def measure(batches: list[dict], codec: str, compression: bool) -> dict:
+    # NOTE: one extension per side, each keeps its compression context across messages like a real connection
+    sender = PerMessageDeflate(False, False, 15, 15)
+    receiver = PerMessageDeflate(False, False, 15, 15)
+    wire_bytes = 0
+    cpu = 0.0
+    for batch in batches:
+        start = time.process_time()
+        if codec == "msgpack":
+            frame = Frame(Opcode.BINARY, msgpack.packb(batch))
+        else:
+            frame = Frame(Opcode.TEXT, json.dumps(batch).encode())
+        sent = frame.serialize(mask=True, extensions=[sender] if compression else None)
+        frame = receive(sent, [receiver] if compression else None)
+        if codec == "msgpack":
+            msgpack.unpackb(frame.data)
+        else:
+            json.loads(frame.data)
+        cpu += time.process_time() - start
+        wire_bytes += len(sent)
+    return {"bytes_per_edit": round(wire_bytes / len(batches), 1), "cpu_us_per_edit": round(cpu / len(batches) * 1e6, 1)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure bytes on the wire and CPU per edit of the frame formats")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma separated document sizes (characters)")
+    parser.add_argument("--edits", type=int, default=200, help="edits measured per combination")
+    parser.add_argument("--kinds", default="op,content", help="op (operation frames) and/or content (whole document frames)")
+    args = parser.parse_args()
+
+    codecs = ["json"] + (["msgpack"] if msgpack else [])
+    if not msgpack:
+        print("msgpack is not installed (pip install msgpack), only measuring json")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        content = make_document(size)
+        for kind in args.kinds.split(","):
+            # NOTE: whole document frames on a 1MB document are slow to build, fewer of them give the same averages
+            batches = make_edits(content, kind, args.edits if kind == "op" else max(10, args.edits * 10000 // size))
+            for codec in codecs:
+                for compression in (False, True):
+                    result = {"size": size, "kind": kind, "codec": codec, "deflate": compression, "edits": len(batches)}
+                    result.update(measure(batches, codec, compression))
+                    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+from __future__ import annotations
+from typing import Iterable, Optional
+import bisect
+import heapq
+import uuid
+
+
+# NOTE: The master's copy of the document list (docID -> name) so listing documents does not ask every replica.
+# It is filled from the document lists of joining replicas and from documents the master creates, every change
+# bumps 'version' which clients get as the ETag of the list
+class Catalog:
+    def __init__(self) -> None:
+        self.names: dict[int, str] = {}
+        self.ids: list[int] = [] # sorted, docIDs are the pagination cursor
+        self.by_name: list[tuple[str, int]] = [] # sorted (lowercased name, docID), for searching by name prefix
+        self.version = 0
+        # NOTE: part of the ETag so a restarted master (counting versions from 0 again) never matches an old one
+        self.instance = uuid.uuid4().hex[:8]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, docID: int) -> bool:
+        return docID in self.names
+
+    # Add documents [{"id": docID, "name": name}, ...], returns the number that were not known yet
+    def add(self, docs: Iterable[dict]) -> int:
+        added = 0
+        for doc in docs:
+            docID = int(doc["id"])
+            if docID in self.names:
+                continue
+            self.names[docID] = doc["name"]
+            # NOTE: new docIDs are always the largest, only documents adopted from replicas land in the middle
+            if not self.ids or docID > self.ids[-1]:
+                self.ids.append(docID)
+            else:
+                bisect.insort(self.ids, docID)
+            bisect.insort(self.by_name, (doc["name"].lower(), docID))
+            added += 1
+        if added:
+            self.version += 1
+        return added
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.instance}-{self.version}"'
+
+    # Up to 'limit' documents with a docID above 'after' (in docID order), only names starting with 'prefix' (ignoring case)
+    def page(self, limit: Optional[int] = None, after: Optional[int] = None, prefix: Optional[str] = None) -> list[dict]:
+        if prefix:
+            # NOTE: the names starting with the prefix are one range of the name index, only that range is looked at
+            prefix = prefix.lower()
+            start = bisect.bisect_left(self.by_name, (prefix,))
+            end = bisect.bisect_left(self.by_name, (prefix + "\U0010ffff",))
+            matches = (docID for _, docID in self.by_name[start:end] if after is None or docID > after)
+            ids = sorted(matches) if limit is None else heapq.nsmallest(limit, matches)
+        else:
+            start = bisect.bisect_right(self.ids, after) if after is not None else 0
+            ids = self.ids[start:] if limit is None else self.ids[start:start + limit]
+        return [{"id": docID, "name": self.names[docID]} for docID in ids]
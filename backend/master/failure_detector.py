@@ -0,0 +1,69 @@
+from __future__ import annotations
+from collections import deque
+from typing import Optional
+import math
+import os
+import time
+
+# NOTE: phi accrual failure detector (Hayashibara et al.), instead of a fixed timeout every replica gets a suspicion level phi
+# computed from how late its heartbeat is compared to the heartbeats seen so far, phi = -log10(P(heartbeat still to come))
+# so phi 1 is a 10% chance of a false positive, phi 8 is 1e-8
+PHI_THRESHOLD = float(os.getenv("PHI_THRESHOLD", "8"))
+# Number of heartbeat intervals kept per replica
+WINDOW = 100
+# Floor on the standard deviation (seconds) so very regular heartbeats do not make phi jump on the smallest delay
+MIN_STD_DEV = 0.1
+# Delay (seconds) on top of the usual interval that is not suspicious (e.g. a GC pause or a busy event loop)
+ACCEPTABLE_PAUSE = float(os.getenv("ACCEPTABLE_PAUSE", "0.5"))
+
+
+class HeartbeatHistory:
+    def __init__(self, first_interval: float) -> None:
+        # NOTE: seeded with a guess so phi is meaningful from the first heartbeat on
+        self.intervals: deque[float] = deque([first_interval, first_interval], maxlen=WINDOW)
+        self.last: Optional[float] = None
+
+    def heartbeat(self, now: float) -> None:
+        if self.last is not None:
+            self.intervals.append(now - self.last)
+        self.last = now
+
+    def phi(self, now: float) -> float:
+        if self.last is None:
+            return 0.0
+        mean = sum(self.intervals) / len(self.intervals)
+        variance = sum((x - mean) ** 2 for x in self.intervals) / len(self.intervals)
+        std_dev = max(math.sqrt(variance), MIN_STD_DEV)
+        mean += ACCEPTABLE_PAUSE
+        # NOTE: logistic approximation of the normal CDF (as used by Akka and Cassandra), y is clamped so exp does not overflow
+        y = max(-20.0, min(20.0, (now - self.last - mean) / std_dev))
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if now - self.last > mean:
+            return -math.log10(e / (1.0 + e))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+
+class FailureDetector:
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.histories: dict[str, HeartbeatHistory] = {}
+
+    def add(self, server: str) -> None:
+        if server not in self.histories:
+            self.histories[server] = HeartbeatHistory(self.interval)
+            self.histories[server].heartbeat(time.monotonic())
+
+    def remove(self, server: str) -> None:
+        self.histories.pop(server, None)
+
+    def heartbeat(self, server: str) -> None:
+        if server in self.histories:
+            self.histories[server].heartbeat(time.monotonic())
+
+    def phi(self, server: str) -> float:
+        return self.histories[server].phi(time.monotonic()) if server in self.histories else 0.0
+
+    # Replicas whose suspicion level crossed the threshold
+    def suspects(self) -> list[str]:
+        now = time.monotonic()
+        return [server for server, history in self.histories.items() if history.phi(now) > PHI_THRESHOLD]
@@ -0,0 +1,114 @@
+from __future__ import annotations
+from typing import Callable, Iterable, Optional
+import json
+import logging
+import os
+from pathlib import Path
+
+logger = logging.getLogger("uvicorn")
+
+# NOTE: The master state the replicas cannot give back is journaled to an append-only file, so a restarted master carries
+# on where it stopped instead of every replica registering again and every token being started over:
+# - membership: the epoch and the replicas in the cluster
+# - documents: docID and name of every document, and the next docID to hand out
+# - tokens: the serial number of every document's token, written when a token is started or regenerated (not on every hop)
+# Load, token holders and replicas waiting for tokens come back with the replicas' next reports.
+# Every change is one JSON line replayed in order on startup. The file is rewritten as a snapshot of the current state
+# (compacted) on startup and once JOURNAL_COMPACT_RECORDS records were appended since
+# NOTE: kept in a data directory next to this file by default (not wherever the master happens to be started from)
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", str(Path(__file__).parent.resolve() / "data" / "master.journal"))
+# "true" also syncs every record to disk (survives the machine crashing, not only the master)
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "false").lower() == "true"
+JOURNAL_COMPACT_RECORDS = int(os.getenv("JOURNAL_COMPACT_RECORDS", "100000"))
+# Documents (or tokens) per record of a snapshot
+SNAPSHOT_CHUNK = 10000
+
+
+class JournalState:
+    def __init__(self) -> None:
+        self.epoch = 0
+        self.servers: list[str] = []
+        self.docs: dict[int, str] = {}
+        self.next_doc_id = 1
+        self.tokens: dict[int, int] = {}
+
+    def apply(self, record: dict) -> None:
+        kind = record["type"]
+        if kind == "membership":
+            self.epoch = record["epoch"]
+            self.servers = record["servers"]
+        elif kind == "docs":
+            for docID, name in record["docs"]:
+                self.docs[int(docID)] = name
+            self.next_doc_id = max(self.next_doc_id, record.get("next", 1))
+        elif kind == "tokens":
+            for docID, serial in record["tokens"]:
+                self.tokens[int(docID)] = serial
+
+    def records(self) -> Iterable[dict]:
+        yield {"type": "membership", "epoch": self.epoch, "servers": self.servers}
+        docs = list(self.docs.items())
+        for i in range(0, max(len(docs), 1), SNAPSHOT_CHUNK):
+            yield {"type": "docs", "docs": docs[i:i + SNAPSHOT_CHUNK], "next": self.next_doc_id}
+        tokens = list(self.tokens.items())
+        for i in range(0, len(tokens), SNAPSHOT_CHUNK):
+            yield {"type": "tokens", "tokens": tokens[i:i + SNAPSHOT_CHUNK]}
+
+
+class Journal:
+    def __init__(self, path: str, snapshot: Callable[[], JournalState]) -> None:
+        self.path = path # empty turns journaling off
+        self.snapshot = snapshot # the current state, written when compacting
+        self.file = None
+        self.appended = 0
+
+    # State as of the last record written
+    def replay(self) -> JournalState:
+        state = JournalState()
+        if not self.path or not os.path.exists(self.path):
+            return state
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # NOTE: only the last line can be cut short (the master stopped while writing it)
+                    logger.info("Ignoring a partly written record at the end of the journal")
+                    break
+                state.apply(record)
+        return state
+
+    # Start appending to a fresh journal holding 'state'
+    def open(self, state: Optional[JournalState] = None) -> None:
+        if self.path:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self.compact(state or self.snapshot())
+
+    def compact(self, state: JournalState) -> None:
+        partial = f"{self.path}.tmp"
+        with open(partial, "w") as f:
+            for record in state.records():
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        # NOTE: the old journal stays whole until the snapshot replaces it in one step
+        os.replace(partial, self.path)
+        self.close()
+        self.file = open(self.path, "a")
+        self.appended = 0
+
+    def append(self, record: dict) -> None:
+        if self.file is None:
+            return
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.file.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(self.file.fileno())
+        self.appended += 1
+        if self.appended >= JOURNAL_COMPACT_RECORDS:
+            self.compact(self.snapshot())
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,138 @@
+from __future__ import annotations
+from typing import Iterable, Optional
+import heapq
+import itertools
+import os
+
+# NOTE: Replicas are ranked by a load score built from what they report (see the replica's load.py):
+#   connected clients + LOOP_LAG_WEIGHT * event loop lag (seconds) + EDIT_RATE_WEIGHT * edits per second
+LOOP_LAG_WEIGHT = float(os.getenv("LOOP_LAG_WEIGHT", "100"))
+EDIT_RATE_WEIGHT = float(os.getenv("EDIT_RATE_WEIGHT", "0.1"))
+# NOTE: clients of a document are placed with the replica already serving it (so its edits are not fanned out across replicas)
+# unless that replica's score is more than AFFINITY_MAX_EXTRA_LOAD above the least loaded replica's
+AFFINITY_MAX_EXTRA_LOAD = float(os.getenv("AFFINITY_MAX_EXTRA_LOAD", "50"))
+
+
+class ReplicaLoad:
+    def __init__(self, server: str) -> None:
+        self.server = server
+        self.clients = 0 # last reported, plus clients placed (minus clients lost) since
+        self.loop_lag = 0.0
+        self.edit_rate = 0.0
+        self.hot_docs: list[int] = []
+        self.docs: dict[int, int] = {} # docID -> clients of that document
+        self.catching_up = False # still copying documents after joining, no clients are placed here meanwhile
+
+    @property
+    def score(self) -> float:
+        return self.clients + LOOP_LAG_WEIGHT * self.loop_lag + EDIT_RATE_WEIGHT * self.edit_rate
+
+
+# Least loaded replica in O(log n): a heap of (score, entry number, replica), entries are replaced instead of updated
+# and an entry is only valid while it is the replica's latest one (stale entries are dropped when they reach the top)
+class Placement:
+    def __init__(self) -> None:
+        self.loads: dict[str, ReplicaLoad] = {}
+        self.heap: list[tuple[float, int, str]] = []
+        self.latest: dict[str, int] = {}
+        self.counter = itertools.count()
+        self.doc_servers: dict[int, dict[str, int]] = {} # docID -> replica -> clients of that document
+
+    def __contains__(self, server: str) -> bool:
+        return server in self.loads
+
+    def add(self, server: str, catching_up: bool = False) -> None:
+        if server not in self.loads:
+            self.loads[server] = ReplicaLoad(server)
+        self.set_catching_up(server, catching_up)
+
+    def set_catching_up(self, server: str, catching_up: bool) -> None:
+        if server in self.loads:
+            self.loads[server].catching_up = catching_up
+            self.push(server)
+
+    def remove(self, server: str) -> None:
+        load = self.loads.pop(server, None)
+        self.latest.pop(server, None)
+        if load:
+            for docID in load.docs:
+                self.doc_servers.get(docID, {}).pop(server, None)
+
+    def push(self, server: str) -> None:
+        # NOTE: a replica that is catching up has no valid heap entry, least_loaded never picks it
+        if self.loads[server].catching_up:
+            self.latest.pop(server, None)
+            return
+        entry = next(self.counter)
+        self.latest[server] = entry
+        heapq.heappush(self.heap, (self.loads[server].score, entry, server))
+        # NOTE: rebuild once stale entries outnumber live ones so the heap does not grow forever
+        if len(self.heap) > 2 * len(self.loads) + 64:
+            self.heap = [(self.loads[s].score, e, s) for s, e in self.latest.items()]
+            heapq.heapify(self.heap)
+
+    # Load report from a replica, replaces what the master estimated since the last one
+    def report(self, server: str, report: dict) -> None:
+        self.add(server)
+        load = self.loads[server]
+        load.clients = int(report.get("sockets", 0))
+        load.loop_lag = float(report.get("loopLag", 0))
+        load.edit_rate = float(report.get("editRate", 0))
+        load.hot_docs = [int(docID) for docID in report.get("hotDocs", [])]
+        load.catching_up = bool(report.get("catchingUp", False))
+        docs = {int(docID): int(count) for docID, count in report.get("docs", {}).items()}
+        for docID in load.docs.keys() - docs.keys():
+            self.doc_servers.get(docID, {}).pop(server, None)
+        for docID, count in docs.items():
+            self.doc_servers.setdefault(docID, {})[server] = count
+        load.docs = docs
+        self.push(server)
+
+    # A client was placed with (or left) a replica, until the next report this is the master's estimate
+    def client_added(self, server: str, docID: Optional[int] = None) -> None:
+        self.change_clients(server, docID, 1)
+
+    def client_lost(self, server: str, docID: Optional[int] = None) -> None:
+        self.change_clients(server, docID, -1)
+
+    def change_clients(self, server: str, docID: Optional[int], change: int) -> None:
+        if server not in self.loads:
+            return
+        load = self.loads[server]
+        load.clients = max(0, load.clients + change)
+        if docID is not None:
+            count = max(0, load.docs.get(docID, 0) + change)
+            load.docs[docID] = count
+            self.doc_servers.setdefault(docID, {})[server] = count
+        self.push(server)
+
+    def least_loaded(self, candidates: Optional[Iterable[str]] = None) -> Optional[str]:
+        if candidates is not None:
+            # NOTE: only used with a handful of candidates (e.g. the replicas that confirmed a new document)
+            candidates = [server for server in candidates if server in self.loads]
+            ready = [server for server in candidates if not self.loads[server].catching_up]
+            # NOTE: a replica that is catching up is better than none (e.g. every replica of the document just joined)
+            return min(ready or candidates, key=lambda server: self.loads[server].score, default=None)
+        while self.heap:
+            _, entry, server = self.heap[0]
+            if self.latest.get(server) == entry:
+                return server
+            heapq.heappop(self.heap)
+        return None
+
+    # Replica for a new client of a document: the replica already serving the document if it is not overloaded
+    def place(self, docID: Optional[int] = None, candidates: Optional[Iterable[str]] = None) -> Optional[str]:
+        candidates = list(candidates) if candidates is not None else None
+        best = self.least_loaded(candidates)
+        if best is None and candidates is None:
+            best = self.least_loaded(self.loads) # every replica is catching up
+        if best is None or docID is None:
+            return best
+        serving = [server for server, count in self.doc_servers.get(docID, {}).items() if count > 0 and server in self.loads and not self.loads[server].catching_up]
+        if candidates is not None:
+            serving = [server for server in serving if server in candidates]
+        if serving:
+            busiest = max(serving, key=lambda server: self.loads[server].docs.get(docID, 0))
+            if self.loads[busiest].score - self.loads[best].score <= AFFINITY_MAX_EXTRA_LOAD:
+                return busiest
+        return best
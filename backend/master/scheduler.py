@@ -0,0 +1,70 @@
+from __future__ import annotations
+from typing import Any, Awaitable, Callable, Hashable, Optional
+import asyncio
+import logging
+import math
+
+logger = logging.getLogger("uvicorn")
+
+
+# NOTE: Hashed timing wheel, every deadline lives in one of 'slots' buckets that the wheel visits once per 'tick' seconds.
+# Scheduling, resetting and cancelling a deadline are O(1) dict/set operations, and one asyncio task drives every deadline
+# (instead of one thread per timer). Deadlines further away than one turn of the wheel wait extra 'rounds'.
+class TimingWheel:
+    def __init__(self, callback: Callable[[Any], Awaitable[None]], tick: float = 0.5, slots: int = 128) -> None:
+        self.callback = callback
+        self.tick = tick
+        self.buckets: list[set] = [set() for _ in range(slots)]
+        self.entries: dict[Hashable, list[int]] = {}  # key -> [slot, rounds left]
+        self.cursor = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+
+    # Call the callback with 'key' after 'delay' seconds, replacing any deadline the key already had
+    def schedule(self, key: Hashable, delay: float) -> None:
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self.cursor + ticks) % len(self.buckets)
+        self.buckets[slot].add(key)
+        self.entries[key] = [slot, (ticks - 1) // len(self.buckets)]
+
+    def cancel(self, key: Hashable) -> None:
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.buckets[entry[0]].discard(key)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.tick
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            self.cursor = (self.cursor + 1) % len(self.buckets)
+            expired = []
+            for key in list(self.buckets[self.cursor]):
+                entry = self.entries[key]
+                if entry[1] > 0:
+                    entry[1] -= 1
+                else:
+                    expired.append(key)
+            for key in expired:
+                self.cancel(key)
+                asyncio.create_task(self.expire(key))
+
+    async def expire(self, key: Hashable) -> None:
+        try:
+            await self.callback(key)
+        except Exception as e:
+            logger.info(f"Timer callback for {key} failed: {e}")
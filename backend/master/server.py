@@ -1,55 +1,111 @@
-from fastapi import Body, FastAPI, BackgroundTasks
+from contextlib import asynccontextmanager
+from fastapi import Body, FastAPI, BackgroundTasks, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Any
-import requests
+from typing import Any, Optional
+import asyncio
 import logging
-from threading import Lock, Timer
 import json
-
-
-# NOTE: The timeout before another token is regenerated is controlled by the integer provided as the first parameter
-# to object instansiation e.g. 'ResettableTimer(20, token_timeout, docID)' time out after 20 seconds
-class ResettableTimer(object):
-    def __init__(self, interval, function, tokenID):
-        self.interval = interval
-        self.function = function
-        self.tokenID = tokenID
-        self.timer = Timer(self.interval, self.function, [self.tokenID])
-        logger.info(f"Following token was generated: {self.tokenID}")
-
-    def run(self):
-        self.timer.start()
-
-    def reset(self):
-        self.timer.cancel()
-        self.timer = Timer(self.interval, self.function, [self.tokenID])
-        self.timer.start()
-        logger.info(f"Resetting the timer for token: {self.tokenID}")
-
-    def inUse(self):
-        self.timer.cancel()
-        logger.info(f"Marking token as in use (stopping its timer): {self.tokenID}")
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+# NOTE: the metrics registry is the replica's module (shared by every process of the cluster, see replica/metrics.py)
+sys.path.append(str(Path(__file__).resolve().parent.parent / "replica"))
+import http_client
+import metrics
+from catalog import Catalog
+from failure_detector import FailureDetector
+from hashring import HashRing
+from journal import JOURNAL_FILE, Journal, JournalState
+from placement import Placement
+from scheduler import TimingWheel
+
+
+# NOTE: A token is regenerated (with the next serial number) when the master has not heard of it for TOKEN_TIMEOUT seconds
+TOKEN_TIMEOUT = float(os.getenv("TOKEN_TIMEOUT", "20"))
+# Seconds between heartbeats (pings) to every replica, a replica that stops answering is evicted by the failure detector
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "1"))
+# NOTE: every document is stored by REPLICATION_FACTOR replicas picked by consistent hashing (0 stores every document everywhere)
+REPLICATION_FACTOR = int(os.getenv("REPLICATION_FACTOR", "3"))
+# Page size used when reading a replica's whole document list
+DOC_LIST_PAGE = int(os.getenv("DOC_LIST_PAGE", "1000"))
+# Number of attempts at creating documents on a replica before it is considered crashed
+CREATE_RETRIES = int(os.getenv("CREATE_RETRIES", "3"))
+
+
+class TokenState:
+    def __init__(self, serial: int) -> None:
+        self.serial = serial
+        self.holder: Optional[str] = None # replica that last reported the token
+        self.demand: list[str] = [] # replicas waiting for it, in order of request (used by adaptive circulation)
+        self.reported_at: Optional[float] = None # when a replica last reported passing it on
 
 
 class ServerInfo:
-    def __init__(self, IP_PORT: str, clients_online: int) -> None:
+    def __init__(self, IP_PORT: str) -> None:
         self.IP_PORT = IP_PORT
-        self.clients_online = clients_online
 
 
 # GLOBAL VARIABLES for instance of master server
-leader_index = 0
 # Tracking servers in the cluster
 server_docs: list[ServerInfo] = []
-server_list_lock = Lock() # NOTE: Precautionary lock to syncronize modification of the server list
-# Managing and tracking tokens
-tokens_not_initialized = True
-docID_timers: dict[str, ResettableTimer] = {}
-token_list: list[str] = []
-
+# Which replicas store which document
+ring = HashRing()
+server_list_lock = asyncio.Lock() # NOTE: Precautionary lock to syncronize modification of the server list
+# NOTE: membership epoch, bumped on every join and eviction, replicas ignore changes older than the view they have
+membership_version = 0
+detector = FailureDetector(HEARTBEAT_INTERVAL)
+# Load of every replica (reported by the replicas) and the documents they serve, used to place clients
+placement = Placement()
+# Documents each replica has connected clients on (replica -> docIDs), tokens in ring mode only go around these replicas
+editing: dict[str, set[int]] = {}
+# Managing and tracking tokens (docID -> its current token), every token deadline lives in one timing wheel
+tokens: dict[int, TokenState] = {}
+token_timers = TimingWheel(lambda docID: token_timeout(docID))
+# NOTE: docIDs are allocated here so a document has the same ID on every replica
+next_doc_id = 1
+# Every document in the cluster (docID -> name), the document list is served from here
+catalog = Catalog()
+# Membership, documents and token serial numbers survive a restart of the master (see journal.py)
+journal = Journal(JOURNAL_FILE, lambda: journal_state())
+# Requests still running after the endpoint that started them returned (kept so they are not garbage collected)
+background_tasks: set[asyncio.Task] = set()
+# NOTE: read-only relays (see relay/server.py) serve viewers (/connectToExistingDoc/?viewOnly=true) from a replica's
+# stream of edits, they are not in the ring: no documents, tokens or replication, only their own placement and heartbeats
+relay_placement = Placement()
+relay_detector = FailureDetector(HEARTBEAT_INTERVAL)
+# NOTE: changes every time the master starts, replicas that see a new one tell it which tokens they use and wait for
+# (what the journal does not keep, see journal.py and restore())
+instance = uuid.uuid4().hex[:8]
+
+# Metrics served at /metrics/ (see metrics.py)
+request_seconds = metrics.Histogram("sharenotes_master_request_seconds", "Time to answer a request (per endpoint)")
+token_hop = metrics.Histogram("sharenotes_token_hop_seconds", "Time between two reports of the same token (one hop, or a renewal while parked)")
+tokens_regenerated = metrics.Counter("sharenotes_tokens_regenerated_total", "Tokens regenerated after timing out")
+loop_lag = metrics.Histogram("sharenotes_event_loop_lag_seconds", "How late the event loop woke up a sleep (probed every 0.25s)")
+metrics.Gauge("sharenotes_replicas", "Replicas in the cluster", lambda: len(server_docs))
+metrics.Gauge("sharenotes_relays", "Read-only relays serving viewers", lambda: len(relay_placement.loads))
+metrics.Gauge("sharenotes_documents", "Documents in the catalog", lambda: len(catalog))
+metrics.Gauge("sharenotes_tokens", "Tokens tracked", lambda: len(tokens))
+metrics.Gauge("sharenotes_token_demand", "Replicas waiting for a token, over every token", lambda: sum(len(token.demand) for token in tokens.values()))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    token_timers.start()
+    restore()
+    monitor = asyncio.create_task(monitor_replicas())
+    lag_probe = asyncio.create_task(probe_loop_lag())
+    yield
+    lag_probe.cancel()
+    monitor.cancel()
+    token_timers.stop()
+    journal.close()
+    await http_client.close()
 
 # Create an instance of the FastAPI class
-app = FastAPI(title="Master Server")
+app = FastAPI(title="Master Server", lifespan=lifespan)
 
 # Adding CORS permissions for client
 origins = [
@@ -66,81 +122,193 @@ app.add_middleware(
 
 logger = logging.getLogger("uvicorn")
 
+# Time every request by the endpoint (path template) that answered it
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    request_seconds.observe(time.perf_counter() - start, endpoint=route.path if route else "unknown")
+    return response
+
+# Metrics of the master in the Prometheus text format
+@app.get("/metrics/")
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+# NOTE: a busy loop wakes up late, how late is the event loop lag
+async def probe_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + 0.25
+        await asyncio.sleep(0.25)
+        loop_lag.observe(max(0.0, loop.time() - expected))
+
 
 ### End points to deal with server additions and updates ###
 # Add replica to list of current servers
 @app.post("/addServer/")
-async def con_server(IP: str, port: str, background_task: BackgroundTasks):
+async def con_server(IP: str, port: str, background_task: BackgroundTasks, catchingUp: bool = False):
     # Basic error checking
     if(not port.isdigit()):
         logger.info("Port provided was not a valid positive number")
         return {"Message": "Bad port provided"}
     
-    with server_list_lock:
+    server = f"{IP}:{port}"
+    async with server_list_lock:
         servers = [x.IP_PORT for x in server_docs]
-        if f"{IP}:{port}" not in servers:
-            server_docs.append(ServerInfo(f"{IP}:{port}", 0))
-            servers.append(f"{IP}:{port}") # add server to local copy for leader election
-        # Pick a leader (lowest port number)
-        global leader_index
-        ports = [int(server.split(':')[1]) for server in servers]
-        leader_index = ports.index(min(ports))
-        logger.info(f"Leader index is {leader_index} and its ip:port are {servers[leader_index]}")
-        # inform other servers that a new one joined
-        background_task.add_task(broadcast_servers, server_docs)
+        if server not in servers:
+            server_docs.append(ServerInfo(server))
+            ring.add(server)
+            placement.add(server, catchingUp)
+            detector.add(server)
+            global membership_version
+            membership_version += 1
+            journal_membership()
+            # inform other servers that a new one joined
+            background_task.add_task(push_membership, {"epoch": membership_version, "joined": [server], "left": []})
+        else:
+            # NOTE: registering twice (e.g. a restart the failure detector did not notice) only needs the full view again
+            placement.set_catching_up(server, catchingUp)
+            background_task.add_task(push_membership, {"epoch": membership_version, "joined": [], "left": []}, [server])
+        # start tracking tokens for the documents the replica brings with it
+        background_task.add_task(adopt_documents, server)
     return {"Message": "Server added to cluster"}
 
-# Broadcast changes to replica list to all replicas
-def broadcast_servers(server_docs: list[ServerInfo]):
-    logger.info("Broadcasting updates to server_list")
+# Current membership view, pulled by replicas that missed a change
+@app.get("/membership/")
+async def membership():
+    return {"epoch": membership_version, "servers": [x.IP_PORT for x in server_docs], "replicationFactor": REPLICATION_FACTOR}
+
+# Push a membership change {"epoch": e, "joined": [...], "left": [...]} to every replica at once
+# NOTE: replicas that just joined (or 'full_view_to') get the whole list instead, the others only the change and apply it
+# if it is the epoch after theirs (pulling the whole view from /membership/ when they missed one). Nothing is held
+# while the requests are out, a change made meanwhile gets its own push with the next epoch
+async def push_membership(delta: dict, full_view_to: Optional[list[str]] = None):
     server_list = [x.IP_PORT for x in server_docs] # get the IP_PORT info from the objects
-    # NOTE: behind a lock to ensure multiple tokens are not initalized and that updates provided to replicas for server lists are consistant
-    with server_list_lock:
-        for server in server_list:
-            try:
-                response = requests.post(f"http://{server}/updateServerList/", data=json.dumps(server_list))
-            except Exception as e:
-                logger.info(f"Failed to broadcast server list to {server} upon request from client, removing it from master list")
-                ip_port = server.split(':')
-                master_detect_replica_crashed(ip_port[0], ip_port[1])
-        
-        # tell the first server to start circulating the tokens for the documents
-        global tokens_not_initialized
-        if (tokens_not_initialized):
-
-            # Get the list of document_ids which need to be tracked from the leader replica
-            # NOTE: No check for if this server has crashed as this request is only made to the first server that just joined
-            # if it already crashed ... then the system is not in a recoverable state and will need to be restarted
-            ret_obj = requests.get(f'http://{server_list[leader_index]}/docList/')
-            doc_list = ret_obj.json()
-
-            # NOTE: only work on the document list if it is not empty
-            if doc_list:
-                global docID_timers
-                global token_list
-                docID_list = [int(doc['id']) for doc in doc_list]
-                logger.info(f"List of Doc IDs in master: {docID_list}")
-                # Start the timers for the tokens (serial number is 1 for the first token of that docID by default)
-                for docID in docID_list:
-                    token_list.append(f"{docID}:1")
-                    docID_timers[f"{docID}:1"] = ResettableTimer(20, token_timeout, f"{docID}:1")
-                    docID_timers[f"{docID}:1"].run()
-
-            # Start the token circulation (done by the leader replica)
-            # NOTE: No check for if this server has crashed as this request is only made to the first server that just joined
-            # if it already crashed ... then the system is not in a recoverable state and will need to be restarted
-            ack = requests.post(f"http://{server_list[leader_index]}/initializeTokens/")
-
-            tokens_not_initialized = False
-        
-    logger.info("Done broadcasting updates to server_list")
-
-# replica is informing master that it lost a client (useful for load balancing)
+    full_view = set(delta["joined"]) | set(full_view_to or [])
+    logger.info(f"Pushing membership epoch {delta['epoch']} (joined {delta['joined']}, left {delta['left']})")
+
+    def push(server: str):
+        if server in full_view:
+            return http_client.post(f"http://{server}/updateServerList/", params={"version": delta["epoch"], "replicationFactor": REPLICATION_FACTOR}, json=server_list)
+        return http_client.post(f"http://{server}/membershipDelta/", json=delta)
+
+    replies = await asyncio.gather(*[push(server) for server in server_list], return_exceptions=True)
+    for server, reply in zip(server_list, replies):
+        if isinstance(reply, Exception):
+            logger.info(f"Failed to push membership to {server}, removing it from master list")
+            evict_replica(server)
+
+
+# Track tokens for the documents a (re)joining replica has that the master does not know about yet
+# NOTE: this is how tokens are started when the cluster (or the master) starts, the replica puts them into circulation
+async def adopt_documents(server: str):
+    try:
+        doc_list = await fetch_doc_list(server)
+    except Exception as e:
+        logger.info(f"Failed to get doc list from {server}: {e}")
+        return
+    add_to_catalog(doc_list)
+    docID_list = [int(doc['id']) for doc in doc_list]
+    # Start the timers for the tokens (serial number is 1 for the first token of that docID by default)
+    bundle = [(docID, 1) for docID in docID_list if docID not in tokens]
+    if bundle:
+        logger.info(f"Adopting {len(bundle)} documents from {server}")
+        await initialize_tokens(bundle, server)
+
+# Whole document list of a replica, read a page at a time
+async def fetch_doc_list(server: str) -> list[dict]:
+    doc_list = []
+    while True:
+        params = {"limit": DOC_LIST_PAGE}
+        if doc_list:
+            params["after"] = doc_list[-1]["id"]
+        response = await http_client.get(f'http://{server}/docList/', params=params)
+        response.raise_for_status()
+        page = response.json()
+        doc_list += page
+        if len(page) < DOC_LIST_PAGE:
+            return doc_list
+
+# replica (or relay) is informing master that it lost a client (useful for load balancing)
 @app.post("/lostClient/{ip}/{port}/")
-async def lost_client(ip: str, port: str):
-    server_list = [x.IP_PORT for x in server_docs]
-    index = server_list.index(f"{ip}:{port}")
-    server_docs[index].clients_online -= 1 # Decrement client number
+async def lost_client(ip: str, port: str, docID: int = None):
+    placement.client_lost(f"{ip}:{port}", docID) # Decrement client number
+    relay_placement.client_lost(f"{ip}:{port}", docID)
+
+# replica reporting its load (connected clients, event loop lag, edit rate, documents it serves)
+@app.post("/reportLoad/")
+async def report_load(IP: str, port: str, report: dict):
+    server = f"{IP}:{port}"
+    # NOTE: reports from replicas that are not (or no longer) in the cluster are ignored,
+    # the replica registers again (it was evicted, e.g. after missing its heartbeats during a network partition)
+    if server not in placement:
+        return {"Registered": False}
+    placement.report(server, report)
+    # NOTE: presence changes are also pushed as they happen (/editors/), the report corrects any that got lost
+    editing[server] = {int(docID) for docID in report.get("docs", {})}
+    detector.heartbeat(server)
+    # NOTE: the epoch lets a replica that missed a membership change notice and pull the current view
+    return {"Registered": True, "epoch": membership_version, "master": instance}
+
+# replica finished copying the documents it was missing after joining, clients can be placed with it
+@app.post("/caughtUp/")
+async def caught_up(IP: str, port: str):
+    server = f"{IP}:{port}"
+    if server not in placement:
+        return {"Registered": False}
+    placement.set_catching_up(server, False)
+    logger.info(f"Server {server} caught up")
+    return {"Registered": True}
+
+# replica gained its first (present true) or lost its last client on a document
+@app.post("/editors/{docID}/")
+async def editors_changed(docID: int, IP: str, port: str, present: bool):
+    server = f"{IP}:{port}"
+    if server not in placement:
+        return {"Registered": False}
+    if present:
+        editing.setdefault(server, set()).add(docID)
+    else:
+        editing.setdefault(server, set()).discard(docID)
+    return {"Registered": True}
+
+### End points to deal with relays ###
+# Add a read-only relay, viewers can be placed with it right away
+@app.post("/addRelay/")
+async def add_relay(IP: str, port: str):
+    if(not port.isdigit()):
+        logger.info("Port provided was not a valid positive number")
+        return {"Message": "Bad port provided"}
+    relay = f"{IP}:{port}"
+    relay_placement.add(relay)
+    relay_detector.add(relay)
+    logger.info(f"Relay {relay} added")
+    return {"Message": "Relay added"}
+
+# relay reporting its load (connected viewers and the documents they watch)
+@app.post("/reportRelayLoad/")
+async def report_relay_load(IP: str, port: str, report: dict):
+    relay = f"{IP}:{port}"
+    # NOTE: a relay that was evicted registers again
+    if relay not in relay_placement:
+        return {"Registered": False}
+    relay_placement.report(relay, report)
+    relay_detector.heartbeat(relay)
+    return {"Registered": True}
+
+def evict_relay(relay: str):
+    if relay in relay_placement:
+        relay_placement.remove(relay)
+        relay_detector.remove(relay)
+        logger.info(f"Evicted relay {relay}")
+
+# Current load of every replica (for debugging and benchmarks)
+@app.get("/load/")
+async def get_load():
+    return {server: {"score": load.score, "clients": load.clients, "loopLag": load.loop_lag, "editRate": load.edit_rate, "hotDocs": load.hot_docs, "catchingUp": load.catching_up}
+            for server, load in placement.loads.items()}
 
 
 
@@ -148,162 +316,247 @@ async def lost_client(ip: str, port: str):
 # Create a new document in the dbs and connect clinet to a replica     
 @app.post("/createDocAndConnect/")
 async def create_doc_and_conn(docName: str = Body()):
-    global server_docs
-
-    docID = -1
-    with server_list_lock:
-        for server in server_docs:
-            try:
-                ret_obj = requests.post(f"http://{server.IP_PORT}/newDocID/{docName}/")
-                logger.info(ret_obj.json())
-                docID = ret_obj.json()["docID"]
-                logger.info(docID)
-            except Exception as e:
-                logger.info(f"Failed to create document at server {server.IP_PORT} upon request from client, removing it from master list")
-                ip_port = server.IP_PORT.split(':')
-                master_detect_replica_crashed(ip_port[0], ip_port[1])
-    
+    docs = allocate_docs([docName])
+    docID = docs[0]["id"]
+    created_at = await create_on_replicas(docs)
+
     # NOTE: should theoretically never run as long as servers are connected in good faith
-    if (docID == -1):
+    if not created_at:
         logger.info("Error occured with creating document")
-    
-    # Get replica with the fewest clients
-    index = min(range(len(server_docs)), key=lambda i: server_docs[i].clients_online)
-    server_docs[index].clients_online += 1 # Add one more client to this replica
-    server = server_docs[index].IP_PORT
-    server = str(server).split(':')
-
-    # Create a token for the new document
-    new_token = f"{docID}:1"
+        raise HTTPException(503, "Document could not be created on a majority of its replicas")
 
-    # Start the timer for this new token
-    global docID_timers
-    global token_list
-    token_list.append(new_token)
-    docID_timers[new_token] = ResettableTimer(20, token_timeout, new_token)
-    docID_timers[new_token].run()
+    add_to_catalog(docs)
 
-    # starts its circulation (done by leader replica)
-    # NOTE: loop to check for when replica has crashed
-    while True:
-        try:
-            global leader_index
-            leader_server = server_docs[leader_index].IP_PORT
-            # NOTE: first token for a given document has serial number of 1
-            response = requests.post(f"http://{leader_server}/initializeToken/{docID}/1/")
-            break
-        except Exception as e:
-            logger.info(f"Failed to initalize token for new document at leader {leader_server}, removing dead server from master list and trying again")
-            ip_port = leader_server.split(':')
-            master_detect_replica_crashed(ip_port[0], ip_port[1])
-            continue
+    # Create a token for the new document and start its circulation (done by one of its replicas)
+    # NOTE: first token for a given document has serial number of 1
+    await initialize_tokens([(docID, 1)])
 
+    # Get the least loaded replica (out of the ones that already have the document)
+    # NOTE: the replicas that confirmed it may have been evicted since, any replica storing it will do
+    server = placement.place(docID, created_at[docID]) or placement.place(docID, replica_set(docID))
+    if server is None:
+        return {"docID": docID, "docName": docName, "Error": "no servers online to connect too"}
+    placement.client_added(server, docID) # Add one more client to this replica
+    server = str(server).split(':')
 
     return {"docID": docID, "docName": docName, "IP": server[0], "port": server[1]}
 
+# Create many documents at once (e.g. importing), body is the list of document names
+@app.post("/createDocs/")
+async def create_docs(docNames: list[str]):
+    if not docNames:
+        return []
+    docs = allocate_docs(docNames)
+    if not await create_on_replicas(docs):
+        logger.info(f"Error occured with creating {len(docs)} documents")
+        raise HTTPException(503, "Documents could not be created on a majority of their replicas")
+    add_to_catalog(docs)
+    await initialize_tokens([(doc["id"], 1) for doc in docs])
+    return [{"docID": doc["id"], "docName": doc["name"]} for doc in docs]
+
 # Connect client to an existing document
+# NOTE: with the docID the client joins the replica already serving that document (unless it is overloaded),
+# out of the replicas storing it. A client that only watches the document (viewOnly) joins a relay instead (the one
+# already relaying the document unless it is overloaded), or a replica when there are no relays
 @app.post("/connectToExistingDoc/")
-async def conn_to_existing_doc():
-    # Get replica with the fewest clients
-    index = min(range(len(server_docs)), key=lambda i: server_docs[i].clients_online)
-    server_docs[index].clients_online += 1 # Add one more client to this replica
-    server = server_docs[index].IP_PORT
+async def conn_to_existing_doc(docID: int = None, viewOnly: bool = False):
+    if viewOnly and docID is not None:
+        relay = relay_placement.place(docID)
+        if relay is not None:
+            relay_placement.client_added(relay, docID)
+            relay = relay.split(':')
+            return {"IP": relay[0], "port": relay[1], "viewOnly": True}
+    server = placement.place(docID, replica_set(docID) if docID is not None else None)
+    if server is None:
+        return {"Error": "no servers online to connect too"}
+    placement.client_added(server, docID) # Add one more client to this replica
     server = str(server).split(':')
 
     return {"IP": server[0], "port": server[1]}
 
-# Get document list from leaders (all replicas SHOULD have the same doclist)
+# Get the document list, 'limit' documents at a time after docID 'after' (the last docID of the previous page)
+# NOTE: served from the master's catalog, 'prefix' only keeps names starting with it (ignoring case). The ETag changes
+# whenever a document is added, a client sending it back in If-None-Match gets a 304 while the list is unchanged
 @app.get("/docList/")
-def doc_list() -> Any:
-    # NOTE: loop to check for when replica has crashed
-    while True:
-        try:
-            global leader_index
-            leader_server = server_docs[leader_index].IP_PORT
-            ret_obj = requests.get(f'http://{leader_server}/docList/')
-            logger.info(f"docList requested by client: {ret_obj.json()}")
-            return ret_obj.json() # return statment acts like a break for the loop
-        except Exception as e:
-            logger.info(f"Failed to get doc list from leader ({leader_server}), removing dead server from master list and trying again")
-            ip_port = leader_server.split(':')
-            master_detect_replica_crashed(ip_port[0], ip_port[1])
-            continue
+async def doc_list(request: Request, response: Response, limit: Optional[int] = Query(None, ge=1), after: Optional[int] = None, prefix: Optional[str] = None) -> Any:
+    if request.headers.get("if-none-match") == catalog.etag:
+        return Response(status_code=304, headers={"ETag": catalog.etag, "Cache-Control": "no-cache"})
+    response.headers["ETag"] = catalog.etag
+    # NOTE: browsers may keep the list but have to revalidate it (If-None-Match) every time
+    response.headers["Cache-Control"] = "no-cache"
+    docs = catalog.page(limit, after, prefix)
+    logger.info(f"docList requested by client: {len(docs)} of {len(catalog)} documents")
+    return docs
 
 
 
 ### Functions for fault tolerance ###
+# Track a new token for a document and start its timer
+def start_token(docID: int, serial: int):
+    token = tokens.setdefault(docID, TokenState(serial))
+    token.serial = serial
+    token.holder = None
+    token_timers.schedule(docID, TOKEN_TIMEOUT)
+    logger.info(f"Following token was generated: {docID}:{serial}")
+
+# Only the latest serial number of a document's token is in circulation
+def is_current(token_id: int, token_serial: int) -> bool:
+    return token_id in tokens and tokens[token_id].serial == token_serial
+
 # Restart token if a timeout is reached
-def token_timeout(token: str):
-    logger.info(f"token {token} timed out, asking leader to generate a new token for that docID")
-    
-    global docID_timers
-    global token_list
-    # remove the token from the token_list and the docID_timers
-    token_list.pop(token_list.index(token))
-    docID_timers.pop(token, None)
-    # Get token info
-    docID = token.split(':')[0]
-    serial = int(token.split(':')[1])
-    serial += 1 # increament serial counter
-
-    # Track and start the new token
-    new_token = f"{docID}:{serial}"
-    token_list.append(new_token) # Add new token
-    docID_timers[new_token] = ResettableTimer(20, token_timeout, new_token)
-    docID_timers[new_token].run()
-
-    # NOTE: loop to check for when leader has crashed
-    while True:
-        try:
-            global leader_index
-            leader_server = server_docs[leader_index].IP_PORT
-            response = requests.post(f"http://{leader_server}/initializeToken/{docID}/{serial}/")
-            break
-        except Exception as e:
-            logger.info(f"Failed to get leader ({leader_server}) to initialize new token, removing dead server from master list and trying again")
-            ip_port = leader_server.split(':')
-            master_detect_replica_crashed(ip_port[0], ip_port[1])
-            continue
+async def token_timeout(docID: int):
+    logger.info(f"token {docID}:{tokens[docID].serial} timed out, asking one of its replicas to generate a new token for that docID")
+
+    tokens_regenerated.inc()
+    # Track and start the new token (increament serial counter)
+    # NOTE: replicas still waiting for the document keep their place
+    serial = tokens[docID].serial + 1
+    await initialize_tokens([(docID, serial)])
+
+# Track new tokens [(docID, serial), ...] and have one of the replicas of each document put them into circulation
+# NOTE: 'server' puts every token of the bundle into circulation instead (it has all the documents)
+async def initialize_tokens(bundle: list[tuple[int, int]], server: Optional[str] = None):
+    for docID, serial in bundle:
+        start_token(docID, serial)
+    journal.append({"type": "tokens", "tokens": bundle})
+
+    # NOTE: loop to check for when a replica has crashed, its tokens go to the next replica of their documents
+    while bundle and server_docs:
+        destinations: dict[str, list[tuple[int, int]]] = {}
+        for docID, serial in bundle:
+            target = server if server in ring.servers else replica_set(docID)[0]
+            destinations.setdefault(target, []).append((docID, serial))
+        targets = list(destinations)
+        replies = await asyncio.gather(*[initialize_at(target, destinations[target]) for target in targets], return_exceptions=True)
+        bundle = []
+        for target, reply in zip(targets, replies):
+            if isinstance(reply, Exception):
+                logger.info(f"Failed to get {target} to initialize new tokens, removing dead server from master list and trying again")
+                evict_replica(target)
+                bundle += destinations[target]
+
+async def initialize_at(server: str, bundle: list[tuple[int, int]]):
+    if len(bundle) == 1:
+        await http_client.post(f"http://{server}/initializeToken/{bundle[0][0]}/{bundle[0][1]}/")
+    else:
+        await http_client.post(f"http://{server}/initializeTokens/", json=bundle)
 
 # Stopping the timer for this token as it is in use
 @app.post("/tokenInUse/{token_id}/{token_serial}/")
-def token_in_use(token_id: int, token_serial: int):
-    global docID_timers
+async def token_in_use(token_id: int, token_serial: int, IP: str = None, port: str = None):
     token_formatted = f"{token_id}:{token_serial}"
-    docID_timers[token_formatted].inUse()
+    if is_current(token_id, token_serial):
+        token_timers.cancel(token_id)
+        # The replica using the token got what it was waiting for
+        if IP is not None:
+            tokens[token_id].holder = f"{IP}:{port}"
+            if f"{IP}:{port}" in tokens[token_id].demand:
+                tokens[token_id].demand.remove(f"{IP}:{port}")
     return {"Message": f"ack for {token_formatted}"}
 
 # Notification of maser to reset the timer for the provided token
 @app.post("/replicaRecvToken/{token_id}/{token_serial}/")
-async def replica_received_token(token_id: int, token_serial: int):
-    global docID_timers
-    global token_list
-    token_formatted = f"{token_id}:{token_serial}"
-    if token_formatted in token_list:
-        # NOTE: token should always be in the dict (if it isn't then something went very wrong)
-        docID_timers[token_formatted].reset()
-        return {"Token": f"valid"}
+async def replica_received_token(token_id: int, token_serial: int, IP: str = None, port: str = None, mode: str = "adaptive"):
+    if is_current(token_id, token_serial):
+        token_timers.schedule(token_id, TOKEN_TIMEOUT)
+        token_reported(token_id)
+        reply = {"Token": "valid"}
+        if IP is not None:
+            tokens[token_id].holder = f"{IP}:{port}"
+            # Route the token straight to the replica that needs it next
+            next_server = next_holder(token_id, f"{IP}:{port}", mode)
+            if next_server:
+                reply["Next"] = next_server
+        return reply
     else:
-        return {"Token": f"invalid"}
+        return {"Token": "invalid"}
+
+# Same as replicaRecvToken for a bundle of tokens [[docID, serial], ...] reported in one request
+@app.post("/replicaRecvTokens/")
+async def replica_received_tokens(bundle: list[tuple[int, int]], IP: str = None, port: str = None, mode: str = "adaptive"):
+    valid = []
+    next_servers = {}
+    for token_id, token_serial in bundle:
+        if not is_current(token_id, token_serial):
+            continue
+        token_timers.schedule(token_id, TOKEN_TIMEOUT)
+        token_reported(token_id)
+        valid.append(token_id)
+        if IP is not None:
+            tokens[token_id].holder = f"{IP}:{port}"
+            next_server = next_holder(token_id, f"{IP}:{port}", mode)
+            if next_server:
+                next_servers[token_id] = next_server
+    return {"valid": valid, "next": next_servers}
+
+def token_reported(token_id: int):
+    now = time.monotonic()
+    token = tokens[token_id]
+    if token.reported_at is not None:
+        token_hop.observe(now - token.reported_at)
+    token.reported_at = now
+
+# Same as tokenInUse for a bundle of tokens [[docID, serial], ...] now used on one replica
+@app.post("/tokensInUse/")
+async def tokens_in_use(bundle: list[tuple[int, int]], IP: str = None, port: str = None):
+    for token_id, token_serial in bundle:
+        await token_in_use(token_id, token_serial, IP, port)
+    return {"Message": f"ack for {len(bundle)} tokens"}
+
+# Replica has clients waiting for a token it does not have
+@app.post("/tokenDemand/{token_id}/")
+async def token_demand_received(token_id: int, IP: str, port: str):
+    if token_id not in tokens:
+        return {"Message": "Unknown document"}
+    requester = f"{IP}:{port}"
+    demand = tokens[token_id].demand
+    if requester not in demand:
+        demand.append(requester)
+    # Nudge the replica the token is parked at (if it is in use or moving it is routed when next reported)
+    holder = tokens[token_id].holder
+    if holder and holder != requester:
+        try:
+            await http_client.post(f"http://{holder}/forwardToken/{token_id}/")
+        except Exception:
+            logger.info(f"Failed to ask {holder} to forward token for docID {token_id}, it is regenerated on timeout")
+    return {"Message": "Demand recorded"}
+
+# Where a token goes after 'reporter', no replica means it stays (parked) at the reporter
+# NOTE: "adaptive" sends it to the replica waiting longest, "ring" to the next replica with clients on the document
+def next_holder(token_id: int, reporter: str, mode: str):
+    if mode == "ring":
+        return next_editor(token_id, reporter)
+    return next_in_demand(token_id, reporter)
+
+# Next replica in a document's token ring, which only has the replicas with clients on the document (in replica set order)
+# NOTE: a document nobody has open has an empty ring and its token is parked
+def next_editor(token_id: int, reporter: str):
+    editors = []
+    for server in replica_set(token_id) + [x.IP_PORT for x in server_docs]:
+        if token_id in editing.get(server, ()) and server not in editors:
+            editors.append(server)
+    if reporter in editors:
+        index = editors.index(reporter)
+        editors = editors[index + 1:] + editors[:index]
+    return editors[0] if editors else None
+
+# Pop the next live replica waiting for a token (other than the one reporting it)
+def next_in_demand(token_id: int, reporter: str):
+    demand = tokens[token_id].demand
+    if reporter in demand:
+        demand.remove(reporter)
+    servers = [x.IP_PORT for x in server_docs]
+    while demand:
+        next_server = demand.pop(0)
+        if next_server in servers:
+            return next_server
+    return None
 
 # Replicas reporting to master about crashes of other replicas
 @app.post("/replicaCrashed/{crashed_ip}/{crashed_port}/")
-def replica_crashed(crashed_ip: str, crashed_port: str):
-    crashed_ip_port = crashed_ip + ":" + crashed_port
-    # find the server with that IP and port
-    global server_docs
-    servers = [x.IP_PORT for x in server_docs]
-    if crashed_ip_port in servers:
-        index_dead_server = servers.index(crashed_ip_port)
-        server_docs.pop(index_dead_server)
-        servers.pop(index_dead_server) # pop server from local copy for leader election
-        # update leader (no effect if the popped replica was not the leader)
-        global leader_index
-        ports = [int(server.split(':')[1]) for server in servers]
-        leader_index = ports.index(min(ports))
-
-        logger.info("Popped dead server from list in master")
-    
+async def replica_crashed(crashed_ip: str, crashed_port: str):
+    # NOTE: the replica only reports a peer after failing to reach it, no need to wait for the failure detector
+    evict_replica(crashed_ip + ":" + crashed_port)
     return {"Message": "ack crash of succesor"}
 
 # Clients asking to be rerouted to a new replica upon being disconnected
@@ -316,29 +569,24 @@ async def transfer_conn(data_str: str = Body()):
     port = data['PORT']
     docID = int(data['docID'])
 
-    global server_docs
+    # NOTE: a viewer goes to another relay (a relay is only evicted by the failure detector as well)
+    if data.get('viewOnly'):
+        relays = [relay for relay in relay_placement.loads if relay != f"{ip}:{port}"]
+        relay = relay_placement.place(docID, relays)
+        if relay is not None:
+            relay_placement.client_added(relay, docID)
+            relay = relay.split(':')
+            return {"IP": relay[0], "port": relay[1], "viewOnly": True}
 
+    # NOTE: the client may only have lost its own network, the replica is evicted by the failure detector if it really is down
     crashed_ip_port = ip + ':' + port
+    servers = [server for server in replica_set(docID) if server != crashed_ip_port]
 
-    servers = [x.IP_PORT for x in server_docs]
-
-    if crashed_ip_port in servers:
-        index_dead_server = servers.index(crashed_ip_port)
-        server_docs.pop(index_dead_server)
-        servers.pop(index_dead_server) # pop server from local copy for leader election
-        # update leader (no effect if the popped replica was not the leader)
-        global leader_index
-        ports = [int(server.split(':')[1]) for server in servers]
-        leader_index = ports.index(min(ports))
-
-    if not server_docs:
+    server = placement.place(docID, servers) or placement.place(docID, replica_set(docID))
+    if server is None:
         return {"Error": "no servers online to connect too"}
-    
-    # Get server with lowest number of current clients
-    index = min(range(len(server_docs)), key=lambda i: server_docs[i].clients_online)
-    server_docs[index].clients_online += 1 # Add one more client to this replica
+    placement.client_added(server, docID) # Add one more client to this replica
 
-    server = server_docs[index].IP_PORT
     server = str(server).split(':')
     logger.info("Client rerouted to:")
     logger.info(server)
@@ -349,20 +597,161 @@ async def transfer_conn(data_str: str = Body()):
 
 
 ### helper functions for the api (not visiable to clients) ###
-def master_detect_replica_crashed(crashed_ip: str, crashed_port: str):
-    crashed_ip_port = crashed_ip + ":" + crashed_port
-    # find the server with that IP and port
-    global server_docs
+# Hand out the next docIDs for the given document names
+def allocate_docs(docNames: list[str]) -> list[dict]:
+    global next_doc_id
+    docs = [{"id": next_doc_id + i, "name": docName} for i, docName in enumerate(docNames)]
+    next_doc_id += len(docs)
+    # NOTE: docIDs handed out for documents that could not be created are not handed out again after a restart either
+    journal.append({"type": "docs", "docs": [], "next": next_doc_id})
+    return docs
+
+# Add documents [{"id": docID, "name": name}, ...] to the catalog, the ones it did not have are journaled
+def add_to_catalog(docs: list[dict]):
+    global next_doc_id
+    new = [doc for doc in docs if int(doc["id"]) not in catalog]
+    if not new:
+        return
+    catalog.add(new)
+    next_doc_id = max(next_doc_id, max(int(doc["id"]) for doc in new) + 1)
+    journal.append({"type": "docs", "docs": [(int(doc["id"]), doc["name"]) for doc in new], "next": next_doc_id})
+
+def journal_membership():
+    journal.append({"type": "membership", "epoch": membership_version, "servers": [x.IP_PORT for x in server_docs]})
+
+# Everything the journal keeps as it is now, written when the journal is compacted
+def journal_state() -> JournalState:
+    state = JournalState()
+    state.epoch = membership_version
+    state.servers = [x.IP_PORT for x in server_docs]
+    state.docs = dict(catalog.names)
+    state.next_doc_id = next_doc_id
+    state.tokens = {docID: token.serial for docID, token in tokens.items()}
+    return state
+
+# Carry on from the journal of the previous run: the same replicas, documents and tokens (no replica has to register again
+# and no token is started over). Tokens the master does not hear of within TOKEN_TIMEOUT are regenerated as usual
+# NOTE: what the replicas still report (load, documents with clients) and tell a master they have not seen before
+# (tokens in use and wanted, see send_load_report on the replica) is not journaled
+def restore():
+    global membership_version
+    global next_doc_id
+    state = journal.replay()
+    catalog.add([{"id": docID, "name": name} for docID, name in state.docs.items()])
+    next_doc_id = state.next_doc_id
+    for docID, serial in state.tokens.items():
+        tokens[docID] = TokenState(serial)
+        token_timers.schedule(docID, TOKEN_TIMEOUT)
+    for server in state.servers:
+        server_docs.append(ServerInfo(server))
+        ring.add(server)
+        placement.add(server)
+        detector.add(server)
+    membership_version = state.epoch
+    if state.servers:
+        logger.info(f"Restored {len(state.servers)} replicas, {len(state.docs)} documents and {len(state.tokens)} tokens from the journal")
+        # NOTE: the replicas may be at a later epoch than the journal (its last records were lost), a new epoch with the whole
+        # view brings every replica back to it, and a replica that is gone fails the push and is evicted
+        membership_version += 1
+        run_in_background(push_membership({"epoch": membership_version, "joined": [], "left": []}, state.servers))
+    journal.open()
+
+# Replicas storing a document
+def replica_set(docID: int) -> list[str]:
+    return ring.replicas(docID, REPLICATION_FACTOR)
+
+# Create documents on their replicas at once, returns the replicas that have each document (docID -> replicas)
+# as soon as a majority of every document's replicas has it, empty if that did not happen
+# NOTE: replicas that have not answered by then are left to finish (or be retried) in the background,
+# the server list lock is only held to pick the replicas so cluster changes are not blocked by the requests
+async def create_on_replicas(docs: list[dict]) -> dict[int, list[str]]:
+    by_server: dict[str, list[dict]] = {}
+    quorum: dict[int, int] = {}
+    async with server_list_lock:
+        for doc in docs:
+            servers = replica_set(doc["id"])
+            quorum[doc["id"]] = len(servers) // 2 + 1
+            for server in servers:
+                by_server.setdefault(server, []).append(doc)
+    created_at: dict[int, list[str]] = {doc["id"]: [] for doc in docs}
+    waiting = set(created_at)
+    pending = [run_in_background(create_on_replica(server, docs_at)) for server, docs_at in by_server.items()]
+    for request in asyncio.as_completed(pending):
+        server = await request
+        if not server:
+            continue
+        for doc in by_server[server]:
+            created_at[doc["id"]].append(server)
+            if len(created_at[doc["id"]]) >= quorum[doc["id"]]:
+                waiting.discard(doc["id"])
+        if not waiting:
+            return created_at
+    return {}
+
+# Create documents on one replica, retrying before the replica is removed from the master list
+async def create_on_replica(server: str, docs: list[dict]) -> Optional[str]:
+    for attempt in range(CREATE_RETRIES):
+        try:
+            response = await http_client.post(f"http://{server}/newDocs/", json=docs)
+            if response.status_code == 200:
+                return server
+            logger.info(f"Server {server} failed to create {len(docs)} documents: {response.status_code}")
+        except Exception:
+            logger.info(f"Failed to reach server {server} to create {len(docs)} documents (attempt {attempt + 1})")
+        if attempt + 1 < CREATE_RETRIES:
+            await asyncio.sleep(0.5 * 2 ** attempt)
+    logger.info(f"Failed to create documents at server {server}, removing it from master list")
+    evict_replica(server)
+    return None
+
+def run_in_background(coroutine) -> asyncio.Task:
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Remove a dead replica from the cluster, every way of finding out a replica crashed ends up here
+def evict_replica(crashed_ip_port: str):
+    global membership_version
     servers = [x.IP_PORT for x in server_docs]
-    if crashed_ip_port in servers:
-        index_dead_server = servers.index(crashed_ip_port)
-        server_docs.pop(index_dead_server)
-        servers.pop(index_dead_server) # pop server from local copy for leader election
-        # update leader (no effect if the popped replica was not the leader)
-        # NOTE: add print statment to show the leader changing
-        global leader_index
-        ports = [int(server.split(':')[1]) for server in servers]
-        leader_index = ports.index(min(ports))
-        logger.info(f"Leader index is {leader_index} and its ip:port are {servers[leader_index]}")
-
-        logger.info("Popped dead server from list in master")
\ No newline at end of file
+    if crashed_ip_port not in servers:
+        return
+    server_docs.pop(servers.index(crashed_ip_port))
+    ring.remove(crashed_ip_port)
+    placement.remove(crashed_ip_port)
+    detector.remove(crashed_ip_port)
+    editing.pop(crashed_ip_port, None)
+    membership_version += 1
+    journal_membership()
+    logger.info(f"Evicted dead server {crashed_ip_port} from list in master (membership version {membership_version})")
+
+    # NOTE: tokens parked at the dead replica are regenerated right away instead of waiting for their timeout
+    for docID, token in tokens.items():
+        if token.holder == crashed_ip_port:
+            token.holder = None
+            token_timers.schedule(docID, 0)
+    # let the remaining replicas know so edits and tokens stop going to the dead one
+    run_in_background(push_membership({"epoch": membership_version, "joined": [], "left": [crashed_ip_port]}))
+
+# Ping every replica every HEARTBEAT_INTERVAL seconds and evict the ones the failure detector suspects
+async def monitor_replicas():
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        for server in [x.IP_PORT for x in server_docs]:
+            run_in_background(ping(server))
+        for server in detector.suspects():
+            logger.info(f"Server {server} missed its heartbeats (phi {detector.phi(server):.1f})")
+            evict_replica(server)
+        for relay in list(relay_placement.loads):
+            run_in_background(ping(relay, relay_detector))
+        for relay in relay_detector.suspects():
+            logger.info(f"Relay {relay} missed its heartbeats (phi {relay_detector.phi(relay):.1f})")
+            evict_relay(relay)
+
+async def ping(server: str, detector: FailureDetector = detector):
+    try:
+        response = await http_client.get(f"http://{server}/ping/", timeout=HEARTBEAT_INTERVAL * 5)
+        if response.status_code == 200:
+            detector.heartbeat(server)
+    except Exception:
+        pass # NOTE: a missed heartbeat raises the suspicion level
\ No newline at end of file
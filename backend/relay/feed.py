@@ -0,0 +1,121 @@
+from __future__ import annotations
+from typing import Awaitable, Callable, Optional
+import asyncio
+import json
+import logging
+import os
+import websockets
+import metrics
+
+logger = logging.getLogger("uvicorn")
+
+# NOTE: A relay subscribes to every document its viewers watch with ONE websocket to a replica storing it (the replica's
+# client endpoint with ?relay=true, so the replica sends it every edit like to a client but never sends it the token),
+# and keeps a copy of the document built from those edits: a new viewer gets the whole document from the relay without
+# the replica hearing of it. When the replica goes away the subscription moves to another one and catches up from the
+# version the copy is at. It is closed FEED_LINGER seconds after the last viewer of the document left
+FEED_LINGER = float(os.getenv("FEED_LINGER", "5"))
+# Seconds between attempts at subscribing when no replica could be reached
+RESUBSCRIBE_DELAY = 1.0
+
+upstream_frames = metrics.Counter("sharenotes_relay_upstream_frames_total", "Edit frames received from replicas")
+resubscriptions = metrics.Counter("sharenotes_relay_resubscriptions_total", "Subscriptions moved to (or retried on) a replica after losing one")
+
+
+class OutOfSync(Exception):
+    pass
+
+
+# Same operations as the replica's (see replica/documents.py): {"pos", "delete", "insert"}
+def apply_op(content: str, op: dict) -> str:
+    try:
+        pos, delete, insert = int(op.get("pos", 0)), int(op.get("delete", 0)), str(op.get("insert", ""))
+    except (TypeError, ValueError, AttributeError):
+        raise OutOfSync(f"Malformed operation: {op}")
+    if pos < 0 or delete < 0 or pos + delete > len(content):
+        raise OutOfSync(f"Operation {op} out of range for a document of length {len(content)}")
+    return content[:pos] + insert + content[pos + delete:]
+
+
+class DocumentFeed:
+    def __init__(self, docID: int, name: str, locate: Callable[[int, Optional[str]], Awaitable[Optional[str]]],
+                 broadcast: Callable[[int, str, bool], None]) -> None:
+        self.docID = docID
+        self.name = name
+        self.locate = locate # replica to subscribe at (given the one that was lost, if any)
+        self.broadcast = broadcast # (docID, message, full document) to every viewer of the document
+        self.content = ""
+        self.version: Optional[int] = None # None until the whole document arrived
+        self.ready = asyncio.Event()
+        self.upstream = None
+        self.task: Optional[asyncio.Task] = None
+        self.linger: Optional[asyncio.TimerHandle] = None
+
+    def snapshot(self) -> dict:
+        return {"content": self.content, "version": self.version}
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+
+    async def run(self) -> None:
+        replica = None
+        while True:
+            replica = await self.locate(self.docID, replica)
+            if replica is None:
+                await asyncio.sleep(RESUBSCRIBE_DELAY)
+                continue
+            # NOTE: after the first subscription only the edits missed since the copy's version are sent
+            since = "" if self.version is None else f"&since={self.version}"
+            try:
+                async with websockets.connect(f"ws://{replica}/ws/{self.docID}/{self.name}/false/?relay=true{since}", max_size=None) as upstream:
+                    self.upstream = upstream
+                    logger.info(f"Subscribed to document {self.docID} at {replica}")
+                    async for message in upstream:
+                        self.receive(message)
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                logger.info(f"Lost subscription to document {self.docID} at {replica}: {e}")
+                await asyncio.sleep(RESUBSCRIBE_DELAY)
+            finally:
+                self.upstream = None
+            resubscriptions.inc()
+
+    # A frame from the replica: the whole document, an operation or the edits missed while resubscribing
+    def receive(self, message: str) -> None:
+        frame = json.loads(message)
+        # NOTE: queue positions and resync answers are meant for editors, relays never edit
+        if "version" not in frame or frame.get("resync"):
+            return
+        upstream_frames.inc()
+        try:
+            if "edits" in frame:
+                # NOTE: resubscribing without having missed anything
+                if not frame["edits"]:
+                    return
+                for edit in frame["edits"]:
+                    self.update(edit)
+            else:
+                self.update(frame)
+        except OutOfSync as e:
+            # NOTE: the replica answers with the whole document, which every viewer gets as well
+            logger.info(f"Copy of document {self.docID} out of sync, asking for the whole document: {e}")
+            asyncio.create_task(self.upstream.send(json.dumps({"resync": True})))
+            return
+        self.broadcast(self.docID, message, "content" in frame)
+
+    def update(self, frame: dict) -> None:
+        if "op" not in frame:
+            self.content = frame["content"]
+            self.version = frame["version"]
+            self.ready.set()
+            return
+        if self.version is None or frame["version"] > self.version + 1:
+            raise OutOfSync(f"expected version {None if self.version is None else self.version + 1}, got {frame['version']}")
+        # NOTE: edits sent again after resubscribing are already in the copy
+        if frame["version"] <= self.version:
+            return
+        self.content = apply_op(self.content, frame["op"])
+        self.version = frame["version"]
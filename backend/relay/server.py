@@ -0,0 +1,185 @@
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, Response, WebSocket, WebSocketDisconnect
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+# NOTE: viewers get outboxes, HTTP calls and metrics the same way as clients of a replica, from the replica's modules
+sys.path.append(str(Path(__file__).resolve().parent.parent / "replica"))
+from feed import FEED_LINGER, DocumentFeed
+from outbox import ClientOutbox
+import http_client
+import metrics
+
+logger = logging.getLogger("uvicorn")
+
+# NOTE: A relay serves clients that only watch documents (placed here by the master with /connectToExistingDoc/?viewOnly=true)
+# from a subscription to a replica per document (see feed.py). It stores nothing and never holds tokens, it is not in the
+# ring either: adding relays adds viewers without making tokens go around more replicas or edits go to more databases
+
+# Enviroment variables
+MY_PORT = os.getenv("PORT")
+MY_IP = os.getenv("IP")
+MASTER_IP = os.getenv("MASTER_IP")
+
+# Seconds between load reports to the master (used to place viewers, they also keep the relay registered)
+LOAD_REPORT_INTERVAL = float(os.getenv("LOAD_REPORT_INTERVAL", "2"))
+# Seconds a viewer waits for the first copy of its document before it is told to try again
+FEED_TIMEOUT = 10.0
+
+# Subscriptions to the documents watched here, and the outboxes of their viewers (docID -> websocket -> outbox)
+feeds: dict[int, DocumentFeed] = {}
+viewers: dict[int, dict[WebSocket, ClientOutbox]] = {}
+
+loop_lag = metrics.Histogram("sharenotes_event_loop_lag_seconds", "How late the event loop woke up a sleep (probed every 0.25s)")
+broadcast_seconds = metrics.Histogram("sharenotes_broadcast_seconds", "Time to queue an edit for every viewer of its document")
+metrics.Gauge("sharenotes_viewers", "Connected viewer websockets", lambda: sum(len(outboxes) for outboxes in viewers.values()))
+metrics.Gauge("sharenotes_relay_feeds", "Documents subscribed to", lambda: len(feeds))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        await register()
+    except Exception as e:
+        logger.info(f"Failed to register with master, the next load report tries again: {e}")
+    reporter = asyncio.create_task(report_load())
+    yield
+    reporter.cancel()
+    for feed in feeds.values():
+        feed.stop()
+    await http_client.close()
+
+app = FastAPI(lifespan=lifespan)
+
+async def register():
+    reply = await http_client.post(f"http://{MASTER_IP}:8000/addRelay/", params={"IP": MY_IP, "port": MY_PORT})
+    logger.info(reply)
+
+# Report the viewers of every document to the master every LOAD_REPORT_INTERVAL seconds, with the event loop lag
+async def report_load():
+    loop = asyncio.get_running_loop()
+    max_lag = 0.0
+    last_report = loop.time()
+    while True:
+        expected = loop.time() + 0.25
+        await asyncio.sleep(0.25)
+        lag = max(0.0, loop.time() - expected)
+        loop_lag.observe(lag)
+        max_lag = max(max_lag, lag)
+        if loop.time() - last_report < LOAD_REPORT_INTERVAL:
+            continue
+        last_report = loop.time()
+        docs = {docID: len(outboxes) for docID, outboxes in viewers.items() if outboxes}
+        report = {"sockets": sum(docs.values()), "loopLag": round(max_lag, 4), "docs": docs}
+        max_lag = 0.0
+        try:
+            reply = await http_client.post(f"http://{MASTER_IP}:8000/reportRelayLoad/", params={"IP": MY_IP, "port": MY_PORT}, json=report)
+            # NOTE: the master evicted this relay (e.g. it missed its heartbeats), register again
+            if not reply.json().get("Registered", True):
+                logger.info("Master no longer knows this relay, registering again")
+                await register()
+        except Exception as e:
+            logger.info(f"Failed to report load to master: {e}")
+
+
+### Subscriptions ###
+# Replica to subscribe to a document at, placed by the master like a client (another one if 'lost' went away)
+async def locate(docID: int, lost: Optional[str]) -> Optional[str]:
+    try:
+        if lost is None:
+            reply = await http_client.post(f"http://{MASTER_IP}:8000/connectToExistingDoc/", params={"docID": docID})
+        else:
+            ip, port = lost.split(':')
+            # NOTE: sent the way the browser sends it (a JSON string as plain text)
+            reply = await http_client.post(f"http://{MASTER_IP}:8000/lostConnection/", content=json.dumps({"IP": ip, "PORT": port, "docID": docID}), headers={"Content-Type": "text/plain"})
+        server = reply.json()
+    except Exception as e:
+        logger.info(f"Failed to get a replica for document {docID} from master: {e}")
+        return None
+    if "IP" not in server:
+        return None
+    return f"{server['IP']}:{server['port']}"
+
+def broadcast(docID: int, message: str, full: bool):
+    outboxes = viewers.get(docID)
+    if outboxes:
+        start = time.perf_counter()
+        for outbox in outboxes.values():
+            outbox.send(message, droppable=True, supersedes=full)
+        broadcast_seconds.observe(time.perf_counter() - start)
+
+def get_feed(docID: int, docName: str) -> DocumentFeed:
+    feed = feeds.get(docID)
+    if feed is None:
+        feed = feeds[docID] = DocumentFeed(docID, docName, locate, broadcast)
+        feed.start()
+    # NOTE: a viewer came back before the subscription was closed
+    if feed.linger is not None:
+        feed.linger.cancel()
+        feed.linger = None
+    return feed
+
+def close_feed(docID: int):
+    if not viewers.get(docID):
+        viewers.pop(docID, None)
+        feed = feeds.pop(docID, None)
+        if feed:
+            logger.info(f"No more viewers of document {docID}, unsubscribing")
+            feed.stop()
+
+
+### Viewers ###
+# Same path as a replica's client websocket, viewers never get to edit here
+# NOTE: a viewer reconnecting with ?since= gets the whole document, that is always a valid answer
+@app.websocket("/ws/{document_id}/{docName}/{editPerm}/")
+async def websocket_endpoint(websocket: WebSocket, document_id: int, docName: str, editPerm: str, since: Optional[int] = None):
+    await websocket.accept()
+    feed = get_feed(document_id, docName)
+    try:
+        await asyncio.wait_for(feed.ready.wait(), FEED_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.info(f"Document {document_id} could not be subscribed to, sending the viewer away")
+        # NOTE: 1013 is "try again later", the viewer reconnects through the master
+        await websocket.close(code=1013)
+        if not viewers.get(document_id):
+            close_feed(document_id)
+        return
+
+    outbox = ClientOutbox(websocket, feed.snapshot)
+    outbox.start()
+    # NOTE: the whole document is queued first, every edit broadcast from now on follows it
+    outbox.send(json.dumps(feed.snapshot()))
+    viewers.setdefault(document_id, {})[websocket] = outbox
+
+    try:
+        while True:
+            data = json.loads(await websocket.receive_text())
+            # Viewer missed an operation, send it the whole document
+            if data.get("resync"):
+                outbox.send(json.dumps(feed.snapshot()))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        viewers[document_id].pop(websocket, None)
+        outbox.stop()
+        if not viewers[document_id] and document_id in feeds:
+            feeds[document_id].linger = asyncio.get_running_loop().call_later(FEED_LINGER, close_feed, document_id)
+        try:
+            await http_client.post(f"http://{MASTER_IP}:8000/lostClient/{MY_IP}/{MY_PORT}/", params={"docID": document_id})
+        except Exception as e:
+            logger.info(f"Failed to inform master of the lost viewer: {e}")
+
+# Heartbeat from the master's failure detector
+@app.get("/ping/")
+async def ping():
+    return {"Message": "pong"}
+
+# Metrics of this relay in the Prometheus text format
+@app.get("/metrics/")
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
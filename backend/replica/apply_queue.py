@@ -0,0 +1,43 @@
+from __future__ import annotations
+from collections import deque
+from typing import Awaitable, Callable
+import asyncio
+import logging
+
+logger = logging.getLogger("uvicorn")
+
+
+# NOTE: Replicated edits are applied through one queue per document: edits of a document are applied strictly in the
+# order they were received, while a document that has to be loaded first (from the database or another replica) does not
+# hold up the edits of other documents. A worker task only exists while its document has edits waiting
+class ApplyQueues:
+    def __init__(self, apply: Callable[[dict], Awaitable[bool]]) -> None:
+        self.apply = apply
+        self.queues: dict[int, deque[tuple[dict, Callable[[bool], None]]]] = {}
+        self.workers: dict[int, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    # Queue an edit, 'done' is called with the result of applying it (False means the document needs its full content)
+    def submit(self, edit: dict, done: Callable[[bool], None]) -> None:
+        docID = int(edit["doc"])
+        self.queues.setdefault(docID, deque()).append((edit, done))
+        if docID not in self.workers:
+            self.workers[docID] = asyncio.create_task(self.drain(docID))
+
+    async def drain(self, docID: int) -> None:
+        queue = self.queues[docID]
+        try:
+            while queue:
+                edit, done = queue.popleft()
+                try:
+                    applied = await self.apply(edit)
+                except Exception as e:
+                    logger.info(f"Failed to apply replicated edit to document {docID}: {e}")
+                    applied = False
+                done(applied)
+        finally:
+            del self.workers[docID]
+            if not queue:
+                del self.queues[docID]
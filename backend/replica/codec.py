@@ -0,0 +1,39 @@
+from __future__ import annotations
+from typing import Union
+import json
+import logging
+import os
+
+logger = logging.getLogger("uvicorn")
+
+# NOTE: Replication links send JSON text frames by default, REPLICATION_CODEC=msgpack sends binary msgpack frames instead
+# (smaller and cheaper to encode, mostly for batches carrying whole documents). The receiving replica decodes a frame by
+# its type and answers in the same format, so replicas with different settings can be mixed (msgpack is in requirements.txt,
+# a replica installed without it sends and accepts JSON only)
+REPLICATION_CODEC = os.getenv("REPLICATION_CODEC", "json")
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+if REPLICATION_CODEC == "msgpack" and msgpack is None:
+    logger.info("REPLICATION_CODEC is msgpack but msgpack is not installed (pip install msgpack), using json")
+    REPLICATION_CODEC = "json"
+
+# Whether this replica sends binary frames on its replication links
+BINARY = REPLICATION_CODEC == "msgpack"
+
+
+def encode(message: dict, binary: bool = BINARY) -> Union[str, bytes]:
+    if binary:
+        return msgpack.packb(message)
+    return json.dumps(message)
+
+
+def decode(data: Union[str, bytes]) -> dict:
+    if isinstance(data, bytes):
+        if msgpack is None:
+            raise ValueError("Received a binary replication frame but msgpack is not installed")
+        return msgpack.unpackb(data)
+    return json.loads(data)
@@ -3,7 +3,8 @@ from contextlib import asynccontextmanager
 from typing import Any, AsyncGenerator, Optional
 import logging
 from sqlmodel import Field, SQLModel
-from sqlalchemy import event
+from sqlalchemy import bindparam, event, func, text, update
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.asyncio import (
     create_async_engine,
     async_sessionmaker,
@@ -11,7 +12,6 @@ from sqlalchemy.ext.asyncio import (
 )
 from sqlalchemy.future import select
 from sqlite3 import Connection
-from exceptions import HTTPException
 #from settings import settings
 from pathlib import Path
 import os
@@ -28,23 +28,31 @@ class Document(DocumentBase, table=True):
     id: int = Field(primary_key=True)
 
 
-class DocumentUpdate(DocumentBase):
-    id: int
-    content: Optional[str]
+# Bounded log of the latest edits of every document, one row per version
+# NOTE: frame is the JSON edit frame, {"op": {...}, "version": v} or {"content": "...", "version": v}
+class EditLog(SQLModel, table=True):
+    doc_id: int = Field(primary_key=True)
+    version: int = Field(primary_key=True)
+    frame: str
 
 
 MY_PORT = os.getenv('PORT')
 
-REPLICA_DIR = Path(__file__).parent.resolve() / "dbs"
+# NOTE: DB_DIR lets several local clusters (e.g. benchmarks) keep their databases apart
+REPLICA_DIR = Path(os.getenv("DB_DIR", Path(__file__).parent.resolve() / "dbs"))
 
 if not REPLICA_DIR.is_dir():
-    REPLICA_DIR.mkdir()
+    REPLICA_DIR.mkdir(parents=True)
 
-sqlite_path = REPLICA_DIR / f"sharenotes_{MY_PORT}.db"
+# NOTE: every worker of a multi-process replica (see worker.py) has its own database with its share of the documents
+WORKER = os.getenv("WORKER")
+sqlite_path = REPLICA_DIR / (f"sharenotes_{MY_PORT}_{WORKER}.db" if WORKER else f"sharenotes_{MY_PORT}.db")
 sqlite_url = f"sqlite+aiosqlite:///{sqlite_path}"
 
 connect_args = {"check_same_thread": False}
-engine = create_async_engine(sqlite_url, echo=True, connect_args=connect_args)
+# NOTE: set DB_ECHO=true to log every SQL statement
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() == "true"
+engine = create_async_engine(sqlite_url, echo=DB_ECHO, connect_args=connect_args)
 SessionMaker = async_sessionmaker(autocommit=False, bind=engine)
 
 logger = logging.getLogger("uvicorn")
@@ -87,6 +95,15 @@ async def create_repl_document(s: AsyncSession, docName: str, docId: int):
     await s.commit()
     await s.refresh(doc)
 
+# Create documents [(docID, docName), ...] in one transaction, IDs that already exist are skipped (so retries are harmless)
+async def create_repl_documents(s: AsyncSession, docs: list[tuple[int, str]]) -> int:
+    ids = [docId for docId, _ in docs]
+    existing = set((await s.execute(select(Document.id).where(Document.id.in_(ids)))).scalars())
+    new_docs = [Document(id=docId, name=docName, content="") for docId, docName in docs if docId not in existing]
+    s.add_all(new_docs)
+    await s.commit()
+    return len(new_docs)
+
 
 async def create_document_with_content(s: AsyncSession, docName: str, docContent: str):
     doc = Document(name=docName, content=docContent)
@@ -102,20 +119,64 @@ async def doc_list_db():
     return doc_list
 
 
-async def update_document(s: AsyncSession, du: DocumentUpdate):
-    doc = await read_document(s, du.id)
-    logger.info("Document before update")
-    logger.info(doc)
-    if not doc:
-        raise HTTPException(404, f"document ID: {du.id} not found")
-    if du.content:
-        doc.content = du.content
+# Up to 'limit' documents (id, name) with an ID above 'after', in ID order, only names starting with 'prefix' (ignoring case)
+# NOTE: the prefix is a range on the name index (NOCASE, like the index) instead of a LIKE so the index is used
+async def list_documents(s: AsyncSession, limit: Optional[int] = None, after: Optional[int] = None, prefix: Optional[str] = None):
+    query = select(Document.id, Document.name).order_by(Document.id)
+    if after is not None:
+        query = query.where(Document.id > after)
+    if prefix:
+        name = Document.name.collate("NOCASE")
+        query = query.where(name >= prefix, name < prefix + "\U0010ffff")
+    if limit is not None:
+        query = query.limit(limit)
+    return await s.execute(query)
+
+
+# Whole documents (id, name, content) with the given IDs
+async def read_documents(s: AsyncSession, ids: list[int]) -> list[Document]:
+    rows = await s.execute(select(Document).where(Document.id.in_(ids)))
+    return list(rows.scalars())
+
+
+# Write the content of many documents (docID -> content) and their new edit log entries in one transaction
+# NOTE: 'truncate' (docID -> version) drops log entries from that version on (the document was reset to an older version),
+# 'compact' (docID -> version) drops log entries older than that version
+async def update_documents(s: AsyncSession, contents: dict[int, str], entries: Optional[list[EditLog]] = None, truncate: Optional[dict[int, int]] = None, compact: Optional[dict[int, int]] = None):
+    # NOTE: bulk UPDATE by primary key, sent as one executemany
+    await s.execute(update(Document), [{"id": docId, "content": content} for docId, content in contents.items()])
+    conn = await s.connection()
+    log = EditLog.__table__
+    if truncate:
+        await conn.execute(log.delete().where(log.c.doc_id == bindparam("d"), log.c.version >= bindparam("v")), [{"d": d, "v": v} for d, v in truncate.items()])
+    if entries:
+        stmt = insert(log)
+        stmt = stmt.on_conflict_do_update(index_elements=[log.c.doc_id, log.c.version], set_={"frame": stmt.excluded.frame})
+        await conn.execute(stmt, [{"doc_id": e.doc_id, "version": e.version, "frame": e.frame} for e in entries])
+    if compact:
+        await conn.execute(log.delete().where(log.c.doc_id == bindparam("d"), log.c.version < bindparam("v")), [{"d": d, "v": v} for d, v in compact.items()])
     await s.commit()
-    await s.refresh(doc)
-    doc = await read_document(s, du.id)
-    logger.info("Document after update")
-    logger.info(doc)
-    return doc
+
+
+# Latest 'limit' edit log entries of a document, oldest first
+async def read_edit_log(s: AsyncSession, docId: int, limit: int) -> list[EditLog]:
+    rows = await s.execute(select(EditLog).where(EditLog.doc_id == docId).order_by(EditLog.version.desc()).limit(limit))
+    return list(reversed(rows.scalars().all()))
+
+
+# Version of every document in the database (or only the given ones) (docID -> version), documents without a log are at version 0
+async def doc_versions(s: AsyncSession, ids: Optional[list[int]] = None) -> dict[int, int]:
+    docs = select(Document.id)
+    log = select(EditLog.doc_id, func.max(EditLog.version)).group_by(EditLog.doc_id)
+    if ids is not None:
+        docs = docs.where(Document.id.in_(ids))
+        log = log.where(EditLog.doc_id.in_(ids))
+    versions = {docId: 0 for docId in (await s.execute(docs)).scalars()}
+    rows = await s.execute(log)
+    for docId, version in rows:
+        if docId in versions:
+            versions[docId] = version
+    return versions
 
 
 @event.listens_for(engine.sync_engine, "connect")
@@ -128,4 +189,6 @@ def set_sqlite_pragma(dbapi_connection: Connection, _connection_record):
 
 async def create_all():
     async with connect() as conn:
-        await conn.run_sync(SQLModel.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(SQLModel.metadata.create_all)
+        # NOTE: also added to databases created before the index existed
+        await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_document_name ON document (name COLLATE NOCASE)"))
\ No newline at end of file
@@ -0,0 +1,213 @@
+from __future__ import annotations
+from collections import deque
+from typing import Callable, Optional
+import asyncio
+import json
+import logging
+import os
+import time
+from db import AsyncSession, EditLog, SessionMaker, read_document, read_edit_log, update_documents
+import metrics
+
+logger = logging.getLogger("uvicorn")
+
+# NOTE: edits are applied to the in memory copy and written to the database behind it (write-behind),
+# dirty documents are flushed every FLUSH_INTERVAL seconds, as soon as FLUSH_MAX_PENDING edits are waiting,
+# when an editor gives the token back and on shutdown, so a burst of typing becomes one write
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "1"))
+FLUSH_MAX_PENDING = int(os.getenv("FLUSH_MAX_PENDING", "500"))
+# NOTE: the latest EDIT_LOG_SIZE edits of every document are kept (in memory and in the database) so a client or replica
+# that is a few versions behind gets only the edits it missed, anything further behind gets the whole document
+EDIT_LOG_SIZE = int(os.getenv("EDIT_LOG_SIZE", "1000"))
+# NOTE: a document nobody used for EVICT_AFTER seconds is dropped from memory when it is clean (written to the database) and
+# idle here (no clients, no replicated edits waiting), it is loaded again the next time it is needed
+EVICT_AFTER = float(os.getenv("EVICT_AFTER", "300"))
+
+# NOTE: Edits travel as operations instead of the whole document, an operation looks like:
+#   {"pos": <index>, "delete": <number of characters removed at pos>, "insert": <text inserted at pos>}
+# and is wrapped in a versioned frame, e.g. {"op": {...}, "version": 12}
+# A full content frame, e.g. {"content": "...", "version": 12}, is still accepted everywhere as the fallback
+
+
+flush_seconds = metrics.Histogram("sharenotes_db_flush_seconds", "Time to write a batch of dirty documents to SQLite")
+flush_documents = metrics.Counter("sharenotes_db_flushed_documents_total", "Documents written to SQLite")
+flush_failures = metrics.Counter("sharenotes_db_flush_failures_total", "Writes to SQLite that failed (retried by the next flush)")
+
+
+class InvalidOperation(Exception):
+    pass
+
+
+def validate_op(op: dict) -> dict:
+    try:
+        pos = int(op.get("pos", 0))
+        delete = int(op.get("delete", 0))
+        insert = str(op.get("insert", ""))
+    except (TypeError, ValueError, AttributeError):
+        raise InvalidOperation(f"Malformed operation: {op}")
+    if pos < 0 or delete < 0:
+        raise InvalidOperation(f"Negative position or delete count in operation: {op}")
+    return {"pos": pos, "delete": delete, "insert": insert}
+
+
+class LiveDocument:
+    def __init__(self, id: int, name: str, content: str, version: int = 0, log: Optional[list[dict]] = None) -> None:
+        self.id = id
+        self.name = name
+        self.content = content
+        self.version = version
+        # Latest edit frames (oldest first), the ones not yet in the database and the version the database log has to be cut at
+        self.log: deque[dict] = deque(log or [], maxlen=EDIT_LOG_SIZE)
+        self.unflushed: list[dict] = []
+        self.truncate_from: Optional[int] = None
+        self.last_used = time.monotonic()
+
+    # Apply an operation and move to the next version
+    def apply(self, op: dict) -> None:
+        op = validate_op(op)
+        end = op["pos"] + op["delete"]
+        if end > len(self.content):
+            raise InvalidOperation(f"Operation {op} out of range for document {self.id} of length {len(self.content)}")
+        self.content = self.content[: op["pos"]] + op["insert"] + self.content[end:]
+        self.version += 1
+        self.record({"op": op, "version": self.version})
+
+    # Overwrite the whole document (fallback path), version defaults to the next one
+    def replace(self, content: str, version: Optional[int] = None) -> None:
+        self.content = content
+        new_version = self.version + 1 if version is None else version
+        if new_version <= self.version:
+            # NOTE: the document went back to an older version, the edits logged from there on no longer apply
+            while self.log and self.log[-1]["version"] >= new_version:
+                self.log.pop()
+            self.unflushed = [frame for frame in self.unflushed if frame["version"] < new_version]
+            self.truncate_from = new_version if self.truncate_from is None else min(self.truncate_from, new_version)
+        self.version = new_version
+        self.record(self.snapshot())
+
+    def record(self, frame: dict) -> None:
+        self.last_used = time.monotonic()
+        self.log.append(frame)
+        self.unflushed.append(frame)
+
+    def snapshot(self) -> dict:
+        return {"content": self.content, "version": self.version}
+
+    # Edit frames that bring a copy at 'version' up to date, None if they are no longer logged (send the snapshot instead)
+    def since(self, version: int) -> Optional[list[dict]]:
+        if version == self.version:
+            return []
+        if version > self.version:
+            return None
+        frames = [frame for frame in self.log if frame["version"] > version]
+        # NOTE: a full content frame does not depend on what came before it
+        for i in range(len(frames) - 1, -1, -1):
+            if "content" in frames[i]:
+                return frames[i:]
+        if frames and frames[0]["version"] == version + 1:
+            return frames
+        return None
+
+
+class DocumentStore:
+    def __init__(self, in_use: Callable[[int], bool] = lambda docID: False):
+        self.in_use = in_use # whether a document is still needed in memory (see evict)
+        self.docs: dict[int, LiveDocument] = {}
+        self.dirty: set[int] = set()
+        self.pending_edits = 0
+        self.flush_needed = asyncio.Event()
+        self.flush_lock = asyncio.Lock() # NOTE: flushes are serialized so an older copy never overwrites a newer one
+        self.task: Optional[asyncio.Task] = None
+
+    # Get the in memory copy of a document, loading it from the database the first time
+    async def get(self, s: AsyncSession, docID: int) -> Optional[LiveDocument]:
+        if docID not in self.docs:
+            doc = await read_document(s, docID)
+            if not doc:
+                return None
+            log = [json.loads(entry.frame) for entry in await read_edit_log(s, docID, EDIT_LOG_SIZE)]
+            version = log[-1]["version"] if log else 0
+            # NOTE: setdefault as another coroutine may have loaded it while this one was reading the database
+            self.docs.setdefault(docID, LiveDocument(doc.id, doc.name, doc.content, version, log))
+            logger.info(f"Loaded document {docID} into memory")
+        self.docs[docID].last_used = time.monotonic()
+        return self.docs[docID]
+
+    # Record that a document changed in memory, it is written to the database by the next flush
+    def mark_dirty(self, docID: int) -> None:
+        self.dirty.add(docID)
+        self.pending_edits += 1
+        if self.pending_edits >= FLUSH_MAX_PENDING:
+            self.flush_needed.set()
+
+    # Write dirty documents (all of them, or only the given one) to the database in one transaction
+    # NOTE: returns False if the write failed (the documents stay dirty)
+    async def flush(self, docID: Optional[int] = None) -> bool:
+        async with self.flush_lock:
+            if docID is None:
+                batch, self.dirty = self.dirty, set()
+                self.pending_edits = 0
+            elif docID in self.dirty:
+                self.dirty.discard(docID)
+                batch = {docID}
+            else:
+                return True
+            if not batch:
+                return True
+            docs = [self.docs[id] for id in batch]
+            contents = {doc.id: doc.content for doc in docs}
+            entries = [EditLog(doc_id=doc.id, version=frame["version"], frame=json.dumps(frame)) for doc in docs for frame in doc.unflushed]
+            truncate = {doc.id: doc.truncate_from for doc in docs if doc.truncate_from is not None}
+            compact = {doc.id: doc.version - EDIT_LOG_SIZE + 1 for doc in docs if doc.version >= EDIT_LOG_SIZE}
+            unflushed = {doc.id: doc.unflushed for doc in docs}
+            for doc in docs:
+                doc.unflushed = []
+                doc.truncate_from = None
+            start = time.perf_counter()
+            try:
+                async with SessionMaker() as s:
+                    await update_documents(s, contents, entries, truncate, compact)
+            except Exception as e:
+                logger.info(f"Failed to flush documents {sorted(batch)}: {e}")
+                flush_failures.inc()
+                # NOTE: retried by the next flush
+                self.dirty |= batch
+                for doc in docs:
+                    kept = [frame for frame in unflushed[doc.id] if doc.truncate_from is None or frame["version"] < doc.truncate_from]
+                    doc.unflushed = kept + doc.unflushed
+                    if doc.id in truncate:
+                        doc.truncate_from = truncate[doc.id] if doc.truncate_from is None else min(doc.truncate_from, truncate[doc.id])
+                return False
+            flush_seconds.observe(time.perf_counter() - start)
+            flush_documents.inc(len(batch))
+            logger.info(f"Flushed {len(batch)} documents to the database")
+            return True
+
+    # Drop the documents that are clean and were not used for EVICT_AFTER seconds from memory
+    def evict(self) -> None:
+        now = time.monotonic()
+        idle = [docID for docID, doc in self.docs.items() if now - doc.last_used >= EVICT_AFTER and docID not in self.dirty
+                and not doc.unflushed and doc.truncate_from is None and not self.in_use(docID)]
+        for docID in idle:
+            del self.docs[docID]
+        if idle:
+            logger.info(f"Evicted {len(idle)} idle documents from memory")
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_needed.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_needed.clear()
+            await self.flush()
+            self.evict()
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    # Stop the periodic flush and write whatever is still dirty
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+        await self.flush()
@@ -0,0 +1,85 @@
+from __future__ import annotations
+from collections import deque
+from typing import Callable, Optional
+import asyncio
+import json
+import logging
+import time
+from fastapi import WebSocket
+import metrics
+
+logger = logging.getLogger("uvicorn")
+
+# Weight of the newest sample in the running averages used for the wait estimate
+SMOOTHING = 0.2
+
+lock_hold = metrics.Histogram("sharenotes_lock_hold_seconds", "How long a client kept the edit lock (and the token stayed in use)")
+token_wait = metrics.Histogram("sharenotes_token_wait_seconds", "How long the head of a queue waited for the token")
+
+
+class EditQueue:
+    def __init__(self, docID: int, send: Callable[[WebSocket, str], None]) -> None:
+        self.docID = docID
+        self.send = send # queues a message for a client
+        self.waiters: deque[tuple[WebSocket, asyncio.Future]] = deque()
+        self.holder: Optional[WebSocket] = None
+        self.held_since = 0.0
+        # Running averages (seconds) of how long a client keeps the lock and how long the head of the queue waits for the token
+        self.avg_hold = 10.0
+        self.avg_token_wait = 1.0
+        self.head_since = 0.0
+
+    def __len__(self) -> int:
+        return len(self.waiters)
+
+    # Add a client to the back of the queue, the future resolves when it is granted the lock
+    def join(self, websocket: WebSocket) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if not self.waiters:
+            self.head_since = time.monotonic()
+        self.waiters.append((websocket, future))
+        logger.info(f"Adding websocket to queue for docID: {self.docID}")
+        return future
+
+    # Remove a client that stopped waiting (e.g. disconnected)
+    def leave(self, websocket: WebSocket) -> None:
+        for entry in self.waiters:
+            if entry[0] is websocket:
+                self.waiters.remove(entry)
+                entry[1].cancel()
+                return
+
+    # Hand the lock to the head of the queue, waking only that client
+    def grant(self) -> bool:
+        while self.waiters:
+            websocket, future = self.waiters.popleft()
+            if future.done():
+                continue
+            now = time.monotonic()
+            token_wait.observe(now - self.head_since)
+            self.avg_token_wait += SMOOTHING * (now - self.head_since - self.avg_token_wait)
+            self.head_since = now
+            self.holder = websocket
+            self.held_since = now
+            future.set_result(True)
+            return True
+        return False
+
+    # Lock given back by its holder
+    def release(self, websocket: WebSocket) -> None:
+        if self.holder is websocket:
+            lock_hold.observe(time.monotonic() - self.held_since)
+            self.avg_hold += SMOOTHING * (time.monotonic() - self.held_since - self.avg_hold)
+            self.holder = None
+            if self.waiters:
+                self.head_since = time.monotonic()
+
+    def estimated_wait(self, position: int) -> float:
+        # NOTE: everyone ahead (including the current holder) keeps the lock for about avg_hold, then the token has to come back
+        ahead = position - 1 + (1 if self.holder else 0)
+        return round(ahead * self.avg_hold + self.avg_token_wait, 1)
+
+    # Tell every waiting client where it is in the queue
+    def notify_positions(self) -> None:
+        for position, (websocket, _) in enumerate(self.waiters, start=1):
+            self.send(websocket, json.dumps({"queue": {"position": position, "estimatedWait": self.estimated_wait(position)}}))
@@ -0,0 +1,67 @@
+from __future__ import annotations
+from typing import Iterable
+import bisect
+import hashlib
+import os
+
+# NOTE: Consistent hashing, every replica owns VNODES points on a ring of 64 bit hashes and a document is stored by the first
+# 'replication factor' distinct replicas found walking the ring clockwise from the document's hash. Adding or removing a replica
+# only moves the documents next to its points, and every node computes the same replica set from the same server list
+# NOTE: the master and the replicas have to use the same VNODES (and hash) to agree on where documents live
+VNODES = int(os.getenv("HASH_RING_VNODES", "64"))
+
+
+def ring_hash(key: str) -> int:
+    # NOTE: python's hash() is salted per process, md5 is the same everywhere
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, servers: Iterable[str] = (), vnodes: int = VNODES) -> None:
+        self.vnodes = vnodes
+        self.servers: set[str] = set()
+        self.points: list[int] = []
+        self.owners: dict[int, str] = {}
+        self.set_servers(servers)
+
+    def __len__(self) -> int:
+        return len(self.servers)
+
+    def set_servers(self, servers: Iterable[str]) -> None:
+        servers = set(servers)
+        for server in self.servers - servers:
+            self.remove(server)
+        for server in servers - self.servers:
+            self.add(server)
+
+    def add(self, server: str) -> None:
+        if server in self.servers:
+            return
+        self.servers.add(server)
+        for i in range(self.vnodes):
+            point = ring_hash(f"{server}#{i}")
+            self.owners[point] = server
+            bisect.insort(self.points, point)
+
+    def remove(self, server: str) -> None:
+        if server not in self.servers:
+            return
+        self.servers.discard(server)
+        self.points = [point for point in self.points if self.owners[point] != server]
+        self.owners = {point: self.owners[point] for point in self.points}
+
+    # Replicas storing a document, the first one is its primary; 'count' 0 (or more than the cluster) means every replica
+    def replicas(self, docID: int, count: int) -> list[str]:
+        if count <= 0 or count >= len(self.servers):
+            count = len(self.servers)
+        found: list[str] = []
+        if not self.points:
+            return found
+        start = bisect.bisect(self.points, ring_hash(f"doc:{docID}"))
+        for i in range(len(self.points)):
+            server = self.owners[self.points[(start + i) % len(self.points)]]
+            if server not in found:
+                found.append(server)
+                if len(found) == count:
+                    break
+        return found
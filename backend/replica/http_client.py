@@ -0,0 +1,39 @@
+from __future__ import annotations
+from typing import Optional
+import os
+import httpx
+
+# NOTE: One pooled async client is shared by every call to the other nodes in the cluster, so calls never block
+# the event loop and connections to the same node are kept alive and reused
+
+# Default timeout (seconds) for a call to another node, can be overridden per call
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "5"))
+# Max number of connections kept open (in total and idle)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "200"))
+
+client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global client
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+        )
+    return client
+
+
+async def close() -> None:
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+async def post(url: str, timeout: Optional[float] = None, **kwargs) -> httpx.Response:
+    return await get_client().post(url, timeout=timeout or HTTP_TIMEOUT, **kwargs)
+
+
+async def get(url: str, timeout: Optional[float] = None, **kwargs) -> httpx.Response:
+    return await get_client().get(url, timeout=timeout or HTTP_TIMEOUT, **kwargs)
@@ -0,0 +1,71 @@
+from __future__ import annotations
+from collections import Counter
+from typing import Awaitable, Callable
+import asyncio
+import logging
+import os
+import metrics
+
+logger = logging.getLogger("uvicorn")
+
+# NOTE: Every LOAD_REPORT_INTERVAL seconds the replica tells the master how busy it is, the master places new clients with it
+LOAD_REPORT_INTERVAL = float(os.getenv("LOAD_REPORT_INTERVAL", "2"))
+# How often (seconds) the event loop is probed for lag (how late a sleep wakes up)
+LOOP_LAG_PROBE = 0.25
+# Number of most edited documents included in a report
+HOT_DOCS = 10
+
+loop_lag = metrics.Histogram("sharenotes_event_loop_lag_seconds", "How late the event loop woke up a sleep (probed every 0.25s)")
+
+
+class LoadMonitor:
+    def __init__(self, clients: Callable[[], dict[int, int]], send: Callable[[dict], Awaitable[None]]) -> None:
+        self.clients = clients # docID -> number of connected clients
+        self.send = send
+        self.edits: Counter[int] = Counter() # docID -> edits since the last report
+        self.max_lag = 0.0
+        self.task = None
+
+    # Count an edit made by a client of this replica
+    def record_edit(self, docID: int) -> None:
+        self.edits[docID] += 1
+
+    def report(self, elapsed: float) -> dict:
+        clients = self.clients()
+        return {
+            "sockets": sum(clients.values()),
+            "loopLag": round(self.max_lag, 4),
+            "editRate": round(sum(self.edits.values()) / elapsed, 2),
+            "hotDocs": [docID for docID, _ in self.edits.most_common(HOT_DOCS)],
+            "docs": {docID: count for docID, count in clients.items() if count},
+        }
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        last_report = loop.time()
+        while True:
+            # NOTE: a busy loop wakes up late, the worst delay since the last report is the loop lag
+            expected = loop.time() + LOOP_LAG_PROBE
+            await asyncio.sleep(LOOP_LAG_PROBE)
+            lag = max(0.0, loop.time() - expected)
+            loop_lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            now = loop.time()
+            if now - last_report < LOAD_REPORT_INTERVAL:
+                continue
+            report = self.report(now - last_report)
+            last_report = now
+            self.edits.clear()
+            self.max_lag = 0.0
+            try:
+                await self.send(report)
+            except Exception as e:
+                logger.info(f"Failed to report load to master: {e}")
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
@@ -0,0 +1,112 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from typing import Callable
+import bisect
+
+# NOTE: Counters, gauges and histograms kept in memory and served as Prometheus text (GET /metrics/).
+# Recording a value is a dict lookup and an add, cheap enough for every edit. Labels are keyword arguments
+# e.g. replication_ack.observe(0.003, peer="localhost:8002")
+
+# Latency buckets (seconds) from half a millisecond to half a minute
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry: list[Metric] = []
+
+
+def label_text(labels: tuple, extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        registry.append(self)
+
+    # Sample lines of the metric in the Prometheus text format
+    @abstractmethod
+    def samples(self) -> list[str]:
+        ...
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{label_text(key)} {value}" for key, value in self.values.items()]
+
+
+# NOTE: gauges are read when scraped, 'read' returns the value, or {label value: value} for a gauge with a 'label'
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable[[], float | dict], label: str = None) -> None:
+        super().__init__(name, help)
+        self.read = read
+        self.label = label
+
+    def samples(self) -> list[str]:
+        value = self.read()
+        if self.label is None:
+            return [f"{self.name} {value}"]
+        return [f"{self.name}{label_text(((self.label, key),))} {v}" for key, v in value.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {} # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{label_text(key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{label_text(key, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{label_text(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{label_text(key)} {series[-1]}")
+        return lines
+
+
+# Every metric of this process in the Prometheus text format
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+# Content type of render() for the metrics endpoint
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,112 @@
+from __future__ import annotations
+from collections import deque
+from typing import Callable, Optional
+import asyncio
+import json
+import logging
+import os
+import time
+from fastapi import WebSocket
+import metrics
+
+logger = logging.getLogger("uvicorn")
+
+# NOTE: Every client websocket gets its own outbox drained by its own writer task, so a slow or stalled browser only
+# delays itself: broadcasting an edit appends to each outbox and never waits on a socket.
+# A client more than CLIENT_BUFFER_BYTES behind has its pending edits replaced by ONE frame with the whole document
+# (the latest state wins), and a client that has not caught up CLIENT_SLOW_TIMEOUT seconds later is disconnected
+# (it reconnects and catches up like after any other disconnect)
+CLIENT_BUFFER_BYTES = int(os.getenv("CLIENT_BUFFER_BYTES", str(1 << 20)))
+CLIENT_SLOW_TIMEOUT = float(os.getenv("CLIENT_SLOW_TIMEOUT", "10"))
+
+snapshots_instead = metrics.Counter("sharenotes_client_snapshots_total", "Times a client fell behind and got the whole document instead of its edits")
+evictions = metrics.Counter("sharenotes_client_evictions_total", "Clients disconnected for staying behind")
+
+# Queue entry standing for the whole document (taken when it is sent)
+SNAPSHOT = None
+
+
+class ClientOutbox:
+    def __init__(self, websocket: WebSocket, snapshot: Callable[[], dict]) -> None:
+        self.websocket = websocket
+        self.snapshot = snapshot
+        self.queue: deque[Optional[tuple[str, bool]]] = deque() # (message, droppable) or SNAPSHOT
+        self.pending_bytes = 0
+        self.snapshot_queued = False # the whole document is queued instead of edits
+        self.behind_since: Optional[float] = None # went over the buffer and has not caught up since
+        self.ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.evicted = False
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+
+    # Queue a message for the client (never blocks the caller)
+    # NOTE: 'droppable' messages are edits that the whole document can stand in for, 'supersedes' ones carry the whole
+    # document themselves so every edit queued before them can be dropped
+    def send(self, message: str, droppable: bool = False, supersedes: bool = False) -> None:
+        if self.evicted:
+            return
+        if droppable and self.behind_since is not None and time.monotonic() - self.behind_since > CLIENT_SLOW_TIMEOUT:
+            self.evict()
+            return
+        if supersedes:
+            self.drop_edits()
+        elif droppable and self.snapshot_queued:
+            return # the whole document is already queued, it will include this edit
+        self.queue.append((message, droppable or supersedes))
+        self.pending_bytes += len(message)
+        if droppable and self.pending_bytes > CLIENT_BUFFER_BYTES:
+            logger.info(f"Client is {self.pending_bytes} bytes behind, sending it the whole document instead of its edits")
+            snapshots_instead.inc()
+            self.drop_edits()
+            self.queue.append(SNAPSHOT)
+            self.snapshot_queued = True
+            if self.behind_since is None:
+                self.behind_since = time.monotonic()
+        self.ready.set()
+
+    def drop_edits(self) -> None:
+        self.queue = deque(entry for entry in self.queue if entry is not SNAPSHOT and not entry[1])
+        self.pending_bytes = sum(len(entry[0]) for entry in self.queue)
+        self.snapshot_queued = False
+
+    # Disconnect a client that cannot keep up
+    def evict(self) -> None:
+        logger.info(f"Client stayed over its send buffer for {CLIENT_SLOW_TIMEOUT}s, disconnecting it")
+        self.evicted = True
+        evictions.inc()
+        self.stop()
+        self.queue.clear()
+        asyncio.create_task(self.close())
+
+    async def close(self) -> None:
+        try:
+            # NOTE: 1013 is "try again later", the client reconnects (possibly to another replica)
+            await self.websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def run(self) -> None:
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                entry = self.queue.popleft()
+                if entry is SNAPSHOT:
+                    self.snapshot_queued = False
+                    message = json.dumps(self.snapshot())
+                else:
+                    message = entry[0]
+                    self.pending_bytes -= len(message)
+                try:
+                    await self.websocket.send_text(message)
+                except Exception as e:
+                    # NOTE: the client's endpoint notices the disconnect and removes the outbox
+                    logger.info(f"Failed to send to client: {e}")
+                    return
+            self.behind_since = None # caught up
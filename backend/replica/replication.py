@@ -0,0 +1,185 @@
+from __future__ import annotations
+from typing import Callable, Optional
+import asyncio
+import logging
+import os
+import time
+import websockets
+import codec
+import metrics
+
+logger = logging.getLogger("uvicorn")
+
+# NOTE: Every replica keeps ONE long lived websocket per peer instead of opening a connection per edit.
+# Edits are queued per peer and sent as batches {"seq": <n>, "edits": [<edit>, ...]}, where an edit is a
+# versioned frame tagged with its document e.g. {"doc": 3, "name": "notes", "op": {...}, "version": 12}
+# (as JSON text frames, or msgpack binary frames, see codec.py)
+# Peers reply with cumulative acks {"ack": <n>, "resync": [<docIDs they could not apply>]}, meaning every
+# batch up to and including n was applied, so batches are pipelined without waiting on each ack
+
+# Max number of edits coalesced into one batch
+MAX_BATCH = int(os.getenv("REPLICATION_MAX_BATCH", "256"))
+# Max number of unacknowledged batches on a link before the sender waits for acks
+MAX_IN_FLIGHT = int(os.getenv("REPLICATION_MAX_IN_FLIGHT", "64"))
+# Time (seconds) the sender waits before sending a batch so more edits can be coalesced into it
+BATCH_DELAY = float(os.getenv("REPLICATION_BATCH_DELAY", "0"))
+# NOTE: links negotiate permessage-deflate ("deflate", the default) so batches of whole documents are compressed on the wire,
+# "none" saves the CPU on fast networks where edits are small operations (see bench/wire.py for the tradeoff)
+REPLICATION_COMPRESSION = os.getenv("REPLICATION_COMPRESSION", "deflate")
+# Max seconds an editor giving the token back waits for the peers to ack the document's edits (see Replicator.drained)
+DRAIN_TIMEOUT = float(os.getenv("REPLICATION_DRAIN_TIMEOUT", "5"))
+# Number of times a broken link is reopened before the peer is reported as down
+RECONNECT_ATTEMPTS = 3
+
+ack_seconds = metrics.Histogram("sharenotes_replication_ack_seconds", "Time from sending a batch to a peer to its ack (per peer)")
+batch_edits = metrics.Counter("sharenotes_replication_edits_sent_total", "Edits sent to a peer (per peer)")
+
+
+class PeerLink:
+    def __init__(self, peer: str, snapshot: Callable[[int], Optional[dict]], on_down: Callable[[str], None]) -> None:
+        self.peer = peer
+        self.snapshot = snapshot
+        self.on_down = on_down
+        self.outbox: list[dict] = []
+        self.in_flight: dict[int, dict] = {}  # seq -> batch waiting for an ack
+        self.sent_at: dict[int, float] = {}  # seq -> when the batch was (last) sent
+        self.seq = 0
+        self.has_edits = asyncio.Event()
+        self.acked = asyncio.Event()
+        self.closed = False
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+        self.close()
+
+    # NOTE: wakes anyone waiting for acks, none come after this
+    def close(self) -> None:
+        self.closed = True
+        self.acked.set()
+
+    # Queue an edit for this peer (never blocks the caller)
+    def send(self, edit: dict) -> None:
+        self.outbox.append(edit)
+        self.has_edits.set()
+
+    # Whether edits of the document are queued or sent without being acked
+    def pending(self, docID: int) -> bool:
+        if any(edit["doc"] == docID for edit in self.outbox):
+            return True
+        return any(edit["doc"] == docID for batch in self.in_flight.values() for edit in batch["edits"])
+
+    async def drained(self, docID: int) -> None:
+        while not self.closed and self.pending(docID):
+            self.acked.clear()
+            await self.acked.wait()
+
+    async def run(self) -> None:
+        failures = 0
+        while True:
+            try:
+                async with websockets.connect(f"ws://{self.peer}/replica/ws/", compression=None if REPLICATION_COMPRESSION == "none" else "deflate") as websocket:
+                    logger.info(f"Replication link to {self.peer} open")
+                    failures = 0
+                    # Anything not acked on the previous connection is sent again (peers ignore duplicates)
+                    for seq in sorted(self.in_flight):
+                        self.sent_at[seq] = time.monotonic()
+                        await websocket.send(codec.encode(self.in_flight[seq]))
+                    # NOTE: whichever side notices the connection dropping first ends both
+                    tasks = {asyncio.create_task(self.read_acks(websocket)), asyncio.create_task(self.write_batches(websocket))}
+                    try:
+                        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    finally:
+                        for task in tasks:
+                            task.cancel()
+                    for task in done:
+                        task.result()
+                    raise ConnectionError("connection closed by peer")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                logger.info(f"Replication link to {self.peer} failed ({failures}/{RECONNECT_ATTEMPTS}): {e}")
+                if failures >= RECONNECT_ATTEMPTS:
+                    self.close()
+                    self.on_down(self.peer)
+                    return
+                await asyncio.sleep(0.1 * failures)
+
+    async def write_batches(self, websocket) -> None:
+        while True:
+            await self.has_edits.wait()
+            if BATCH_DELAY:
+                await asyncio.sleep(BATCH_DELAY)
+            # Back pressure: don't let the peer fall arbitrarily far behind
+            while len(self.in_flight) >= MAX_IN_FLIGHT:
+                self.acked.clear()
+                await self.acked.wait()
+            edits, self.outbox = self.outbox[:MAX_BATCH], self.outbox[MAX_BATCH:]
+            if not self.outbox:
+                self.has_edits.clear()
+            self.seq += 1
+            batch = {"seq": self.seq, "edits": edits}
+            self.in_flight[self.seq] = batch
+            self.sent_at[self.seq] = time.monotonic()
+            batch_edits.inc(len(edits), peer=self.peer)
+            await websocket.send(codec.encode(batch))
+
+    async def read_acks(self, websocket) -> None:
+        async for message in websocket:
+            reply = codec.decode(message)
+            # NOTE: acks are cumulative, everything up to the acked sequence number is done
+            now = time.monotonic()
+            for seq in [seq for seq in self.in_flight if seq <= reply["ack"]]:
+                del self.in_flight[seq]
+                ack_seconds.observe(now - self.sent_at.pop(seq, now), peer=self.peer)
+            self.acked.set()
+            for docID in reply.get("resync", []):
+                logger.info(f"Replica {self.peer} asked for full content of document {docID}")
+                edit = self.snapshot(docID)
+                if edit:
+                    self.send(edit)
+
+
+class Replicator:
+    def __init__(self, me: str, snapshot: Callable[[int], Optional[dict]], on_down: Callable[[str], None]) -> None:
+        self.me = me
+        self.snapshot = snapshot
+        self.on_down = on_down
+        self.links: dict[str, PeerLink] = {}
+
+    # Open links to new peers and close links to peers no longer in the cluster
+    def update_peers(self, server_list: list[str]) -> None:
+        peers = [server for server in server_list if server != self.me]
+        for peer in list(self.links):
+            if peer not in peers:
+                self.links.pop(peer).stop()
+        for peer in peers:
+            if peer not in self.links:
+                self.links[peer] = PeerLink(peer, self.snapshot, self.link_down)
+                self.links[peer].start()
+
+    def link_down(self, peer: str) -> None:
+        self.links.pop(peer, None)
+        self.on_down(peer)
+
+    # Fan an edit out to every peer (or only the given ones, e.g. the other replicas storing the document) concurrently
+    def replicate(self, edit: dict, peers: Optional[list[str]] = None) -> None:
+        if peers is None:
+            peers = list(self.links)
+        for peer in peers:
+            if peer in self.links:
+                self.links[peer].send(edit)
+
+    # Wait until every peer acked the edits of a document queued so far, False if that took over DRAIN_TIMEOUT seconds
+    # NOTE: an editor's token is only sent on after this, so whoever gets it next edits on top of every edit before it
+    async def drained(self, docID: int) -> bool:
+        try:
+            await asyncio.wait_for(asyncio.gather(*[link.drained(docID) for link in self.links.values()]), DRAIN_TIMEOUT)
+            return True
+        except asyncio.TimeoutError:
+            return False
@@ -0,0 +1,414 @@
+from __future__ import annotations
+from contextlib import asynccontextmanager
+from typing import Optional
+import argparse
+import asyncio
+import logging
+import os
+import re
+import socket
+import subprocess
+import sys
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+import httpx
+import uvicorn
+import websockets
+import codec
+import http_client
+from worker import HandoffServer, owner, worker_socket
+
+logger = logging.getLogger("uvicorn")
+
+# NOTE: Front of a replica running as several worker processes (see worker.py), started instead of uvicorn:
+#   python router.py --port 8001 --workers 4
+# with the same environment variables as a single process replica. The router owns the replica's port:
+# - client websockets (/ws/{docID}/...) are handed to the worker of their document as they connect
+# - requests about one document go to its worker, requests about many are split by worker and the replies merged
+# - membership changes go to every worker
+# - replication links from other replicas end here, their batches are split by worker and the acks combined
+# The workers register, report their load and say they caught up through the router (/worker/{i}/...), which tells
+# the master about the whole replica
+REPLICA_WORKERS = int(os.getenv("REPLICA_WORKERS", str(os.cpu_count() or 1)))
+# Seconds a worker gets to answer a request passed on by the router (copying documents to a joining replica is slow)
+WORKER_TIMEOUT = 60.0
+# Same as the workers' (see server.py)
+SNAPSHOT_CHUNK = int(os.getenv("SNAPSHOT_CHUNK", "200"))
+
+# Connections handed over to a worker, by their request line
+HANDOFF_PATH = re.compile(rb"^GET /(?:replica/)?ws/(\d+)/")
+
+MASTER_IP = os.getenv("MASTER_IP")
+
+workers = REPLICA_WORKERS
+port = os.getenv("PORT")
+processes: list[subprocess.Popen] = []
+# Datagram sockets the connections are handed over on, one per worker
+channels: list[socket.socket] = []
+clients: list[httpx.AsyncClient] = []
+# Latest load report of every worker, and the workers still catching up (the replica is until all of them are)
+reports: dict[int, dict] = {}
+catching_up: set[int] = set()
+# NOTE: after the master evicted the replica every worker has to register (and catch up) again
+rejoining: set[int] = set()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for worker in range(workers):
+        clients.append(httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(uds=worker_socket(port, worker)), base_url="http://worker", timeout=WORKER_TIMEOUT))
+    yield
+    for client in clients:
+        await client.aclose()
+    await http_client.close()
+
+app = FastAPI(lifespan=lifespan)
+
+
+# Start the workers, each with its end of a handoff channel
+def spawn_workers(local_address: str):
+    global catching_up
+    for worker in range(workers):
+        router_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        processes.append(subprocess.Popen(
+            [sys.executable, "worker.py"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env={**os.environ, "PORT": port, "WORKER": str(worker), "WORKERS": str(workers), "HANDOFF_FD": str(worker_end.fileno()),
+                 "REGISTRAR": f"{local_address}/worker/{worker}"},
+            pass_fds=[worker_end.fileno()],
+        ))
+        worker_end.close()
+        channels.append(router_end)
+    catching_up = set(range(workers))
+
+def stop_workers():
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+### Handing connections over ###
+async def accept(listener: socket.socket, server: HandoffServer):
+    loop = asyncio.get_running_loop()
+    pending: set[asyncio.Task] = set()
+    while True:
+        connection, _ = await loop.sock_accept(listener)
+        task = asyncio.create_task(dispatch(connection, server))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+# Client websockets go to their document's worker, everything else is served here
+async def dispatch(connection: socket.socket, server: HandoffServer):
+    match = HANDOFF_PATH.match(await peek_request_line(connection))
+    if match:
+        # NOTE: the worker gets its own copy of the socket, the request is still unread so it sees the whole connection
+        socket.send_fds(channels[owner(int(match[1]), workers)], [b"c"], [connection.fileno()])
+        connection.close()
+        return
+    await server.serve_connection(connection)
+
+# The first line of the request on a new connection, without reading it off the socket
+async def peek_request_line(connection: socket.socket, timeout: float = 10) -> bytes:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        try:
+            data = connection.recv(1024, socket.MSG_PEEK)
+        except BlockingIOError:
+            readable = loop.create_future()
+            # NOTE: the reader can fire again before it is removed below, only the first one counts
+            loop.add_reader(connection.fileno(), lambda: readable.done() or readable.set_result(None))
+            try:
+                await asyncio.wait_for(readable, deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            finally:
+                loop.remove_reader(connection.fileno())
+            continue
+        if not data or b"\r\n" in data or len(data) == 1024:
+            return data.split(b"\r\n")[0]
+        # NOTE: only part of the line arrived, the socket stays readable until the rest is read so poll instead
+        await asyncio.sleep(0.001)
+    return b""
+
+
+### Passing requests on to the workers ###
+async def forward(worker: int, request: Request) -> Response:
+    reply = await clients[worker].request(
+        request.method,
+        request.url.path,
+        params=request.query_params,
+        content=await request.body(),
+        headers={"content-type": request.headers.get("content-type", "application/json")},
+    )
+    return Response(reply.content, reply.status_code, media_type=reply.headers.get("content-type"))
+
+# Send a request to every worker, in parallel, with the body each one gets (the request's own by default)
+async def to_workers(request: Request, bodies: Optional[dict[int, object]] = None) -> dict[int, httpx.Response]:
+    targets = list(range(workers)) if bodies is None else list(bodies)
+    content = await request.body()
+    replies = await asyncio.gather(*[clients[worker].request(
+        request.method,
+        request.url.path,
+        params=request.query_params,
+        content=content if bodies is None else None,
+        json=None if bodies is None else bodies[worker],
+        headers={"content-type": "application/json"},
+    ) for worker in targets])
+    for reply in replies:
+        reply.raise_for_status()
+    return dict(zip(targets, replies))
+
+# Split [[docID, ...], ...] or [{"id": docID, ...}, ...] by the worker storing each document
+def split(items: list, docID=lambda item: item[0]) -> dict[int, list]:
+    parts: dict[int, list] = {}
+    for item in items:
+        parts.setdefault(owner(int(docID(item)), workers), []).append(item)
+    return parts
+
+
+# Requests about one document
+@app.post("/recvToken/{docID}/{serial}/")
+@app.post("/forwardToken/{docID}/")
+@app.post("/initializeToken/{docID}/{serial}/")
+@app.get("/docSince/{docID}/{version}")
+@app.get("/document/{docID}/")
+async def one_document(request: Request, docID: int):
+    return await forward(owner(docID, workers), request)
+
+@app.post("/newDocID/{docName}/")
+@app.post("/createDoc/")
+async def new_document(request: Request, docID: Optional[int] = None):
+    # NOTE: a document has to be created on the worker its docID maps to, a worker picking the docID itself would store it
+    # where no later request for it goes (the master always sends the docID it allocated)
+    if docID is None:
+        raise HTTPException(400, "docID is required by a replica running workers")
+    return await forward(owner(docID, workers), request)
+
+# Requests about many documents
+@app.post("/recvTokens/")
+async def recv_tokens(request: Request):
+    parts = split(await request.json())
+    if not parts:
+        return {"Using": []}
+    replies = await to_workers(request, parts)
+    return {"Using": [docID for reply in replies.values() for docID in reply.json()["Using"]]}
+
+@app.post("/initializeTokens/")
+async def initialize_tokens(request: Request):
+    bundle = await request.json() if await request.body() else None
+    # NOTE: without a bundle every worker starts the tokens of all its documents
+    await to_workers(request, None if bundle is None else split(bundle))
+    return {"Message": "Tokens initialized"}
+
+@app.post("/newDocs/")
+async def new_documents(request: Request):
+    parts = split(await request.json(), lambda doc: doc["id"])
+    replies = await to_workers(request, parts)
+    return {"created": sum(reply.json()["created"] for reply in replies.values())}
+
+@app.post("/docsSince/")
+async def docs_since(request: Request):
+    parts: dict[int, dict] = {}
+    for docID, version in (await request.json()).items():
+        parts.setdefault(owner(int(docID), workers), {})[docID] = version
+    replies = await to_workers(request, parts)
+    return {docID: frame for reply in replies.values() for docID, frame in reply.json().items()}
+
+# NOTE: every worker lists its own documents in docID order, the pages are merged and cut to the page size again
+@app.get("/docList/")
+async def doc_list(request: Request, limit: Optional[int] = None):
+    replies = await to_workers(request)
+    docs = sorted((doc for reply in replies.values() for doc in reply.json()), key=lambda doc: doc["id"])
+    return docs[:limit] if limit else docs
+
+@app.get("/snapshot/")
+async def snapshot(request: Request, limit: int = SNAPSHOT_CHUNK):
+    replies = [reply.json() for reply in (await to_workers(request)).values()]
+    docs = sorted((doc for reply in replies for doc in reply["docs"]), key=lambda doc: doc["id"])
+    # NOTE: the next chunk starts where the worker that got the least far stopped (or after the last document that fits the
+    # page), the documents past it are dropped here and sent with the next chunk. A worker can stop without sending any
+    # document (none of the ones it went through were asked for), that is not the end of the snapshot
+    ends = [reply["next"] for reply in replies if reply["next"] is not None]
+    if len(docs) > limit:
+        ends.append(docs[limit - 1]["id"])
+    if not ends:
+        return {"docs": docs, "next": None}
+    end = min(ends)
+    return {"docs": [doc for doc in docs if doc["id"] <= end], "next": end}
+
+# Membership changes go to every worker
+@app.post("/updateServerList/")
+@app.post("/membershipDelta/")
+async def membership(request: Request):
+    replies = await to_workers(request)
+    return replies[0].json()
+
+# Heartbeat from the master, the replica is only alive while all its workers are
+@app.get("/ping/")
+async def ping():
+    if any(process.poll() is not None for process in processes):
+        raise HTTPException(503, "A worker stopped")
+    return {"Message": "pong"}
+
+# Metrics of every worker, each sample labelled with its worker
+@app.get("/metrics/")
+async def metrics(request: Request):
+    replies = await to_workers(request)
+    families: dict[str, list[str]] = {}
+    for worker, reply in replies.items():
+        name = None
+        for line in reply.text.splitlines():
+            if line.startswith("# HELP "):
+                name = line.split()[2]
+                header = name not in families
+                families.setdefault(name, [])
+            if line.startswith("#"):
+                if header:
+                    families[name].append(line)
+                continue
+            sample, value = line.rsplit(" ", 1)
+            label = f'worker="{worker}"'
+            sample = sample.replace("{", "{" + label + ",", 1) if sample.endswith("}") else sample + "{" + label + "}"
+            families[name].append(f"{sample} {value}")
+    return Response("\n".join(line for lines in families.values() for line in lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+### Speaking to the master for the workers ###
+@app.post("/worker/{worker}/addServer/")
+async def add_server(worker: int, IP: str, port: str, catchingUp: bool = False):
+    rejoining.discard(worker)
+    if catchingUp:
+        catching_up.add(worker)
+    # NOTE: registering again is harmless, the master sends the whole view again (to every worker, through /updateServerList/)
+    reply = await http_client.post(f"http://{MASTER_IP}:8000/addServer/", params={"IP": IP, "port": port, "catchingUp": bool(catching_up)})
+    return reply.json()
+
+@app.post("/worker/{worker}/reportLoad/")
+async def report_load(worker: int, IP: str, port: str, report: dict):
+    global catching_up
+    global rejoining
+    reports[worker] = report
+    if worker in rejoining:
+        return {"Registered": False}
+    merged = {
+        "sockets": sum(report.get("sockets", 0) for report in reports.values()),
+        "loopLag": max(report.get("loopLag", 0) for report in reports.values()),
+        "editRate": round(sum(report.get("editRate", 0) for report in reports.values()), 2),
+        "hotDocs": [docID for report in reports.values() for docID in report.get("hotDocs", [])],
+        "docs": {docID: count for report in reports.values() for docID, count in report.get("docs", {}).items()},
+        "catchingUp": bool(catching_up),
+    }
+    reply = (await http_client.post(f"http://{MASTER_IP}:8000/reportLoad/", params={"IP": IP, "port": port}, json=merged)).json()
+    if not reply.get("Registered", True):
+        logger.info("Master no longer knows this replica, every worker registers again")
+        rejoining = set(range(workers))
+        catching_up = set(range(workers))
+    return reply
+
+@app.post("/worker/{worker}/caughtUp/")
+async def caught_up(worker: int, IP: str, port: str):
+    catching_up.discard(worker)
+    if catching_up:
+        return {"Registered": True}
+    reply = await http_client.post(f"http://{MASTER_IP}:8000/caughtUp/", params={"IP": IP, "port": port})
+    return reply.json()
+
+
+### Replication links ###
+# A replication link from another replica, every batch is split into one batch per worker (sent on this link's own
+# link to each worker) and acked once every part of it and of the batches before it was acked by its worker
+@app.websocket("/replica/ws/")
+async def replication_link(websocket: WebSocket):
+    await websocket.accept()
+    binary = codec.BINARY
+    links = [await websockets.unix_connect(worker_socket(port, worker), "ws://worker/replica/ws/", compression=None) for worker in range(workers)]
+    sequence = [0] * workers # last sequence number sent to every worker
+    parts: list[dict[int, int]] = [{} for _ in range(workers)] # worker sequence number -> batch it is part of
+    remaining: dict[int, int] = {} # batches in the order received -> parts not acked yet
+    acked = 0
+    replies: asyncio.Queue[dict] = asyncio.Queue()
+
+    def advance():
+        nonlocal acked
+        done = None
+        while remaining and remaining[next(iter(remaining))] == 0:
+            done = next(iter(remaining))
+            del remaining[done]
+        if done is not None:
+            acked = done
+            replies.put_nowait({"ack": acked, "resync": []})
+
+    async def read_acks(worker: int):
+        async for message in links[worker]:
+            reply = codec.decode(message)
+            for seq in [seq for seq in parts[worker] if seq <= reply["ack"]]:
+                remaining[parts[worker].pop(seq)] -= 1
+            if reply.get("resync"):
+                replies.put_nowait({"ack": acked, "resync": reply["resync"]})
+            advance()
+
+    async def send_replies():
+        while True:
+            reply = await replies.get()
+            if binary:
+                await websocket.send_bytes(codec.encode(reply, binary))
+            else:
+                await websocket.send_text(codec.encode(reply, binary))
+
+    tasks = [asyncio.create_task(read_acks(worker)) for worker in range(workers)] + [asyncio.create_task(send_replies())]
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            binary = message.get("bytes") is not None
+            batch = codec.decode(message["bytes"] if binary else message["text"])
+            by_worker = split(batch["edits"], lambda edit: edit["doc"])
+            remaining[batch["seq"]] = len(by_worker)
+            for worker, edits in by_worker.items():
+                sequence[worker] += 1
+                parts[worker][sequence[worker]] = batch["seq"]
+                await links[worker].send(codec.encode({"seq": sequence[worker], "edits": edits}))
+            advance() # NOTE: for empty batches
+    except (WebSocketDisconnect, websockets.ConnectionClosed):
+        # NOTE: the other replica sends everything that was not acked again when it reconnects
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        for link in links:
+            await link.close()
+
+
+async def serve(server: HandoffServer, listener: socket.socket):
+    accepter = asyncio.create_task(accept(listener, server))
+    try:
+        await server.serve()
+    finally:
+        accepter.cancel()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a replica as a router in front of several worker processes")
+    parser.add_argument("--port", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--workers", type=int, default=REPLICA_WORKERS)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    port = os.environ["PORT"] = args.port
+    workers = args.workers
+    os.environ["LOG_LEVEL"] = args.log_level
+    listener = socket.create_server((args.host, int(port)), backlog=2048)
+    listener.setblocking(False)
+    local_host = "127.0.0.1" if args.host in ("0.0.0.0", "localhost") else args.host
+    spawn_workers(f"{local_host}:{port}")
+    config = uvicorn.Config(app, uds=worker_socket(port, "router"), log_level=args.log_level)
+    config.setup_event_loop()
+    try:
+        asyncio.run(serve(HandoffServer(config), listener))
+    finally:
+        stop_workers()
@@ -1,28 +1,42 @@
 from contextlib import asynccontextmanager
-from typing import Annotated, List, Any, Tuple, Dict
-from fastapi import Depends, FastAPI, WebSocket, WebSocketDisconnect, BackgroundTasks
+from typing import Annotated, List, Any, Optional
+from fastapi import Depends, FastAPI, Query, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 import json
 import logging
 from sqlalchemy.future import select
 import os
 from db import (
-    DocumentUpdate,
     Document,
     DocumentList,
     create_all,
     AsyncSession,
     create_document,
+    create_repl_documents,
     create_document_with_content,
-    read_document,
     session,
-    update_document,
-    doc_list_db
+    SessionMaker,
+    doc_versions,
+    doc_list_db,
+    list_documents,
+    read_documents,
+    update_documents,
+    EditLog
 )
-import websockets
-import requests
-import time
+from documents import FLUSH_INTERVAL, DocumentStore, InvalidOperation, LiveDocument, validate_op
+from exceptions import HTTPException
+from replication import Replicator
+from apply_queue import ApplyQueues
+from edit_queue import EditQueue
+from outbox import ClientOutbox
+from load import LoadMonitor
+from hashring import HashRing
+from tracing import log_edit, new_trace_id
+import http_client
+import codec
+import metrics
 import asyncio
+import time
 from threading import Lock
 
 # alternative to directly defining paramter type
@@ -39,14 +53,31 @@ logger = logging.getLogger("uvicorn")
 # Global arrays and queues
 server_list = []
 successor = 0
-doc_queues: dict[int, list] = {}
-doc_permission: dict[WebSocket, bool] = {}
-send_token_count = 0
+# Set once this replica asked a peer for the edits it missed while it was down
+caught_up = False
+# NOTE: until the documents it is missing have been copied from its peers the master places no clients here
+catching_up = True
+registered = asyncio.Event()
+# NOTE: the latest server list version from the master, older broadcasts arriving late are ignored
+membership_version = -1
+# Instance of the master this replica last reported to (a new one means the master restarted)
+master_instance = None
+# Which replicas store which document (consistent hashing, same ring and replication factor as the master)
+ring = HashRing()
+replication_factor = 0
+edit_queues: dict[int, EditQueue] = {}
 serial_of_token: dict[int, int] = {}
 # NOTE: Lock is needed as multiple attempts can be made to pass tokens to a dead successor within a short time window
 # the lock avoids faulty deletes in that scenerio
 succ_lock = Lock()
 
+# Metrics served at /metrics/ (see metrics.py), the gauges are defined with what they read
+client_edits = metrics.Counter("sharenotes_client_edits_total", "Edits made by clients of this replica")
+replicated_edits = metrics.Counter("sharenotes_replicated_edits_total", "Edits received from other replicas and applied")
+broadcast_seconds = metrics.Histogram("sharenotes_broadcast_seconds", "Time to queue an edit for every client of its document")
+token_lap = metrics.Histogram("sharenotes_token_lap_seconds", "Time between two arrivals of a token at this replica")
+token_idle = metrics.Histogram("sharenotes_token_idle_seconds", "Time a token stayed parked here before being used or passed on")
+
 # Enviroment variables
 MY_PORT = os.getenv("PORT")
 logger.info(MY_PORT)
@@ -57,6 +88,33 @@ logger.info(MY_IP)
 MASTER_IP = os.getenv("MASTER_IP")
 logger.info(MASTER_IP)
 
+# NOTE: where this replica registers, reports its load and says it caught up: the master, or the router when this is one
+# of the workers of a multi-process replica (see router.py), which speaks to the master for all its workers
+REGISTRAR = os.getenv("REGISTRAR", f"{MASTER_IP}:8000")
+
+# NOTE: "adaptive" parks tokens nobody is waiting for at their last holder and sends them straight to replicas
+# that asked the master for them, "ring" passes a token around the replicas with clients on its document waiting
+# TOKEN_HOP_DELAY seconds per hop. In both modes the master picks the next holder, tokens of documents nobody has open are parked
+TOKEN_MODE = os.getenv("TOKEN_MODE", "adaptive")
+TOKEN_HOP_DELAY = float(os.getenv("TOKEN_HOP_DELAY", "2"))
+# How often (seconds) parked tokens are reported to the master, has to be well under the master's token timeout
+TOKEN_RENEW_INTERVAL = float(os.getenv("TOKEN_RENEW_INTERVAL", "5"))
+# NOTE: when replicated edits are acked to the replica that sent them: "received", "applied" (in memory, the default)
+# or "persisted" (written to the database), see replica_websocket_endpoint
+REPLICATION_ACK = os.getenv("REPLICATION_ACK", "applied")
+# Number of documents a peer reads per chunk when copying documents to a replica that joined
+SNAPSHOT_CHUNK = int(os.getenv("SNAPSHOT_CHUNK", "200"))
+# Seconds before a document that is still out of sync asks the sending replica for its full content again
+RESYNC_RETRY = 2.0
+# Tokens held here with nobody waiting for them (docID -> serial)
+parked_tokens: dict[int, int] = {}
+# NOTE: for the token metrics, when every token last arrived here and since when it has been parked here (docID -> time)
+token_arrived: dict[int, float] = {}
+parked_since: dict[int, float] = {}
+# Tokens to report to the master and pass on in the next bundle (docID -> serial)
+outgoing_tokens: dict[int, int] = {}
+tokens_to_send = asyncio.Event()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -64,9 +122,34 @@ async def lifespan(app: FastAPI):
     # Initailize variables for synchronization
     await create_doc_queues()
     # inform master that you want to be registered to the cluster
-    reply = requests.post(f"http://{MASTER_IP}:8000/addServer/", params={"IP": MY_IP, "port": MY_PORT})
-    logger.info(reply)
+    # NOTE: done once this replica accepts connections, the master starts sending it the server list right away
+    registration = asyncio.create_task(register_with_master())
+    renewer = asyncio.create_task(renew_parked_tokens())
+    sender = asyncio.create_task(token_sender())
+    documents.start()
+    load.start()
     yield
+    load.stop()
+    registration.cancel()
+    renewer.cancel()
+    sender.cancel()
+    await documents.stop()
+    await http_client.close()
+
+async def register_with_master():
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(MY_IP, int(MY_PORT))
+            writer.close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    await join_cluster()
+
+async def join_cluster():
+    reply = await http_client.post(f"http://{REGISTRAR}/addServer/", params={"IP": MY_IP, "port": MY_PORT, "catchingUp": catching_up})
+    logger.info(reply)
+    registered.set()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -85,190 +168,539 @@ app.add_middleware(
 class ConnectionManager:
     def __init__(self):
         self.active_connections: dict[int, list] = {}
+        # NOTE: everything sent to a client goes through its outbox so messages keep their order and nobody waits on a socket
+        self.outboxes: dict[WebSocket, ClientOutbox] = {}
+        # Read-only relays (see relay/server.py) subscribed to a document, they get its broadcasts like any client but
+        # never edit, so they do not bring the document's token to this replica
+        self.relays: set[WebSocket] = set()
 
-    async def connect(self, docID: int, websocket: WebSocket):
+    async def connect(self, docID: int, websocket: WebSocket, relay: bool = False):
         await websocket.accept()
+        self.outboxes[websocket] = ClientOutbox(websocket, lambda: documents.docs[docID].snapshot())
+        self.outboxes[websocket].start()
         self.active_connections.setdefault(docID, []).append(websocket)
+        if relay:
+            self.relays.add(websocket)
+        elif self.clients(docID) == 1:
+            report_editors(docID, True)
 
     def disconnect(self, docID: int, websocket: WebSocket):
         self.active_connections[docID].remove(websocket)
+        self.outboxes.pop(websocket).stop()
+        if websocket in self.relays:
+            self.relays.discard(websocket)
+        elif not self.clients(docID):
+            report_editors(docID, False)
+
+    # Clients of a document that can edit it (relays left out)
+    def clients(self, docID: int) -> int:
+        return sum(1 for websocket in self.active_connections.get(docID, []) if websocket not in self.relays)
+
+    # Queue a message for one client
+    def send(self, websocket: WebSocket, message: str):
+        if websocket in self.outboxes:
+            self.outboxes[websocket].send(message)
 
-    async def broadcast(self, docID: int, message: str):
+    # Queue an edit frame for every client of a document, 'full' frames carry the whole document
+    def broadcast(self, docID: int, message: str, exclude: WebSocket = None, full: bool = False):
         if docID in self.active_connections:
+            start = time.perf_counter()
             for connection in self.active_connections[docID]:
-                await connection.send_text(message)
+                # NOTE: the editor already has its own change, no need to echo it back
+                if connection is exclude:
+                    continue
+                self.outboxes[connection].send(message, droppable=True, supersedes=full)
+            broadcast_seconds.observe(time.perf_counter() - start)
+
+# Tell the master this replica got its first (or lost its last) client on a document, tokens only visit replicas with clients
+def report_editors(docID: int, present: bool):
+    async def report():
+        try:
+            await http_client.post(f"http://{MASTER_IP}:8000/editors/{docID}/", params={"IP": MY_IP, "port": MY_PORT, "present": present})
+        except Exception as e:
+            # NOTE: the next load report carries the documents with clients as well
+            logger.info(f"Failed to report clients of docID {docID} to master: {e}")
+    asyncio.create_task(report())
 
 manager = ConnectionManager()
 
+# Whether a document has to stay in memory: it has clients (or relays) here, replicated edits waiting to be applied,
+# or edits not acked by a peer yet (a peer asking for its full content gets the in memory copy)
+def document_in_use(docID: int) -> bool:
+    if manager.active_connections.get(docID) or docID in apply_queues.queues or docID in apply_queues.workers:
+        return True
+    return docID in resyncing or any(link.pending(docID) for link in replicator.links.values())
+
+# In memory copies of the documents, edits are applied here as operations
+documents = DocumentStore(document_in_use)
+
+# Periodic load reports to the master (used to place clients)
+async def send_load_report(report: dict):
+    global caught_up
+    global catching_up
+    global membership_version
+    global master_instance
+    report["catchingUp"] = catching_up
+    reply = await http_client.post(f"http://{REGISTRAR}/reportLoad/", params={"IP": MY_IP, "port": MY_PORT}, json=report)
+    reply = reply.json()
+    # NOTE: the master evicted this replica (e.g. it missed its heartbeats), join the cluster again and catch up
+    if registered.is_set() and not reply.get("Registered", True):
+        logger.info("Master no longer knows this replica, registering again")
+        registered.clear()
+        caught_up = False
+        catching_up = True
+        membership_version = -1
+        await join_cluster()
+    # NOTE: the master is at a newer membership epoch, a change was missed
+    elif reply.get("epoch", -1) > membership_version:
+        await pull_membership()
+    # NOTE: the master restarted, it got the membership and tokens back from its journal but not which tokens are in use or wanted
+    if reply.get("master") and reply["master"] != master_instance:
+        if master_instance is not None:
+            await report_tokens()
+        master_instance = reply["master"]
+
+# Tell a restarted master which tokens clients here are using (so it does not regenerate them) and which ones they wait for
+async def report_tokens():
+    in_use = [(docID, serial_of_token[docID]) for docID, queue in edit_queues.items() if queue.holder is not None and docID in serial_of_token]
+    waiting = [docID for docID, queue in edit_queues.items() if len(queue) and queue.holder is None and docID not in parked_tokens]
+    logger.info(f"Master restarted, reporting {len(in_use)} tokens in use and {len(waiting)} wanted")
+    if in_use:
+        await tokens_in_use(in_use, f"{MY_IP}:{MY_PORT}")
+    for docID in waiting:
+        await announce_demand(docID)
+
+load = LoadMonitor(lambda: {docID: manager.clients(docID) for docID in manager.active_connections}, send_load_report)
+
 
 # Function for populating queues for each document
 async def create_doc_queues():
     docList = await doc_list_db()
     for doc in docList:
         logger.info(f"Creating empty document lists for document: {doc[0]}")
-        doc_queues[int(doc[0])] = []
+        edit_queues[int(doc[0])] = EditQueue(int(doc[0]), manager.send)
+
+# Queue of clients waiting to edit a document
+def get_queue(docID: int) -> EditQueue:
+    if docID not in edit_queues:
+        edit_queues[docID] = EditQueue(docID, manager.send)
+    return edit_queues[docID]
 
 # Http post request to create a new document
+# NOTE: the master allocates the docID so the document has the same ID on every replica (without one the replica picks it)
 @app.post("/newDocID/{docName}/")
-async def create_docID(s: Session, docName: str):
-    docID = await create_document(s, docName)
-    doc_queues[docID] = [] # create queue for docID
+async def create_docID(s: Session, docName: str, docID: int = None):
+    if docID is None:
+        docID = await create_document(s, docName)
+    else:
+        await create_repl_documents(s, [(docID, docName)])
+    get_queue(docID) # create queue for docID
     return {"docID": docID}
 
-# Http post request to get docList
+# Create many documents [{"id": docID, "name": docName}, ...] at once (bulk imports and master fan-out)
+@app.post("/newDocs/")
+async def create_docs(s: Session, docs: list[DocumentList]):
+    created = await create_repl_documents(s, [(doc.id, doc.name) for doc in docs])
+    for doc in docs:
+        get_queue(doc.id)
+    return {"created": created}
+
+# Heartbeat from the master's failure detector
+@app.get("/ping/")
+async def ping():
+    return {"Message": "pong"}
+
+# Http post request to get docList, 'limit' documents at a time after docID 'after', 'prefix' filters names (ignoring case)
 @app.get("/docList/", response_model=List[DocumentList])
-async def doc_list(s: Session) -> Any:
-    docList = await s.execute(select(Document.id, Document.name))
+async def doc_list(s: Session, limit: Optional[int] = Query(None, ge=1), after: Optional[int] = None, prefix: Optional[str] = None) -> Any:
+    docList = await list_documents(s, limit, after, prefix)
     return docList
 
 
-# Updating server list to reflect any changes in the master
+# Edits a copy of the document at 'version' is missing, or the whole document if they are no longer logged
+def catch_up_frame(doc: LiveDocument, version: int) -> dict:
+    frames = doc.since(version)
+    if frames is None:
+        return doc.snapshot()
+    return {"edits": frames, "version": doc.version}
+
+# Http get request for everything that happened to a document since the given version
+@app.get("/docSince/{docID}/{version}")
+async def doc_since(s: Session, docID: int, version: int):
+    doc = await documents.get(s, docID)
+    if not doc:
+        raise HTTPException(404, f"document ID: {docID} not found")
+    return catch_up_frame(doc, version)
+
+# Same as docSince for many documents at once (docID -> version), used by replicas catching up after (re)joining
+# NOTE: documents the asking replica is not behind on are left out
+@app.post("/docsSince/")
+async def docs_since(s: Session, versions: dict[int, int]):
+    stored = await doc_versions(s)
+    reply = {}
+    for docID, version in versions.items():
+        current = documents.docs[docID].version if docID in documents.docs else stored.get(docID)
+        if current is None or version >= current:
+            continue
+        reply[docID] = catch_up_frame(await documents.get(s, docID), version)
+    return reply
+
+
+# Updating server list to reflect any changes in the master (whole view, sent when joining)
 @app.post("/updateServerList/")
-async def update_server_list(new_server_list: list[str]):
+async def update_server_list(new_server_list: list[str], version: int = None, replicationFactor: int = None):
+    global membership_version
+    global replication_factor
+    if replicationFactor is not None:
+        replication_factor = replicationFactor
+    if version is not None:
+        if version < membership_version:
+            logger.info(f"Ignoring server list version {version}, already at {membership_version}")
+            return {"message": "Stale server list ignored"}
+        membership_version = version
+    set_server_list(new_server_list)
+    return {"message": "Server list updated successfully"}
+
+# Membership change from the master {"epoch": e, "joined": [...], "left": [...]}
+# NOTE: only applied on top of the epoch before it, a replica that missed one pulls the whole view instead
+@app.post("/membershipDelta/")
+async def membership_delta(delta: dict):
+    global membership_version
+    epoch = int(delta["epoch"])
+    if epoch <= membership_version:
+        logger.info(f"Ignoring membership epoch {epoch}, already at {membership_version}")
+        return {"message": "Stale membership ignored"}
+    if membership_version < 0 or epoch != membership_version + 1:
+        asyncio.create_task(pull_membership())
+        return {"message": "Missed a membership change, pulling the whole view"}
+    membership_version = epoch
+    new_server_list = [server for server in server_list if server not in delta["left"]]
+    new_server_list += [server for server in delta["joined"] if server not in new_server_list]
+    set_server_list(new_server_list)
+    return {"message": "Server list updated successfully"}
+
+# Get the whole membership view from the master
+async def pull_membership():
+    global membership_version
+    try:
+        view = (await http_client.get(f"http://{MASTER_IP}:8000/membership/")).json()
+    except Exception as e:
+        logger.info(f"Failed to pull membership from master: {e}")
+        return
+    if view["epoch"] >= membership_version:
+        global replication_factor
+        membership_version = view["epoch"]
+        replication_factor = view.get("replicationFactor", replication_factor)
+        set_server_list(view["servers"])
+
+def set_server_list(new_server_list: list[str]):
     global server_list
     global successor
+    global caught_up
+    if f"{MY_IP}:{MY_PORT}" not in new_server_list:
+        logger.info("This replica is not in the new server list, ignoring it")
+        return
     server_list = new_server_list
+    ring.set_servers(server_list)
     index = server_list.index(f"{MY_IP}:{MY_PORT}")
     successor = (index+1) % len(server_list)
+    # open (or close) the replication links to match the new cluster
+    replicator.update_peers(server_list)
+    # NOTE: the first server list after (re)joining tells this replica who to catch up from
+    peers = [server for server in server_list if server != f"{MY_IP}:{MY_PORT}"]
+    if not caught_up:
+        caught_up = True
+        asyncio.create_task(bootstrap(peers))
     logger.info("Updated server list: ")
     logger.info(server_list)
     logger.info("Index of successor: ")
     logger.info(successor)
 
-    return {"message": "Server list updated successfully"}
-
 
 # For every document in its documement list, create a token and send it to its successor
+# NOTE: a bundle [[docID, serial], ...] in the body only initializes those tokens (used for bulk document creation)
 @app.post("/initializeTokens/")
-async def initialize_tokens(s: Session, background_task: BackgroundTasks):
+async def initialize_tokens(s: Session, bundle: Optional[list[tuple[int, int]]] = None):
+    if bundle is not None:
+        logger.info(f"INITIALIZE TOKENS ({len(bundle)})")
+        for token_id, token_serial in bundle:
+            send_token(token_id, token_serial)
+        return {"Message": "Tokens initialized"}
     logger.info("INITIALIZE TOKENS (ALL)")
     docList = await s.execute(select(Document.id, Document.name))
     logger.info(f"List of documents from db for which tokens will be generated: {docList}")
     for doc in docList:
         # NOTE: all tokens initially start with serial number 1
-        background_task.add_task(send_token, int(doc[0]), 1)
+        send_token(int(doc[0]), 1)
     return {"Message": "Tokens initialized"}
 
 
 # Create a token ONLY for the specified docID:serial-number
 @app.post("/initializeToken/{token_id}/{token_serial}/")
-async def initialize_token(token_id: int, token_serial: int, background_task: BackgroundTasks):
+async def initialize_token(token_id: int, token_serial: int):
     logger.info("INITIALIZE TOKEN (ONE)")
-    background_task.add_task(send_token, token_id, token_serial)
+    send_token(token_id, token_serial)
     return {"Message": "Token initialized"}
 
 # Handle recieving token
 @app.post("/recvToken/{token_id}/{token_serial}/")
-def recv_token(token_id: int, token_serial: int, background_task: BackgroundTasks):
+async def recv_token(token_id: int, token_serial: int):
     logger.info(f"Received token: {token_id}:{token_serial}")
+    token_received(token_id)
 
-    if doc_queues[token_id]:
-        # NOTE: Have to remember the serial number for the tokens you are using (needed for when you release the edit lock)
-        global serial_of_token
-        serial_of_token[token_id] = token_serial
-        # Get the websocket at the head of the queue
-        head = doc_queues[token_id].pop(0)
-        doc_permission[head] = True
+    if grant_token(token_id, token_serial):
         return {"Using": "true"}
     else:
-        background_task.add_task(send_token, token_id, token_serial) # NOTE: Has to run as a background task or the calling send_token function in the ancestor waits forever
+        send_token(token_id, token_serial)
         return {"Using": "false"}
 
-# Handle sending token
+# Handle recieving a bundle of tokens [[docID, serial], ...] in one request, replies with the docIDs now in use here
+@app.post("/recvTokens/")
+async def recv_tokens(tokens: list[tuple[int, int]]):
+    logger.info(f"Received {len(tokens)} tokens")
+    using = []
+    for token_id, token_serial in tokens:
+        token_received(token_id)
+        if grant_token(token_id, token_serial):
+            using.append(token_id)
+        else:
+            send_token(token_id, token_serial)
+    return {"Using": using}
+
+# Master asking for a parked token to be sent on as another replica is waiting for it
+@app.post("/forwardToken/{token_id}/")
+async def forward_token(token_id: int):
+    token_serial = parked_tokens.pop(token_id, None)
+    if token_serial is None:
+        # NOTE: token is in use or already moving, the master routes it when it is next reported
+        return {"Forwarded": "false"}
+    token_unparked(token_id)
+    send_token(token_id, token_serial)
+    return {"Forwarded": "true"}
+
+# Give the token to the client at the head of the document's queue (if anyone is waiting)
+def grant_token(token_id: int, token_serial: int) -> bool:
+    queue = get_queue(token_id)
+    # Wake the websocket at the head of the queue (and only that one)
+    if queue.grant():
+        # NOTE: Have to remember the serial number for the tokens you are using (needed for when you release the edit lock)
+        serial_of_token[token_id] = token_serial
+        queue.notify_positions()
+        return True
+    return False
+
+# Inform master the tokens are being used by clients on the given replica (stops their timers)
+async def tokens_in_use(tokens: list[tuple[int, int]], holder: str):
+    ip_port = holder.split(':')
+    await http_client.post(f"http://{MASTER_IP}:8000/tokensInUse/", json=tokens, params={"IP": ip_port[0], "port": ip_port[1]})
+
+# Client started waiting for a document, get the token here as fast as possible
+async def request_token(token_id: int):
+    queue = get_queue(token_id)
+    if token_id not in parked_tokens and queue.holder is None and len(queue) == 1:
+        # NOTE: only the first waiter advertises demand, the master has a parked token sent on right away
+        await announce_demand(token_id)
+    # NOTE: checked after the demand was recorded as the token may have been parked here in the meantime
+    if token_id in parked_tokens and queue.holder is None:
+        # Token is already here, nobody else has to be involved
+        token_serial = parked_tokens.pop(token_id)
+        if grant_token(token_id, token_serial):
+            token_unparked(token_id)
+            await tokens_in_use([(token_id, token_serial)], f"{MY_IP}:{MY_PORT}")
+        else:
+            park_token(token_id, token_serial)
+
+# Tell the master clients here are waiting for a document's token
+async def announce_demand(token_id: int):
+    await http_client.post(f"http://{MASTER_IP}:8000/tokenDemand/{token_id}/", params={"IP": MY_IP, "port": MY_PORT})
+
+# Keep a token here until someone wants it
+def park_token(token_id: int, token_serial: int):
+    parked_tokens[token_id] = token_serial
+    # NOTE: renewing a parked token sends it through the master and parks it again, it stays idle since the first time
+    parked_since.setdefault(token_id, time.monotonic())
+
+# A token that was parked here is being used or passed on
+def token_unparked(token_id: int):
+    since = parked_since.pop(token_id, None)
+    if since is not None:
+        token_idle.observe(time.monotonic() - since)
+
+# A token arrived from another replica, the time since it was last here is the time it took to come back
+def token_received(token_id: int):
+    now = time.monotonic()
+    if token_id in token_arrived:
+        token_lap.observe(now - token_arrived[token_id])
+    token_arrived[token_id] = now
+
+# Parked tokens are reported to the master regularly (all in one bundle) so it does not think they were lost
+async def renew_parked_tokens():
+    while True:
+        await asyncio.sleep(TOKEN_RENEW_INTERVAL)
+        for token_id in list(parked_tokens):
+            token_serial = parked_tokens.pop(token_id, None)
+            if token_serial is not None:
+                send_token(token_id, token_serial)
+
+# Queue a token to be passed on, every queued token leaves in the next bundle
 def send_token(token_id: int, token_serial: int):
-    # Inform master that you received the token before sending it
-    reply_master = requests.post(f"http://{MASTER_IP}:8000/replicaRecvToken/{token_id}/{token_serial}/")
-    reply_master_resp = reply_master.json()
-    logger.info(f"reply from master: {reply_master_resp}")
-    # If true then this token should not be in circulation ... let it disappear silently
-    if (reply_master_resp['Token'] == "invalid"):
-        logger.info("Invalid token detected, was not propogated...")
-        return
+    outgoing_tokens[token_id] = token_serial
+    tokens_to_send.set()
 
-    # Loop for passing token to successor ... successfully
+# Pass on the token an editor gave back, once the document is written here and the other replicas storing it have its edits
+async def release_token(document_id: int):
+    await documents.flush(document_id)
+    if not await replicator.drained(document_id):
+        logger.info(f"Peers did not ack every edit of document {document_id} in time, passing its token on anyway")
+    send_token(document_id, serial_of_token[document_id])
+
+# Sends the queued tokens as bundles: one report to the master and one request per destination replica
+async def token_sender():
+    global outgoing_tokens
     while True:
+        await tokens_to_send.wait()
+        if TOKEN_MODE == "ring":
+            await asyncio.sleep(TOKEN_HOP_DELAY)
+        tokens_to_send.clear()
+        bundle, outgoing_tokens = outgoing_tokens, {}
         try:
-            global successor
-            global server_list
-
-            time.sleep(2)
-            logger.info(f"Server_list before call to recvToken: {server_list}")
-            with succ_lock:
-                succ_server = server_list[successor]
-            logger.info("Sending token")
-            reply_succ = requests.post(f"http://{succ_server}/recvToken/{token_id}/{token_serial}/")
-            reply_succ_resp = reply_succ.json()
-            logger.info(f"reply for recvToken to successor: {reply_succ_resp}")
-            if (reply_succ_resp['Using'] == "true"):
-                reply_token_use = requests.post(f"http://{MASTER_IP}:8000/tokenInUse/{token_id}/{token_serial}/")
-            
-            logger.info(f"Sent token ({token_id}:{token_serial}) to {succ_server}")
-            break # done if post request returned successfully
-        
+            await send_tokens(bundle)
         except Exception as e:
+            logger.info(f"Failed to send token bundle, trying again: {e}")
+            for token_id, token_serial in bundle.items():
+                outgoing_tokens.setdefault(token_id, token_serial)
+            tokens_to_send.set()
+            await asyncio.sleep(1)
 
-            logger.info(f"handling send_token exceptions: {e}")
-            logger.info(f"Current successor index: {successor}")
+async def send_tokens(bundle: dict[int, int]):
+    # Inform master that you received the tokens before sending them
+    reply_master = await http_client.post(f"http://{MASTER_IP}:8000/replicaRecvTokens/", json=list(bundle.items()), params={"IP": MY_IP, "port": MY_PORT, "mode": TOKEN_MODE})
+    reply_master_resp = reply_master.json()
+    logger.info(f"reply from master: {reply_master_resp}")
 
-            # inform master of replica crash
-            bad_ip_port = succ_server.split(':')
-            reply = requests.post(f"http://{MASTER_IP}:8000/replicaCrashed/{bad_ip_port[0]}/{bad_ip_port[1]}/")
+    destinations: dict[str, list[tuple[int, int]]] = {}
+    used_here = []
+    for token_id, token_serial in bundle.items():
+        # If true then this token should not be in circulation ... let it disappear silently
+        if token_id not in reply_master_resp["valid"]:
+            logger.info(f"Invalid token {token_id}:{token_serial} detected, was not propogated...")
+            continue
+        # NOTE: json object keys are strings
+        next_server = reply_master_resp["next"].get(str(token_id))
+        if not next_server:
+            # No other replica needs it, use it here if a client started waiting, otherwise park it here
+            if grant_token(token_id, token_serial):
+                token_unparked(token_id)
+                used_here.append((token_id, token_serial))
+            else:
+                park_token(token_id, token_serial)
+            continue
+        token_unparked(token_id)
+        destinations.setdefault(next_server, []).append((token_id, token_serial))
 
-            # pop the bad successor out of the local ring if it exists in the server list
-            # within a lock to avoid duplicate modfications
-            with succ_lock:
-                if succ_server in server_list:
-                    succ_index = server_list.index(succ_server)
-                    server_list.pop(succ_index)
-                    # set new successor
-                    index = server_list.index(f"{MY_IP}:{MY_PORT}")
-                    successor = (index+1) % len(server_list)
+    if used_here:
+        await tokens_in_use(used_here, f"{MY_IP}:{MY_PORT}")
+    # NOTE: every destination gets its bundle concurrently
+    await asyncio.gather(*[pass_tokens(server, tokens) for server, tokens in destinations.items()])
+    # NOTE: the master took this replica out of the token's demand when it sent the token on, clients still waiting here
+    # (they queued behind a local holder, only the first waiter announces itself) have to be announced again or the token
+    # would stay parked wherever it goes next
+    for tokens in destinations.values():
+        for token_id, _ in tokens:
+            if len(get_queue(token_id)):
+                await announce_demand(token_id)
 
-            logger.info(f"Successor updated to index: {successor}")
+# Pass a bundle of tokens to another replica
+async def pass_tokens(succ_server: str, tokens: list[tuple[int, int]]):
+    try:
+        logger.info(f"Sending {len(tokens)} tokens to {succ_server}")
+        reply_succ = await http_client.post(f"http://{succ_server}/recvTokens/", json=tokens)
+        using = reply_succ.json()["Using"]
+        logger.info(f"reply for recvTokens to {succ_server}: {using}")
+        if using:
+            await tokens_in_use([token for token in tokens if token[0] in using], succ_server)
 
-            continue # try again (done in loop to avoid recursion)
+    except Exception as e:
 
+        logger.info(f"handling send_token exceptions: {e}")
+        logger.info(f"Current successor index: {successor}")
 
+        # inform master of replica crash
+        bad_ip_port = succ_server.split(':')
+        await http_client.post(f"http://{MASTER_IP}:8000/replicaCrashed/{bad_ip_port[0]}/{bad_ip_port[1]}/")
+
+        # pop the bad successor out of the local ring if it exists in the server list
+        remove_peer(succ_server)
+
+        logger.info(f"Successor updated to index: {successor}")
+
+        for token_id, token_serial in tokens:
+            # Keep it here, the master routes it again when it is next reported
+            park_token(token_id, token_serial)
+
+
+# NOTE: 'relay' is set by read-only relays subscribing to the document's edits for their viewers
 @app.websocket("/ws/{document_id}/{docName}/{editPerm}/")
-async def websocket_endpoint(websocket: WebSocket, document_id: int, docName: str, editPerm: str, s: Session):
-    global server_list
-    global successor
+async def websocket_endpoint(websocket: WebSocket, document_id: int, docName: str, editPerm: str, since: Optional[int] = None, relay: bool = False):
 
     logger.info("editPerm:")
     logger.info(editPerm)
-    await manager.connect(document_id, websocket)
+    await manager.connect(document_id, websocket, relay)
 
     logger.info(f"{document_id} {docName}")
-    doc = await read_document(s, document_id)
+    # NOTE: the database is only needed to load the document, a session held for the whole connection would tie up
+    # a pooled database connection per client
+    async with SessionMaker() as s:
+        doc = await get_document(s, document_id)
+    queue = get_queue(document_id)
 
     if editPerm == "true":
-        await websocket.send_text("*** START EDITING ***")
+        manager.send(websocket, "*** START EDITING ***")
     
-    await websocket.send_text(doc.content)
+    # NOTE: the client gets the whole document (and its version) once, after that only operations are sent
+    # a reconnecting client that already has the document up to version 'since' only gets the edits it missed
+    if since is None:
+        manager.send(websocket, json.dumps(doc.snapshot()))
+    else:
+        manager.send(websocket, json.dumps(catch_up_frame(doc, since)))
 
     try:
         while True:
             if editPerm == "true":
-                doc_permission[websocket] = True # Client was editing before disconnect, so let them continue editing
+                queue.holder = websocket # Client was editing before disconnect, so let them continue editing
                 editPerm = "false" # following requests to edit will have to jump through regular permission logic
 
             else:
                 # Data is client request to edit
                 data = await websocket.receive_text()
-                logger.info(data)
-                # add the client to the queue of websockets waiting for that document
-                doc_queues[document_id].append(websocket)
-                logger.info(f"Adding websocket to queue for docID: {document_id}")
-                doc_permission[websocket] = False
-            
-                # Loop the socket while you don't have permission
-                while not doc_permission[websocket]:
-                    logger.info(f"{doc_permission[websocket]}")
-                    logger.info("Waiting for permission")
-                    await asyncio.sleep(2)
+                # Client missed an operation, send it the whole document instead of queueing it
+                if json.loads(data).get("resync"):
+                    manager.send(websocket, json.dumps(doc.snapshot()))
                     continue
+                # add the client to the queue of websockets waiting for that document
+                granted = queue.join(websocket)
+                queue.notify_positions()
+                await request_token(document_id)
+
+                # Wait for the token to be handed to this client, still answering resync requests in the meantime
+                logger.info("Waiting for permission")
+                while not granted.done():
+                    receive = asyncio.ensure_future(websocket.receive_text())
+                    await asyncio.wait({granted, receive}, return_when=asyncio.FIRST_COMPLETED)
+                    # NOTE: the pending receive has to be fully cancelled before the socket can be read again
+                    receive.cancel()
+                    try:
+                        data = await receive
+                    except asyncio.CancelledError:
+                        continue
+                    except WebSocketDisconnect:
+                        queue.leave(websocket)
+                        queue.notify_positions()
+                        raise
+                    if json.loads(data).get("resync"):
+                        manager.send(websocket, json.dumps(doc.snapshot()))
 
-                await websocket.send_text("*** START EDITING ***")
+                manager.send(websocket, "*** START EDITING ***")
 
             logger.info("telling client, lock acquired")
 
@@ -276,93 +708,402 @@ async def websocket_endpoint(websocket: WebSocket, document_id: int, docName: st
                 data = await websocket.receive_text()
                 # parse data json
                 json_data = json.loads(data)
-                data = json_data['content']
-                if (data == "*** STOP EDITING ***"):
+                if (json_data.get('content') == "*** STOP EDITING ***"):
                     logger.info("Client said done editing")
-                    doc_permission[websocket] = False
-                    send_token(document_id, serial_of_token[document_id])
+                    queue.release(websocket)
+                    await release_token(document_id)
                     break
 
-                logger.info("Content: ")
-                logger.info(data)
-
-                # Update document in this replica's database
-                doc = await update_document(s, DocumentUpdate(content=data, id=document_id, name=docName))
-                # NOTE: Broadcast changes to any websockets on THIS replica working on that document
-                await manager.broadcast(document_id, data)
+                if json_data.get("resync"):
+                    manager.send(websocket, json.dumps(doc.snapshot()))
+                    continue
 
-                for server_info in server_list:
-                    server = server_info.split(':')
-                    # Don't update yourself
-                    if server[0] == MY_IP and server[1] == MY_PORT:
+                if "op" in json_data:
+                    # NOTE: an operation is only valid against the version the client based it on,
+                    # otherwise ask the client to fall back to sending the full content
+                    if json_data.get("version") != doc.version:
+                        logger.info(f"Operation based on version {json_data.get('version')} but document is at {doc.version}, asking for full content")
+                        manager.send(websocket, json.dumps({"resync": True, "version": doc.version}))
                         continue
                     try:
-                        response = await connect_to_replica(document_id, docName, doc.content, server[0], server[1])
-                    except TimeoutError:
-                        if server_info in server_list:
-                            server_list.remove(server_info)
-                            logger.info("Server_list after removing server which caused the time out: ")
-                            logger.info(server_list)
-                            # set new successor
-                            index = server_list.index(f"{MY_IP}:{MY_PORT}")
-                            successor = (index+1) % len(server_list)
-                            continue
+                        doc.apply(json_data["op"])
+                    except InvalidOperation as e:
+                        logger.info(f"Rejected operation: {e}")
+                        manager.send(websocket, json.dumps({"resync": True, "version": doc.version}))
+                        continue
+                    frame = {"op": json_data["op"], "version": doc.version}
+                else:
+                    doc.replace(json_data["content"])
+                    frame = doc.snapshot()
+
+                # NOTE: the trace ID goes with the edit to the other replicas (a client may send its own)
+                trace = json_data.get("trace") or new_trace_id()
+                log_edit(f"Edit to document {document_id} from client", trace, frame)
+                message = json.dumps(frame)
+                client_edits.inc()
+
+                # Update document in this replica's database (written behind, see documents.py)
+                documents.mark_dirty(document_id)
+                load.record_edit(document_id)
+                # NOTE: Broadcast changes to any websockets on THIS replica working on that document
+                manager.broadcast(document_id, message, exclude=websocket, full="op" not in frame)
+
+                # NOTE: only queues the edit on each peer's replication link, the links send concurrently
+                replicator.replicate({"doc": document_id, "name": docName, **frame, "trace": trace}, peers_of(document_id))
     except WebSocketDisconnect:
         manager.disconnect(document_id, websocket)
-        # Inform server you lost a connection from a client (NOTE: Master is hard coded to be on localhost port 8000)
-        response = requests.post(f"http://{MASTER_IP}:8000/lostClient/{MY_IP}/{MY_PORT}/")
         # If client closes tab without pressing stop editing, then pass the token along
-        if websocket in doc_permission:
-            if doc_permission[websocket] == True:
-                send_token(document_id, serial_of_token[document_id])
-        logger.info(response)
+        if queue.holder is websocket:
+            queue.release(websocket)
+            await release_token(document_id)
+        # Inform server you lost a connection from a client (NOTE: Master is hard coded to be on localhost port 8000)
+        try:
+            response = await http_client.post(f"http://{MASTER_IP}:8000/lostClient/{MY_IP}/{MY_PORT}/", params={"docID": document_id})
+            logger.info(response)
+        except Exception as e:
+            logger.info(f"Failed to inform master of the lost client: {e}")
         # Then disconnect
 
 
-# create websocket to connect to replica
-async def connect_to_replica(document_id: int, docName: str, content: str, IP: str, port: str):
-    uri = f"ws://{IP}:{port}/replica/ws/{document_id}/{docName}"
+# Get the edits this replica missed while it was down from the other replicas storing its documents
+async def catch_up(peers: list[str]):
+    async with SessionMaker() as s:
+        versions = await doc_versions(s)
+        versions.update({docID: doc.version for docID, doc in documents.docs.items()})
+        by_peer: dict[str, dict[int, int]] = {}
+        for docID, version in versions.items():
+            by_peer.setdefault((peers_of(docID) or peers)[0], {})[docID] = version
+
+        for peer, peer_versions in by_peer.items():
+            try:
+                reply = await http_client.post(f"http://{peer}/docsSince/", json=peer_versions, timeout=30)
+                missed = reply.json()
+            except Exception as e:
+                logger.info(f"Failed to catch up from {peer}: {e}")
+                continue
+
+            for docID, frame in missed.items():
+                # NOTE: edits replicated since joining may already have moved the document on, those frames are skipped
+                for edit in frame.get("edits", [frame]):
+                    doc = await documents.get(s, int(docID))
+                    if doc and edit["version"] <= doc.version:
+                        continue
+                    if not await apply_in_order({"doc": int(docID), **edit}):
+                        break
+            logger.info(f"Caught up on {len(missed)} documents from {peer}")
+
+# Get up to date after (re)joining the cluster: the edits missed on the documents this replica has, then a copy of the
+# documents it should store but does not have, then tell the master clients can be placed here
+async def bootstrap(peers: list[str]):
+    global catching_up
+    if peers:
+        await catch_up(peers)
+        copied = await asyncio.gather(*[copy_snapshot(peer) for peer in peers])
+        logger.info(f"Copied {sum(copied)} documents from {len(peers)} peers")
+    catching_up = False
     try:
-        async with websockets.connect(uri) as websocket:
-            print(f"Connected to replica {uri}")
-            await websocket.send(json.dumps({
-                "content": content
-            }))
-            response = await websocket.recv()
-            print(response, f", {MY_PORT}")
-            return response
-    except ConnectionRefusedError:
-        print(f"Failed to connect to {uri}. Connection refused.")
-        raise TimeoutError # NOTE: TEMP CHANGE, DEAL WITH EXCEPTIONS PROPERLY
+        await http_client.post(f"http://{REGISTRAR}/caughtUp/", params={"IP": MY_IP, "port": MY_PORT})
     except Exception as e:
-        print(f"An error occurred: {e}")
-        raise
+        logger.info(f"Failed to tell master this replica caught up, the next load report does: {e}")
+
+# Copy the documents this replica should store from one peer, a chunk at a time, returns the number of documents copied
+async def copy_snapshot(peer: str) -> int:
+    copied = 0
+    after = 0
+    while after is not None:
+        try:
+            reply = await http_client.get(f"http://{peer}/snapshot/", params={"owner": f"{MY_IP}:{MY_PORT}", "epoch": membership_version, "after": after}, timeout=60)
+            reply.raise_for_status()
+            chunk = reply.json()
+        except Exception as e:
+            # NOTE: documents that were not copied are fetched from a peer when they are first used
+            logger.info(f"Failed to copy documents from {peer}: {e}")
+            return copied
+        copied += await store_snapshot(chunk["docs"])
+        after = chunk["next"]
+    return copied
+
+# Store copies of documents [{"id", "name", "content", "version"}, ...] that are newer than the ones here
+async def store_snapshot(docs: list[dict]) -> int:
+    if not docs:
+        return 0
+    ids = [doc["id"] for doc in docs]
+    contents: dict[int, str] = {}
+    entries: list[EditLog] = []
+    compact: dict[int, int] = {}
+    async with SessionMaker() as s:
+        await create_repl_documents(s, [(doc["id"], doc["name"]) for doc in docs])
+        stored = await doc_versions(s, ids)
+        for doc in docs:
+            docID, version = doc["id"], doc["version"]
+            get_queue(docID)
+            if docID in documents.docs:
+                # NOTE: documents in memory may be getting edits right now, the copy goes through their apply queue
+                if documents.docs[docID].version < version:
+                    await apply_in_order({"doc": docID, "name": doc["name"], "content": doc["content"], "version": version})
+            elif stored.get(docID, 0) < version:
+                # NOTE: written as the document's only log entry, so the version is right when it is loaded
+                contents[docID] = doc["content"]
+                entries.append(EditLog(doc_id=docID, version=version, frame=json.dumps({"content": doc["content"], "version": version})))
+                compact[docID] = version
+        if contents:
+            await update_documents(s, contents, entries, compact=compact)
+    return len(docs)
 
-# websocket connections for replication
+# A chunk of the documents 'owner' should store that this replica is the first other replica of, in docID order after 'after'
+# NOTE: used by replicas (re)joining the cluster, 'next' is where the following chunk starts (null after the last one).
+# Every document comes with the content and version it had at the same moment (from memory if it is loaded)
+@app.get("/snapshot/")
+async def snapshot(s: Session, owner: str, epoch: int = -1, after: int = 0, limit: int = Query(SNAPSHOT_CHUNK, ge=1)):
+    # NOTE: the joining replica may already know about a membership change this one has not been told about
+    if epoch > membership_version:
+        await pull_membership()
+    me = f"{MY_IP}:{MY_PORT}"
+    rows = (await list_documents(s, limit, after)).all()
+    ids = []
+    for docID, _ in rows:
+        servers = replica_set(docID)
+        if owner in servers and [server for server in servers if server != owner][:1] == [me]:
+            ids.append(docID)
+    stored = await doc_versions(s, [docID for docID in ids if docID not in documents.docs])
+    docs = []
+    for doc in await read_documents(s, [docID for docID in ids if docID not in documents.docs]):
+        docs.append({"id": doc.id, "name": doc.name, "content": doc.content, "version": stored.get(doc.id, 0)})
+    for docID in ids:
+        if docID in documents.docs:
+            live = documents.docs[docID]
+            docs.append({"id": docID, "name": live.name, **live.snapshot()})
+    return {"docs": docs, "next": rows[-1][0] if len(rows) == limit else None}
+
+# Replicas storing a document and the other replicas storing it (the ones its edits are replicated to)
+def replica_set(docID: int) -> list[str]:
+    return ring.replicas(docID, replication_factor)
+
+def peers_of(docID: int) -> list[str]:
+    return [server for server in replica_set(docID) if server != f"{MY_IP}:{MY_PORT}"]
+
+# The document from memory or the database, fetched from another replica if this one does not have it yet
+# NOTE: happens after membership changes, consistent hashing hands some documents to replicas that never stored them
+async def get_document(s: Session, docID: int) -> Optional[LiveDocument]:
+    doc = await documents.get(s, docID)
+    if doc:
+        return doc
+    others = peers_of(docID) + [server for server in server_list if server not in peers_of(docID) and server != f"{MY_IP}:{MY_PORT}"]
+    for peer in others:
+        try:
+            reply = await http_client.get(f"http://{peer}/document/{docID}/")
+        except Exception as e:
+            logger.info(f"Failed to fetch document {docID} from {peer}: {e}")
+            continue
+        if reply.status_code == 200:
+            break
+    else:
+        return None
+    data = reply.json()
+    logger.info(f"Fetched document {docID} (version {data['version']}) from {peer}")
+    await create_repl_documents(s, [(docID, data["name"])])
+    doc = await documents.get(s, docID)
+    if doc.version < data["version"]:
+        doc.replace(data["content"], data["version"])
+        documents.mark_dirty(docID)
+    get_queue(docID)
+    return doc
+
+# Http get request for the whole document (used by replicas that have to start storing it)
+@app.get("/document/{docID}/")
+async def get_whole_document(s: Session, docID: int):
+    doc = await documents.get(s, docID)
+    if not doc:
+        raise HTTPException(404, f"document ID: {docID} not found")
+    return {"id": doc.id, "name": doc.name, **doc.snapshot()}
+
+# Peer can't be reached over its replication link, drop it from the local ring
+def remove_peer(server_info: str):
+    global successor
+    with succ_lock:
+        if server_info in server_list:
+            server_list.remove(server_info)
+            ring.remove(server_info)
+            logger.info("Server_list after removing server which caused the time out: ")
+            logger.info(server_list)
+            # set new successor
+            index = server_list.index(f"{MY_IP}:{MY_PORT}")
+            successor = (index+1) % len(server_list)
+
+# Full content of a document, sent to a peer that is behind
+def replication_snapshot(docID: int):
+    if docID not in documents.docs:
+        return None
+    doc = documents.docs[docID]
+    return {"doc": docID, "name": doc.name, **doc.snapshot()}
+
+replicator = Replicator(f"{MY_IP}:{MY_PORT}", replication_snapshot, remove_peer)
+
+# Documents waiting for their full content after a replicated edit could not be applied (docID -> when it was asked for)
+resyncing: dict[int, float] = {}
+
+# Apply one replicated edit, returns False if this replica is behind and needs the full content
+# NOTE: only called through apply_queues, edits of a document are applied one at a time in the order they were received
+async def apply_replicated_edit(edit: dict) -> bool:
+    document_id = int(edit["doc"])
+    doc = documents.docs.get(document_id)
+    if not doc:
+        async with SessionMaker() as s:
+            doc = await get_document(s, document_id)
+    if not doc:
+        logger.info(f"Replicated edit for unknown document {document_id}")
+        return True
+
+    if "op" in edit:
+        # NOTE: operations have to be applied in order, anything but the next version means this replica is out of sync
+        # the edits after it are skipped until the full content arrives (asked for again if it takes too long)
+        try:
+            if edit["version"] <= doc.version:
+                # NOTE: an edit sent again after a reconnect is already applied, a different edit at a version this replica
+                # already has means two replicas went different ways from there
+                logged = next((frame for frame in reversed(doc.log) if frame["version"] == edit["version"]), None)
+                if logged is None or "op" not in logged or logged["op"] == validate_op(edit["op"]):
+                    return True
+                raise InvalidOperation(f"conflicting edit at version {edit['version']}")
+            if edit["version"] != doc.version + 1:
+                raise InvalidOperation(f"expected version {doc.version + 1}, got {edit['version']}")
+            doc.apply(edit["op"])
+        except InvalidOperation as e:
+            logger.info(f"[trace {edit.get('trace')}] Replicated edit to document {document_id} not applied: {e}")
+            now = time.monotonic()
+            if now - resyncing.get(document_id, -RESYNC_RETRY) < RESYNC_RETRY:
+                return True
+            resyncing[document_id] = now
+            return False
+        frame = {"op": edit["op"], "version": doc.version}
+    else:
+        # NOTE: a content frame sent again (or overtaken by later edits) would take the document back to an older version,
+        # one at the version this replica is at but with other content is the answer to a resync (or conflict) and replaces it
+        version = edit.get("version")
+        if version is not None and (version < doc.version or (version == doc.version and edit["content"] == doc.content)):
+            return True
+        doc.replace(edit["content"], version)
+        resyncing.pop(document_id, None)
+        frame = doc.snapshot()
+    log_edit(f"Replicated edit to document {document_id} applied", edit.get("trace"), frame)
+    replicated_edits.inc()
+
+    # Update the document in your replicate database (written behind, see documents.py)
+    documents.mark_dirty(document_id)
+    # NOTE: Broadcast changes to any clients who might be waiting to edit the document
+    manager.broadcast(document_id, json.dumps(frame), full="op" not in frame)
+    return True
+
+apply_queues = ApplyQueues(apply_replicated_edit)
+
+metrics.Gauge("sharenotes_clients", "Connected client websockets", lambda: len(manager.outboxes))
+metrics.Gauge("sharenotes_relay_subscriptions", "Relays subscribed to a document here (counted in the client websockets too)", lambda: len(manager.relays))
+metrics.Gauge("sharenotes_documents_loaded", "Documents in memory", lambda: len(documents.docs))
+metrics.Gauge("sharenotes_documents_dirty", "Documents waiting to be written to SQLite", lambda: len(documents.dirty))
+metrics.Gauge("sharenotes_edit_queue_waiting", "Clients waiting for the edit lock, over every document", lambda: sum(len(queue) for queue in edit_queues.values()))
+metrics.Gauge("sharenotes_edit_queue_longest", "Clients waiting for the edit lock of the document with the longest queue", lambda: max((len(queue) for queue in edit_queues.values()), default=0))
+metrics.Gauge("sharenotes_apply_queue_edits", "Replicated edits waiting to be applied", lambda: len(apply_queues))
+metrics.Gauge("sharenotes_tokens_parked", "Tokens parked here", lambda: len(parked_tokens))
+metrics.Gauge("sharenotes_replication_queued_edits", "Edits waiting to be sent to a peer", lambda: {peer: len(link.outbox) for peer, link in replicator.links.items()}, label="peer")
+metrics.Gauge("sharenotes_replication_in_flight_batches", "Batches sent to a peer and not acked yet", lambda: {peer: len(link.in_flight) for peer, link in replicator.links.items()}, label="peer")
+
+# Apply a replicated edit after the ones already queued for its document
+async def apply_in_order(edit: dict) -> bool:
+    applied = asyncio.get_running_loop().create_future()
+    apply_queues.submit(edit, applied.set_result)
+    return await applied
+
+# websocket connections for replication, one connection carries batches of edits for any document
+# NOTE: the document in the path is only used for single (unbatched) frames
+# Batches are acked (cumulatively, in order) depending on REPLICATION_ACK: "received" as soon as their edits are queued,
+# "applied" once every edit is applied in memory (and broadcast to clients here), "persisted" once they are also written to
+# the database. An edit that cannot be applied is reported when that is known ({"ack": <last acked>, "resync": [docID]})
+@app.websocket("/replica/ws/")
 @app.websocket("/replica/ws/{document_id}/{docName}")
-async def replica_websocket_endpoint(websocket: WebSocket, document_id: int, docName: str, s: Session):
-    await manager.connect(document_id, websocket)
-    print(f"Connected to document {document_id} with name {docName}")
+async def replica_websocket_endpoint(websocket: WebSocket, document_id: int = None, docName: str = None):
+    # NOTE: not registered with the manager, the sending replica is not a client and should not get broadcasts
+    await websocket.accept()
+    logger.info("Replication link accepted")
+    binary = codec.BINARY
+    replies: asyncio.Queue[dict] = asyncio.Queue()
+    # Batches not acked yet, in the order received (seq -> edits not applied yet)
+    unacked: dict[int, int] = {}
+    acked = 0
+
+    async def send_replies():
+        while True:
+            reply = await replies.get()
+            await send_replication_reply(websocket, reply, binary)
+
+    async def ack_persisted(seq: int):
+        nonlocal acked
+        while not await documents.flush():
+            await asyncio.sleep(FLUSH_INTERVAL)
+        acked = max(acked, seq)
+        replies.put_nowait({"ack": acked, "resync": []})
 
-    doc = await read_document(s, document_id)
+    def batch_done():
+        nonlocal acked
+        done = None
+        while unacked and unacked[next(iter(unacked))] == 0:
+            done = next(iter(unacked))
+            del unacked[done]
+        if done is None:
+            return
+        if REPLICATION_ACK == "persisted":
+            asyncio.create_task(ack_persisted(done))
+        else:
+            acked = done
+            replies.put_nowait({"ack": done, "resync": []})
 
+    def edit_done(seq: int, docID: int, applied: bool):
+        if not applied:
+            replies.put_nowait({"ack": acked, "resync": [docID]})
+        if seq in unacked:
+            unacked[seq] -= 1
+            batch_done()
+
+    sender = asyncio.create_task(send_replies())
     try:
         while True:
-            data = await websocket.receive_text()
-            print(docName)
-            print(data)
-            # parse data json
-            data = json.loads(data)['content']
-
-            # Update the document in your replicate database
-            doc = await update_document(s, DocumentUpdate(content=data, id=document_id, name=docName))
-            # NOTE: Broadcast changes to any clients who might be waiting to edit the document
-            await manager.broadcast(document_id, data)
-
-            await websocket.send_text(f"ack from replica {MY_PORT}")
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            # NOTE: binary frames are msgpack, text frames JSON, the acks go back in the same format
+            binary = message.get("bytes") is not None
+            batch = codec.decode(message["bytes"] if binary else message["text"])
+
+            if "edits" not in batch:
+                # Single edit for the document in the path
+                in_sync = await apply_in_order({"doc": document_id, "name": docName, **batch})
+                await send_replication_reply(websocket, {"ack": MY_PORT, "resync": not in_sync}, binary)
+                continue
+
+            seq = batch["seq"]
+            if REPLICATION_ACK != "received":
+                unacked[seq] = len(batch["edits"])
+            for edit in batch["edits"]:
+                apply_queues.submit(edit, lambda applied, seq=seq, docID=int(edit["doc"]): edit_done(seq, docID, applied))
+            if REPLICATION_ACK == "received":
+                acked = seq
+                replies.put_nowait({"ack": seq, "resync": []})
+            else:
+                batch_done() # NOTE: for empty batches
     except WebSocketDisconnect:
-        manager.disconnect(document_id, websocket)
-        print(f"Connection closed with exception")
+        logger.info("Replication link closed")
+    finally:
+        sender.cancel()
+
+async def send_replication_reply(websocket: WebSocket, reply: dict, binary: bool):
+    if binary:
+        await websocket.send_bytes(codec.encode(reply, binary))
+    else:
+        await websocket.send_text(codec.encode(reply, binary))
+
+# Metrics of this replica in the Prometheus text format
+@app.get("/metrics/")
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 # For demoing
 @app.post("/createDoc/", response_model=Document)
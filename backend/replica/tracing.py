@@ -0,0 +1,29 @@
+from __future__ import annotations
+from typing import Optional
+import logging
+import os
+import random
+import uuid
+import zlib
+
+logger = logging.getLogger("uvicorn")
+
+# NOTE: Every edit made by a client gets a trace ID where it is made, the ID travels with the edit on the replication links
+# (the "trace" field of the replicated edit) so the logs of the replicas applying it can be matched up.
+# Edit frames (which carry document content) are not logged by default, CONTENT_LOG_SAMPLE is the fraction of edits
+# that are (1 logs every edit, only meant for debugging: logging content on every keystroke slows the replica down)
+CONTENT_LOG_SAMPLE = float(os.getenv("CONTENT_LOG_SAMPLE", "0"))
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+# Log an edit frame (content included) if this edit is sampled
+# NOTE: sampled by trace ID, so an edit logged where it was made is logged by every replica applying it as well
+def log_edit(event: str, trace: Optional[str], frame: dict) -> None:
+    if not CONTENT_LOG_SAMPLE:
+        return
+    sample = zlib.crc32(trace.encode()) / 0x100000000 if trace else random.random()
+    if sample < CONTENT_LOG_SAMPLE:
+        logger.info(f"[trace {trace}] {event}: {frame}")
@@ -0,0 +1,76 @@
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import socket
+import tempfile
+import uvicorn
+
+logger = logging.getLogger("uvicorn")
+
+# NOTE: A replica can run as a router (router.py) in front of several worker processes, each one running server.py for its
+# share of the documents (docID modulo the number of workers). All the state of a document (its in memory copy, edit
+# queue, token and clients) lives in one worker, so edits of different documents are handled on different cores and
+# broadcasts never leave the worker. The router hands a client's websocket to its document's worker as it connects
+# (the connected socket itself, passed over a unix socket), the worker then serves it without the router in the middle.
+# Every other request reaches the workers through the router, over one unix socket per worker
+
+
+# Worker storing a document
+def owner(docID: int, workers: int) -> int:
+    return docID % workers
+
+
+# Unix socket a worker (or the router itself) serves HTTP on
+def worker_socket(port: str, worker) -> str:
+    return os.path.join(tempfile.gettempdir(), f"sharenotes_{port}_{worker}.sock")
+
+
+# uvicorn server that also serves connections accepted by another process (handed over as file descriptors)
+class HandoffServer(uvicorn.Server):
+    def __init__(self, config: uvicorn.Config) -> None:
+        super().__init__(config)
+        self.ready = asyncio.Event()
+        self.handoffs: set[asyncio.Task] = set()
+
+    async def startup(self, sockets=None) -> None:
+        await super().startup(sockets)
+        self.ready.set()
+
+    # Serve a connection accepted elsewhere as if this server had accepted it
+    async def serve_connection(self, sock: socket.socket) -> None:
+        await self.ready.wait()
+        sock.setblocking(False)
+        # NOTE: the same protocol uvicorn creates for every connection it accepts itself, so shutdown closes these too
+        protocol = self.config.http_protocol_class(config=self.config, server_state=self.server_state, app_state=self.lifespan.state)
+        await asyncio.get_running_loop().connect_accepted_socket(lambda: protocol, sock)
+
+    # Serve every connection the router sends on 'channel' (a unix datagram socket)
+    def receive_handoffs(self, channel: socket.socket) -> None:
+        channel.setblocking(False)
+
+        def receive():
+            try:
+                _, fds, _, _ = socket.recv_fds(channel, 1, 16)
+            except BlockingIOError:
+                return
+            for fd in fds:
+                task = asyncio.create_task(self.serve_connection(socket.socket(fileno=fd)))
+                self.handoffs.add(task)
+                task.add_done_callback(self.handoffs.discard)
+
+        asyncio.get_running_loop().add_reader(channel.fileno(), receive)
+
+
+async def main() -> None:
+    worker = int(os.environ["WORKER"])
+    config = uvicorn.Config("server:app", uds=worker_socket(os.environ["PORT"], worker), log_level=os.getenv("LOG_LEVEL", "info"))
+    server = HandoffServer(config)
+    server.receive_handoffs(socket.socket(fileno=int(os.environ["HANDOFF_FD"])))
+    await server.serve()
+
+
+# Started by router.py, one process per worker
+if __name__ == "__main__":
+    uvicorn.Config("server:app").setup_event_loop()
+    asyncio.run(main())
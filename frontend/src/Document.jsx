@@ -3,6 +3,25 @@ import { useLocation, useNavigate } from "react-router-dom";
 import { useParams } from "react-router-dom";
 import "./App.css";
 
+// Smallest single splice turning prev into next (edits from a textarea are contiguous)
+function diffOp(prev, next) {
+  let start = 0;
+  while (start < prev.length && start < next.length && prev[start] === next[start]) {
+    start++;
+  }
+  let endPrev = prev.length;
+  let endNext = next.length;
+  while (endPrev > start && endNext > start && prev[endPrev - 1] === next[endNext - 1]) {
+    endPrev--;
+    endNext--;
+  }
+  return { pos: start, delete: endPrev - start, insert: next.slice(start, endNext) };
+}
+
+function applyOp(text, op) {
+  return text.slice(0, op.pos) + op.insert + text.slice(op.pos + op.delete);
+}
+
 export default function Document() {
   const [textValue, setTextValue] = useState("");
 
@@ -10,6 +29,9 @@ export default function Document() {
 
   const { ip, port, id, docName } = useParams();
 
+  // Opened to only view the document (see Home.jsx), the client never asks to edit and reconnects to a relay if it can
+  const VIEW_ONLY = new URLSearchParams(useLocation().search).get("view") === "true";
+
   const [webSocket, setWebSocket] = useState(null);
 
   const [canEdit, setCanEdit] = useState(false);
@@ -18,8 +40,17 @@ export default function Document() {
 
   const [isReconnecting, setIsReconnecting] = useState(false);
 
+  // Position in the queue of clients waiting to edit and the replica's estimate of the wait (seconds)
+  const [queueInfo, setQueueInfo] = useState(null);
+
   const CAN_EDIT = useRef(canEdit);
 
+  // Latest text and the version of the document it corresponds to (needed to send and apply operations)
+  const TEXT = useRef("");
+  const VERSION = useRef(0);
+  // Set once the document was received, a reconnect then only asks for the edits made since VERSION
+  const HAS_DOC = useRef(false);
+
   let navigate = useNavigate();
   useEffect(() => {
     connectWebSocket(ip, port);
@@ -43,6 +74,7 @@ export default function Document() {
         CAN_EDIT.current +
         "/"
     );
+    const since = HAS_DOC.current ? "?since=" + VERSION.current : "";
     const ws = new WebSocket(
       "ws://" +
         ip +
@@ -54,7 +86,8 @@ export default function Document() {
         docName +
         "/" +
         CAN_EDIT.current +
-        "/"
+        "/" +
+        since
     );
 
     ws.onopen = () => {
@@ -67,18 +100,34 @@ export default function Document() {
 
       if (event.data === "*** START EDITING ***") {
         setIsLoading(false);
+        setQueueInfo(null);
         CAN_EDIT.current = true;
         console.log("CAN_EDIT.current " + CAN_EDIT.current);
 
         setCanEdit(true);
         // console.log("canEdit textbox " + canEdit);
+        return;
+      }
 
-      } else if (!CAN_EDIT.current) {
-        console.log("Updating textbox as this user is not editing")
-        setTextValue(event.data);
+      const data = JSON.parse(event.data);
+      if (data.queue) {
+        setQueueInfo(data.queue);
+      } else if (data.resync) {
+        // Replica could not apply our operation, fall back to sending the whole document
+        VERSION.current = data.version + 1;
+        ws.send(JSON.stringify({ content: TEXT.current }));
+      } else if (CAN_EDIT.current) {
+        // Only one client can edit at a time, so the editor's own text is the latest
+      } else if (data.edits) {
+        // Edits missed while reconnecting, applied in order
+        for (const frame of data.edits) {
+          if (!applyFrame(ws, frame)) {
+            return;
+          }
+        }
+      } else {
+        applyFrame(ws, data);
       }
-      // Shouldn't need this as only once client can update
-      //setTextValue(event.data);
     };
 
     ws.onclose = () => {
@@ -92,6 +141,25 @@ export default function Document() {
     setWebSocket(ws);
   };
 
+  // Apply an operation or full content frame from the replica, returns false if an operation was missed
+  const applyFrame = (ws, frame) => {
+    if (frame.op) {
+      if (frame.version !== VERSION.current + 1) {
+        // Missed an operation, ask for the whole document
+        ws.send(JSON.stringify({ resync: true }));
+        return false;
+      }
+      console.log("Updating textbox as this user is not editing")
+      TEXT.current = applyOp(TEXT.current, frame.op);
+    } else {
+      TEXT.current = frame.content;
+      HAS_DOC.current = true;
+    }
+    VERSION.current = frame.version;
+    setTextValue(TEXT.current);
+    return true;
+  };
+
   const requestNewIPAndPort = (ip, port) => {
     const bodyObj = JSON.stringify({
       IP: ip,
@@ -110,6 +178,7 @@ export default function Document() {
           IP: ip,
           PORT: port,
           docID: id,
+          viewOnly: VIEW_ONLY,
         }),
       })
         .then((response) => response.json())
@@ -155,10 +224,13 @@ export default function Document() {
     const { value } = event.target;
     setTextValue(value);
 
-    // Send textValue if the ws is open
+    // Send only the change (and the version it applies to) if the ws is open
     if (webSocket && webSocket.readyState === WebSocket.OPEN) {
-      webSocket.send(JSON.stringify({ content: value }));
+      const op = diffOp(TEXT.current, value);
+      webSocket.send(JSON.stringify({ op: op, version: VERSION.current }));
+      VERSION.current += 1;
     }
+    TEXT.current = value;
   }
 
   function navigateHome() {
@@ -185,7 +257,7 @@ export default function Document() {
       </nav>
       <div className="main">
         <div className="container" style={{ border: "none", padding: "15px" }}>
-          {!canEdit && (
+          {!canEdit && !VIEW_ONLY && (
             <>
               {isLoading ? (
                 <button className="btn"
@@ -197,7 +269,9 @@ export default function Document() {
                     borderRadius: "20px",
                   }}
                 >
-                  Loading...
+                  {queueInfo
+                    ? `Waiting to edit (position ${queueInfo.position}, ~${Math.ceil(queueInfo.estimatedWait)}s)`
+                    : "Loading..."}
                 </button>
               ) : (
                 <button className="btn"
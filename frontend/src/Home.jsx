@@ -7,16 +7,17 @@ const Home = () => {
   const [idSelected, setIdSelected] = useState("");
   const [nameSelected, setNameSelected] = useState("");
   const [searchTerm, setSearchTerm] = useState("");
+  const [hasMore, setHasMore] = useState(false);
 
   const MASTER_IP = "10.13.67.149";
+  // NOTE: the list is read a page at a time, searching asks the master for names starting with the search term
+  const PAGE_SIZE = 50;
 
   const handleSearchChange = (e) => {
     setSearchTerm(e.target.value);
   };
 
-  const filteredDocList = docList.filter(([index, doc]) =>
-    doc.name.toLowerCase().includes(searchTerm.toLowerCase())
-  );
+  const filteredDocList = Object.entries(docList);
 
   const handleChange = (e) => setDocName(e.target.value);
 
@@ -45,10 +46,14 @@ const Home = () => {
       });
   };
 
-  const navigateToExistingDocument = () => {
+  // NOTE: a client opening the document to only view it is placed on a read-only relay when one is up
+  const navigateToExistingDocument = (viewOnly) => {
     console.log(idSelected);
     console.log(nameSelected);
-    fetch("http://" + MASTER_IP + ":8000/connectToExistingDoc/", {
+    // NOTE: the docID lets the master send every client of a document to the same replica
+    const params = new URLSearchParams({ docID: idSelected });
+    if (viewOnly) params.set("viewOnly", true);
+    fetch("http://" + MASTER_IP + ":8000/connectToExistingDoc/?" + params, {
       method: "POST",
       header: {
         "Content-Type": "application/json",
@@ -61,21 +66,26 @@ const Home = () => {
         console.log(IP);
         console.log(port);
         navigate(
-          `/document/` + IP + "/" + port + "/" + idSelected + "/" + nameSelected
+          `/document/` + IP + "/" + port + "/" + idSelected + "/" + nameSelected + (viewOnly ? "?view=true" : "")
         );
       });
   };
 
-  // Get Document List from the server
-  const getDocList = async () => {
-    const response = await fetch("http://" + MASTER_IP + ":8000/docList/");
-    setDocList(Object.entries(await response.json()));
+  // Get Document List from the server (the page after docID 'after', or the first page)
+  const getDocList = async (after) => {
+    const params = new URLSearchParams({ limit: PAGE_SIZE });
+    if (searchTerm) params.set("prefix", searchTerm);
+    if (after !== undefined) params.set("after", after);
+    const response = await fetch("http://" + MASTER_IP + ":8000/docList/?" + params);
+    const page = await response.json();
+    setDocList((docs) => (after !== undefined ? [...docs, ...page] : page));
+    setHasMore(page.length === PAGE_SIZE);
     console.log(response);
   };
 
   useEffect(() => {
     getDocList();
-  }, []);
+  }, [searchTerm]);
 
   return (
     <>
@@ -174,14 +184,31 @@ const Home = () => {
                 </button>
               ))
             )}
+            {hasMore && (
+              <button
+                onClick={() => getDocList(docList[docList.length - 1].id)}
+                style={{ margin: "10px", cursor: "pointer" }}
+              >
+                Load more
+              </button>
+            )}
           </div>
         </div>
-        <button
-          className="openDocButton"
-          disabled={!idSelected}
-          onClick={navigateToExistingDocument}>
-          Open Selected Document
-        </button>
+        <div>
+          <button
+            className="openDocButton"
+            disabled={!idSelected}
+            onClick={() => navigateToExistingDocument(false)}>
+            Open Selected Document
+          </button>
+          <button
+            className="openDocButton"
+            disabled={!idSelected}
+            onClick={() => navigateToExistingDocument(true)}
+            style={{ marginLeft: "10px" }}>
+            View Selected Document
+          </button>
+        </div>
       </div>
     </>
   );